@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Adaptive (AIMD) concurrency limits for downloads and R2 uploads.
+
+Each remote host, and the R2 endpoint, gets an `AdaptiveLimiter` that caps
+how many requests are in flight, the way TCP congestion control caps a
+window:
+
+- every healthy response grows the limit by about one request per window
+  (additive increase, up to `max_limit`)
+- a throttling response (HTTP 429/503, S3 SlowDown and friends) halves it
+  (multiplicative decrease, down to `min_limit`); a latency spike well above
+  the recent average trims it by 10%
+- decreases happen at most once per window: requests that were already in
+  flight when the limit dropped do not shrink it again
+
+Throttled calls are retried after a full-jitter exponential backoff (or the
+server's Retry-After, if longer), so a large backfill settles at the highest
+concurrency the remote accepts instead of failing a burst of assets.
+"""
+
+import time
+import random
+import threading
+from typing import Callable, Optional, TypeVar
+
+from tracing import tracer
+
+T = TypeVar('T')
+
+# HTTP statuses and S3 error codes that mean "slow down" rather than "failed"
+THROTTLE_STATUSES = {429, 503}
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'TooManyRequests',
+                  'TooManyRequestsException', 'RequestLimitExceeded', 'ServiceUnavailable'}
+
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+# A response this many times slower than the running average (and slower than
+# the floor) counts as congestion
+LATENCY_SPIKE_FACTOR = 4.0
+LATENCY_SPIKE_FLOOR = 1.0
+LATENCY_SMOOTHING = 0.1
+
+THROTTLE_DECREASE = 0.5
+LATENCY_DECREASE = 0.9
+
+
+def _response_details(exc: BaseException):
+    """(status, error code, Retry-After) of a requests HTTPError or botocore ClientError"""
+    response = getattr(exc, 'response', None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        metadata = response.get('ResponseMetadata', {})
+        return (metadata.get('HTTPStatusCode'), response.get('Error', {}).get('Code'),
+                metadata.get('HTTPHeaders', {}).get('retry-after'))
+    if response is not None:
+        # requests HTTPError
+        return getattr(response, 'status_code', None), None, response.headers.get('Retry-After')
+    return None, None, None
+
+
+def is_throttled(exc: BaseException) -> bool:
+    """True if exc is the remote asking us to slow down"""
+    status, code, _ = _response_details(exc)
+    if status in THROTTLE_STATUSES or code in THROTTLE_CODES:
+        return True
+    # boto3's managed transfers (upload_fileobj) wrap the ClientError into a message
+    message = str(exc)
+    return any(f"({code})" in message for code in THROTTLE_CODES)
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds the server asked us to wait, if it sent a numeric Retry-After"""
+    value = _response_details(exc)[2]
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP) -> float:
+    """Full-jitter exponential backoff for the given retry attempt (0-based)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptiveLimiter:
+    def __init__(self, name: str, initial_limit: int, max_limit: int, min_limit: int = 1,
+                 max_retries: int = DEFAULT_MAX_RETRIES):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.max_retries = max_retries
+        self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+
+        self._inflight = 0
+        self._changed = threading.Condition()
+        self._last_decrease = 0.0
+        self._average_latency: Optional[float] = None
+
+        self.stats = {'throttled': 0, 'retries': 0, 'latency_spikes': 0, 'lowest_limit': int(self.limit)}
+
+    def acquire(self) -> float:
+        """Block until a slot is free under the current limit; returns the start time"""
+        with self._changed:
+            while self._inflight >= int(self.limit):
+                self._changed.wait()
+            self._inflight += 1
+        return time.monotonic()
+
+    def release(self, started: float, throttled: bool = False, failed: bool = False):
+        """Free a slot and adjust the limit from how the request went
+
+        A request that failed for another reason (e.g. a 404) leaves the limit alone.
+        """
+        now = time.monotonic()
+        latency = now - started
+        with self._changed:
+            self._inflight -= 1
+
+            if throttled:
+                self.stats['throttled'] += 1
+                self._decrease(started, now, THROTTLE_DECREASE)
+            elif not failed:
+                if self._is_latency_spike(latency):
+                    self.stats['latency_spikes'] += 1
+                    self._decrease(started, now, LATENCY_DECREASE)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._average_latency = latency if self._average_latency is None else (
+                    (1 - LATENCY_SMOOTHING) * self._average_latency + LATENCY_SMOOTHING * latency
+                )
+            self._changed.notify_all()
+
+    def _is_latency_spike(self, latency: float) -> bool:
+        return (self._average_latency is not None and latency > LATENCY_SPIKE_FLOOR
+                and latency > LATENCY_SPIKE_FACTOR * self._average_latency)
+
+    def _decrease(self, started: float, now: float, factor: float):
+        # Requests already in flight when the limit last dropped saw the old window; ignore them
+        if started < self._last_decrease:
+            return
+        self.limit = max(float(self.min_limit), self.limit * factor)
+        self._last_decrease = now
+        self.stats['lowest_limit'] = min(self.stats['lowest_limit'], int(self.limit))
+
+    def run(self, fn: Callable[[], T]) -> T:
+        """Call fn under the limit, retrying with jittered backoff while the remote throttles"""
+        for attempt in range(self.max_retries + 1):
+            started = self.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                throttled = is_throttled(e)
+                self.release(started, throttled=throttled, failed=True)
+                if not throttled or attempt == self.max_retries:
+                    raise
+                delay = max(backoff_delay(attempt), retry_after(e) or 0.0)
+                with self._changed:
+                    self.stats['retries'] += 1
+                with tracer.span('backoff', asset=self.name):
+                    time.sleep(delay)
+                continue
+            self.release(started)
+            return result
+
+    def summary(self) -> Optional[str]:
+        """One line about throttling, or None if the remote never pushed back"""
+        stats = self.stats
+        if not stats['throttled'] and not stats['latency_spikes']:
+            return None
+        return (
+            f"{self.name}: throttled {stats['throttled']}x, {stats['latency_spikes']} latency spikes, "
+            f"{stats['retries']} retries; concurrency dipped to {stats['lowest_limit']}, now {int(self.limit)}"
+        )
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark diagram post-processing: the previous per-script compositor versus
+diagram_postprocess.round_and_flatten.
+
+A synthetic 4K-scale RGBA render (what `--scale 2` produces for a large
+diagram) is padded, rounded and flattened repeatedly. Latency is measured in
+process; peak memory is measured as the growth of the max RSS of a fresh
+child process per implementation, since Pillow's buffers bypass tracemalloc.
+AVIF encoding is identical for both and left out.
+
+Usage:
+    python scripts/benchmarks/bench_postprocess.py [--width 3840] [--height 2160] [--runs 10]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import statistics
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image, ImageDraw  # noqa: E402
+from diagram_postprocess import round_and_flatten  # noqa: E402
+from corpus import synthetic_render  # noqa: E402
+
+PADDING = 20
+RADIUS = 12
+
+
+def legacy_postprocess(png_data: bytes) -> Image.Image:
+    """The compositor previously duplicated in the D2 and Mermaid scripts"""
+    with Image.open(io.BytesIO(png_data)) as img:
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        new_width = img.width + PADDING * 2
+        new_height = img.height + PADDING * 2
+
+        padded_img = Image.new('RGBA', (new_width, new_height), (0, 0, 0, 0))
+        padded_img.paste(img, (PADDING, PADDING))
+
+        mask = Image.new('L', (new_width, new_height), 0)
+        ImageDraw.Draw(mask).rounded_rectangle([(0, 0), (new_width, new_height)], radius=RADIUS, fill=255)
+
+        rounded_img = Image.new('RGBA', (new_width, new_height), (0, 0, 0, 0))
+        rounded_img.paste(padded_img, (0, 0))
+        rounded_img.putalpha(mask)
+
+        background = Image.new('RGB', rounded_img.size, (255, 255, 255))
+        background.paste(rounded_img, mask=rounded_img.split()[-1])
+        return background
+
+
+def shared_postprocess(png_data: bytes) -> Image.Image:
+    return round_and_flatten(png_data, padding=PADDING, radius=RADIUS)
+
+
+IMPLEMENTATIONS = {'legacy': legacy_postprocess, 'shared': shared_postprocess}
+
+
+def max_rss_mb() -> float:
+    """Peak resident memory of this process in MiB"""
+    # Linux carries ru_maxrss over from the forking parent, VmHWM starts fresh at exec
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def measure_peak(name: str, png_path: str):
+    """Child process entry point: print the RSS growth of one post-process call"""
+    with open(png_path, 'rb') as f:
+        png_data = f.read()
+    before = max_rss_mb()
+    IMPLEMENTATIONS[name](png_data)
+    print(json.dumps({'peak_mb': max_rss_mb() - before}))
+
+
+def run_one(name: str, fn, png_data: bytes, png_path: str, runs: int):
+    """Time one implementation in process and measure its peak memory in a child"""
+    fn(png_data)  # warm-up (mask cache, allocator)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(png_data)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    child = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--peak-child', name, png_path],
+        capture_output=True, text=True, check=True
+    )
+    peak = json.loads(child.stdout)['peak_mb']
+    print(f"{name:<16}{statistics.median(timings):>12.1f}{min(timings):>10.1f}{peak:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark diagram post-processing")
+    parser.add_argument('--width', type=int, default=3840)
+    parser.add_argument('--height', type=int, default=2160)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--peak-child', nargs=2, metavar=('IMPL', 'PNG'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.peak_child:
+        measure_peak(*args.peak_child)
+        return 0
+
+    png_data = synthetic_render(args.width, args.height)
+    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as f:
+        f.write(png_data)
+        png_path = f.name
+    print(f"Synthetic render: {args.width}x{args.height} RGBA, {len(png_data) / 1024:.0f} KiB PNG")
+    print(f"{'implementation':<16}{'median ms':>12}{'min ms':>10}{'peak MiB':>12}")
+
+    try:
+        for name, fn in IMPLEMENTATIONS.items():
+            run_one(name, fn, png_data, png_path, args.runs)
+    finally:
+        os.unlink(png_path)
+
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
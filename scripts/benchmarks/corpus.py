@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Synthetic blog corpus for the migration benchmarks.
+
+`generate_corpus` writes a throwaway project with `src/content/blog/<post>/index.mdx`
+files of varying size. Posts mix local images, remote images and Giphy links
+(served by the fixture server), Mermaid and D2 blocks, and unrelated code
+fences. The corpus is fully determined by its seed, so runs are comparable.
+"""
+
+import io
+import random
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+from PIL import Image, ImageDraw
+
+# Post shapes: (name, paragraphs, local images, remote images, giphy links, mermaid, d2)
+POST_SIZES = (
+    ('small', 4, 1, 1, 0, 1, 0),
+    ('medium', 12, 3, 2, 1, 2, 1),
+    ('large', 40, 8, 5, 2, 4, 3),
+)
+
+LOREM = (
+    "Caching is a trade-off between memory and recomputation, and every layer of "
+    "the stack makes that trade-off differently. "
+)
+
+
+class Corpus(NamedTuple):
+    root: Path
+    posts: List[Path]
+    # Remote path (served by the fixture server) -> file bytes
+    remote_files: Dict[str, bytes]
+    # Giphy media path (served under /giphy/) -> GIF bytes
+    giphy_files: Dict[str, bytes]
+
+
+def synthetic_photo(rng: random.Random, width: int, height: int, fmt: str) -> bytes:
+    """Gradient with noise-like blocks, roughly as hard to encode as a screenshot"""
+    img = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(img)
+    for y in range(0, height, 8):
+        shade = int(255 * y / height)
+        draw.rectangle([0, y, width, y + 8], fill=(shade, 128, 255 - shade))
+    for _ in range(60):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle([x, y, x + rng.randrange(10, 120), y + rng.randrange(10, 80)],
+                       fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    output = io.BytesIO()
+    img.save(output, fmt)
+    return output.getvalue()
+
+
+def synthetic_gif(frames: int = 12, size: int = 200) -> bytes:
+    images = []
+    for i in range(frames):
+        frame = Image.new('RGB', (size, size), 'white')
+        ImageDraw.Draw(frame).ellipse([i * 10, 60, i * 10 + 60, 120], fill=(200, 40, 40))
+        images.append(frame)
+    output = io.BytesIO()
+    images[0].save(output, 'GIF', save_all=True, append_images=images[1:], duration=80, loop=0)
+    return output.getvalue()
+
+
+def synthetic_render(width: int, height: int) -> bytes:
+    """A transparent canvas with boxes, lines and text, like a rendered diagram"""
+    img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    for i in range(0, width - 200, 240):
+        for j in range(0, height - 120, 180):
+            draw.rounded_rectangle([i + 20, j + 20, i + 200, j + 120], radius=10,
+                                   fill=(235, 240, 255, 255), outline=(40, 40, 90, 255), width=3)
+            draw.text((i + 40, j + 60), f"node {i}-{j}", fill=(20, 20, 20, 255))
+            draw.line([i + 200, j + 70, i + 260, j + 70], fill=(90, 90, 90, 255), width=3)
+    output = io.BytesIO()
+    img.save(output, 'PNG', compress_level=1)
+    return output.getvalue()
+
+
+def render_size_for(code: str) -> tuple:
+    """Plausible `--scale 2` render size for a diagram of this many lines"""
+    lines = code.count('\n') + 1
+    return 600 + 160 * lines, 400 + 90 * lines
+
+
+def _mermaid_block(rng: random.Random) -> str:
+    nodes = rng.randrange(4, 14)
+    edges = "\n".join(f"    N{i} --> N{i + 1}" for i in range(nodes))
+    return f"```mermaid\ngraph TD\n{edges}\n```"
+
+
+def _d2_block(rng: random.Random) -> str:
+    nodes = rng.randrange(3, 10)
+    edges = "\n".join(f'n{i} -> n{i + 1}: "step {i}"' for i in range(nodes))
+    return f"```d2\n{edges}\n```"
+
+
+def generate_corpus(root: Path, posts: int = 12, seed: int = 1234, fixture_url: str = "") -> Corpus:
+    """Write a synthetic project under root; remote refs point at fixture_url"""
+    rng = random.Random(seed)
+    blog_dir = root / "src" / "content" / "blog"
+    blog_dir.mkdir(parents=True, exist_ok=True)
+
+    remote_files: Dict[str, bytes] = {}
+    giphy_files: Dict[str, bytes] = {}
+    gif = synthetic_gif()
+    post_dirs = []
+
+    for n in range(posts):
+        size_name, paragraphs, local, remote, giphy, mermaid, d2 = POST_SIZES[n % len(POST_SIZES)]
+        post_dir = blog_dir / f"{size_name}-post-{n:03d}"
+        post_dir.mkdir(exist_ok=True)
+        blocks = [f"---\ntitle: Post {n}\n---\n", f"## Introduction {n}\n"]
+
+        for i in range(local):
+            name = f"figure-{i}.png" if i % 2 == 0 else f"photo-{i}.jpg"
+            width, height = rng.choice(((640, 400), (960, 540), (1280, 800)))
+            fmt = 'PNG' if name.endswith('.png') else 'JPEG'
+            (post_dir / name).write_bytes(synthetic_photo(rng, width, height, fmt))
+            blocks.append(f"![Figure {i}](./{name})\n")
+
+        for i in range(remote):
+            path = f"/images/{post_dir.name}-{i}.jpg"
+            remote_files[path] = synthetic_photo(rng, 800, 500, 'JPEG')
+            blocks.append(f'<img src="{fixture_url}{path}" alt="Remote {i}" />\n')
+
+        for i in range(giphy):
+            media_path = f"/media/{post_dir.name}{i}/giphy.gif"
+            giphy_files[media_path] = gif
+            blocks.append(f"![Reaction {i}](https://media{i % 4}.giphy.com{media_path})\n")
+
+        for i in range(mermaid):
+            blocks.append(f"### Flow {i}\n\n{_mermaid_block(rng)}\n")
+        for i in range(d2):
+            blocks.append(f"### Architecture {i}\n\n{_d2_block(rng)}\n")
+
+        # Prose and unrelated code, including an image link that must not be migrated
+        for i in range(paragraphs):
+            blocks.append(LOREM * rng.randrange(2, 8) + "\n")
+            if i % 5 == 4:
+                blocks.append("```python\nprint('![not an image](./skip.png)')\n```\n")
+
+        # Keep the front matter first, shuffle everything else
+        body = blocks[2:]
+        rng.shuffle(body)
+        (post_dir / "index.mdx").write_text("\n".join(blocks[:2] + body), encoding='utf-8')
+        post_dirs.append(post_dir)
+
+    return Corpus(root, post_dirs, remote_files, giphy_files)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Network stand-ins for the migration benchmarks.
+
+- `FixtureServer`: a threaded local HTTP server that serves in-memory files
+  with an optional per-request latency, standing in for image hosts
+- `GiphyRedirectAdapter`: routes https://media*.giphy.com requests of a
+  requests.Session to the fixture server
+- `FakeS3`: an in-process stand-in for the subset of the S3 API the migration
+  scripts use (PutObject, upload_fileobj, paginated ListObjectsV2), with an
+  optional per-request latency standing in for the R2 round trip
+"""
+
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from requests.adapters import HTTPAdapter
+
+
+class FixtureServer:
+    def __init__(self, files: Dict[str, bytes], latency: float = 0.0):
+        self.files = files
+        self.latency = latency
+        self.requests = 0
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'FixtureServer':
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fixture.requests += 1
+                if fixture.latency:
+                    time.sleep(fixture.latency)
+                body = fixture.files.get(urlparse(self.path).path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class GiphyRedirectAdapter(HTTPAdapter):
+    """Send Giphy media requests to `<fixture_url>/giphy/<path>` instead"""
+
+    def __init__(self, fixture_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.fixture_url = fixture_url
+
+    def send(self, request, **kwargs):
+        request.url = f"{self.fixture_url}/giphy{urlparse(request.url).path}"
+        return super().send(request, **kwargs)
+
+
+class FakeS3:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.objects: Dict[str, bytes] = {}
+        self.calls = {'put_object': 0, 'upload_fileobj': 0, 'list_objects_v2': 0}
+        self._lock = threading.Lock()
+
+    def _round_trip(self, operation: str):
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_object(self, Bucket: str, Key: str, Body, **kwargs) -> dict:
+        self._round_trip('put_object')
+        data = Body if isinstance(Body, bytes) else Body.read()
+        with self._lock:
+            self.objects[Key] = data
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, ExtraArgs=None, Config=None):
+        self._round_trip('upload_fileobj')
+        data = Fileobj.read()
+        with self._lock:
+            self.objects[Key] = data
+
+    def get_paginator(self, operation: str):
+        fake = self
+
+        class Paginator:
+            def paginate(self, Bucket: str, Prefix: str = ''):
+                fake._round_trip('list_objects_v2')
+                with fake._lock:
+                    contents = [
+                        {'Key': key, 'Size': len(data), 'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+                        for key, data in fake.objects.items() if key.startswith(Prefix)
+                    ]
+                yield {'Contents': contents}
+
+        return Paginator()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Stage-by-stage benchmark of the asset migration pipeline.
+
+A synthetic corpus (see corpus.py) is generated in a temporary project and
+every stage of the image migration is timed on its own, with the network
+replaced by local stand-ins (see fixtures.py):
+
+- scan:    tokenize every index.mdx (scan_content, bypassing the memo cache)
+- resolve: resolve every image reference to a local path or URL, as the image
+           migrator selects them, and every Giphy link to its canonical clip URL
+- fetch:   download remote images and Giphy GIFs from the fixture server
+- encode:  decode and AVIF-encode every image (GIFs pass through)
+- corners: pad, round and flatten a synthetic render per Mermaid/D2 block
+- upload:  push every encoded asset through R2UploadScheduler into FakeS3
+- rewrite: rewrite every index.mdx with the R2 URLs
+
+Each stage runs --repeat times and the median is reported. With --save-baseline
+the report is written as the new baseline; with --baseline the run fails
+(exit 1) when a stage's median exceeds the baseline by more than --threshold
+(and by more than --min-delta-ms, so sub-millisecond stages do not flap).
+Both default to the reference baseline committed next to this script; pass a
+path (e.g. under .cache/) to keep a baseline for this machine only.
+
+Usage:
+    python scripts/benchmarks/run_benchmarks.py [--posts 6] [--repeat 3]
+        [--save-baseline [PATH]] [--baseline [PATH]] [--threshold 0.25]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from corpus import generate_corpus, render_size_for, synthetic_render  # noqa: E402
+from fixtures import FakeS3, FixtureServer, GiphyRedirectAdapter  # noqa: E402
+
+# Reference baseline committed with the repo, recorded with the default options
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_MIN_DELTA_MS = 5.0
+
+def time_stage(run: Callable[[], int], repeat: int, setup: Callable[[], None] = None) -> Dict[str, float]:
+    """Median and min wall time of `run` in ms; `setup` runs untimed before each repeat"""
+    timings = []
+    items = 0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        items = run()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'median_ms': round(statistics.median(timings), 3), 'min_ms': round(min(timings), 3), 'items': items}
+
+
+def run_pipeline(args, work_dir: Path) -> Dict[str, Dict[str, float]]:
+    """Generate the corpus under work_dir and time every stage against the stand-ins"""
+    # Imported here so the migrator sees the benchmark's environment and working directory
+    import migrate_images_to_r2
+    from diagram_postprocess import round_and_flatten
+    from mdx_scanner import is_giphy_link, scan_content
+    from migrate_giphy_to_r2 import canonical_giphy_url
+    from r2_uploader import R2UploadScheduler
+
+    files: Dict[str, bytes] = {}
+    server = FixtureServer(files, latency=args.fetch_latency_ms / 1000).start()
+    try:
+        corpus = generate_corpus(work_dir, posts=args.posts, seed=args.seed, fixture_url=server.url)
+        files.update(corpus.remote_files)
+        files.update({f"/giphy{path}": data for path, data in corpus.giphy_files.items()})
+        originals = {post: (post / "index.mdx").read_bytes() for post in corpus.posts}
+
+        # The migrator hands _setup_r2_client to its uploader as the client factory, so the
+        # patched factory is kept and builds the FakeS3 client when the first upload needs it
+        with mock.patch.object(migrate_images_to_r2.ImageToR2Migrator, '_setup_r2_client',
+                               return_value=FakeS3()):
+            migrator = migrate_images_to_r2.ImageToR2Migrator(jobs=1)
+        migrator.fetcher.session.mount('https://media', GiphyRedirectAdapter(server.url))
+
+        # scan
+        scans = {}
+
+        def scan():
+            for post in corpus.posts:
+                with open(post / "index.mdx", 'r', encoding='utf-8') as f:
+                    scans[post] = scan_content(f.read())
+            return len(scans)
+
+        # resolve; markdown Giphy links are the Giphy migrator's, which fetches each clip's canonical URL
+        sources: List[Tuple[Path, str, str, str]] = []
+
+        def resolve():
+            sources.clear()
+            for post, scan_result in scans.items():
+                for ref in scan_result.image_refs:
+                    if not migrator._is_image_url(ref.src) or is_giphy_link(ref):
+                        continue
+                    resolved = migrator.resolve_image_path(ref.src, post)
+                    if resolved:
+                        sources.append((post, ref.full_match, ref.src, resolved))
+                for link in scan_result.giphy_links:
+                    sources.append((post, f"![{link.alt_text}]({link.url})", link.url, canonical_giphy_url(link.url)))
+            return len(sources)
+
+        # fetch (local files are read in the same stage, as download_or_read_image does)
+        payloads: Dict[str, bytes] = {}
+
+        def fetch():
+            urls = [source for _, _, _, source in sources if source.startswith(('http://', 'https://'))]
+            for url, result in migrator.fetcher.fetch_all(urls).items():
+                if isinstance(result, Exception):
+                    raise result
+                payloads[url] = result
+            for _, _, _, source in sources:
+                if source not in payloads:
+                    payloads[source] = migrator.download_or_read_image(source)
+            return len(payloads)
+
+        # encode
+        encoded: Dict[str, Tuple[bytes, str]] = {}
+
+        def encode():
+            for source, data in payloads.items():
+                body, content_type, _ = migrate_images_to_r2.encode_image(data, source)
+                encoded[source] = (body, content_type)
+            return len(encoded)
+
+        # corners, on renders made untimed at the size each block would render at
+        renders: List[bytes] = []
+
+        def make_renders():
+            if not renders:
+                renders.extend(
+                    synthetic_render(*render_size_for(block.code))
+                    for scan_result in scans.values()
+                    for block in scan_result.mermaid_blocks + scan_result.d2_blocks
+                )
+
+        def corners():
+            for png_data in renders:
+                round_and_flatten(png_data, padding=20, radius=12)
+            return len(renders)
+
+        # upload, into an empty bucket every repeat so each asset is a real PUT
+        urls: Dict[Tuple[Path, str], str] = {}
+
+        def upload():
+            fake = FakeS3(latency=args.upload_latency_ms / 1000)
+            scheduler = R2UploadScheduler(lambda: fake, migrator.bucket_name, migrator.r2_public_url)
+            futures = []
+            for post, full_match, _, source in sources:
+                body, content_type = encoded[source]
+                key = f"blogs/{post.name}/{migrator.generate_filename(source, '', body)}"
+                futures.append(((post, full_match), scheduler.submit(key, body, content_type)))
+            for ref, future in futures:
+                urls[ref] = future.result()
+            scheduler.close()
+            return len(futures)
+
+        # rewrite, starting from the original files every repeat
+        def restore():
+            for post, content in originals.items():
+                (post / "index.mdx").write_bytes(content)
+
+        def rewrite():
+            for post in corpus.posts:
+                replacements = {
+                    full_match: url for (ref_post, full_match), url in urls.items()
+                    if ref_post == post and full_match.startswith('![')
+                }
+                elements = {
+                    full_match: f'<img src="{url}" />' for (ref_post, full_match), url in urls.items()
+                    if ref_post == post and not full_match.startswith('![')
+                }
+                migrator.replace_image_references_in_file(post / "index.mdx", replacements, elements)
+            return len(corpus.posts)
+
+        # Every stage runs once untimed first, which also produces the next stage's input
+        stages = {}
+        for name, run, setup in (
+            ('scan', scan, None),
+            ('resolve', resolve, None),
+            ('fetch', fetch, payloads.clear),
+            ('encode', encode, encoded.clear),
+            ('corners', corners, make_renders),
+            ('upload', upload, urls.clear),
+            ('rewrite', rewrite, restore),
+        ):
+            if setup is not None:
+                setup()
+            run()
+            stages[name] = time_stage(run, args.repeat, setup)
+            print(f"  {name:<10}{stages[name]['median_ms']:>12.1f}{stages[name]['min_ms']:>10.1f}"
+                  f"{stages[name]['items']:>8}")
+
+        migrator.fetcher.close()
+        migrator.uploader.close()
+        return stages
+    finally:
+        server.stop()
+
+
+def compare(report: dict, baseline: dict, threshold: float, min_delta_ms: float) -> List[str]:
+    """Stages whose median regressed beyond the threshold, as printable lines"""
+    regressions = []
+    for name, current in report['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if previous is None:
+            continue
+        limit = previous['median_ms'] * (1 + threshold)
+        delta = current['median_ms'] - previous['median_ms']
+        if current['median_ms'] > limit and delta > min_delta_ms:
+            regressions.append(
+                f"{name}: {previous['median_ms']:.1f} ms -> {current['median_ms']:.1f} ms "
+                f"(+{delta / previous['median_ms'] * 100:.0f}%)"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the asset migration pipeline stage by stage")
+    parser.add_argument('--posts', type=int, default=6, help='Number of synthetic posts')
+    parser.add_argument('--seed', type=int, default=1234, help='Corpus seed')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage')
+    parser.add_argument('--fetch-latency-ms', type=float, default=0.0,
+                        help='Simulated latency per fixture server request')
+    parser.add_argument('--upload-latency-ms', type=float, default=0.0,
+                        help='Simulated latency per S3 request')
+    parser.add_argument('--output', type=Path, help='Also write the report to this JSON file')
+    parser.add_argument('--save-baseline', type=Path, nargs='?', const=DEFAULT_BASELINE,
+                        help=f'Store this run as the baseline (default path: {DEFAULT_BASELINE})')
+    parser.add_argument('--baseline', type=Path, nargs='?', const=DEFAULT_BASELINE,
+                        help=f'Fail if a stage regressed against this baseline (default path: {DEFAULT_BASELINE})')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Allowed slowdown per stage as a fraction (default: 0.25)')
+    parser.add_argument('--min-delta-ms', type=float, default=DEFAULT_MIN_DELTA_MS,
+                        help='Ignore regressions smaller than this many ms (default: 5)')
+    args = parser.parse_args()
+
+    # Paths given on the command line are relative to where the benchmark was started
+    cwd = Path.cwd()
+    paths = {name: (cwd / getattr(args, name)) if getattr(args, name) else None
+             for name in ('output', 'save_baseline', 'baseline')}
+
+    work_dir = Path(tempfile.mkdtemp(prefix='migration-bench-'))
+    env = {
+        'MIGRATION_STATE_DISABLE': '1',
+        'DIAGRAM_CACHE_DISABLE': '1',
+        'HTTP_CACHE_DISABLE': '1',
+        'R2_ACCESS_KEY_ID': 'bench',
+        'R2_SECRET_ACCESS_KEY': 'bench',
+        'R2_ENDPOINT_URL': 'http://127.0.0.1:9',
+        'R2_BUCKET_NAME': 'bench',
+        'R2_PUBLIC_URL': 'https://assets.example.com',
+    }
+    print(f"Corpus: {args.posts} posts (seed {args.seed}) in {work_dir}, {args.repeat} runs per stage")
+    print(f"  {'stage':<10}{'median ms':>12}{'min ms':>10}{'items':>8}")
+
+    try:
+        with mock.patch.dict(os.environ, env):
+            os.chdir(work_dir)
+            try:
+                stages = run_pipeline(args, work_dir)
+            finally:
+                os.chdir(cwd)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'corpus': {'posts': args.posts, 'seed': args.seed},
+        'repeat': args.repeat,
+        'stages': stages,
+    }
+
+    for path in (paths['output'], paths['save_baseline']):
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(report, indent=2) + "\n", encoding='utf-8')
+            print(f"Report written to {path}")
+
+    if paths['baseline'] is not None:
+        if not paths['baseline'].exists():
+            print(f"No baseline at {paths['baseline']}; run with --save-baseline first")
+            return 1
+        baseline = json.loads(paths['baseline'].read_text(encoding='utf-8'))
+        if baseline.get('corpus') != report['corpus']:
+            print(f"⚠️  Baseline corpus {baseline.get('corpus')} differs from this run's {report['corpus']}")
+        for key in ('machine', 'python'):
+            if baseline.get(key) != report[key]:
+                print(f"⚠️  Baseline was recorded on {key} {baseline.get(key)}, this run is on {report[key]}; "
+                      f"timings may not be comparable")
+        regressions = compare(report, baseline, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f"✗ {len(regressions)} stage(s) regressed by more than {args.threshold * 100:.0f}%:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"✓ No stage regressed by more than {args.threshold * 100:.0f}% against {paths['baseline']}")
+
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Watch mode for the migration scripts.
+
+After a normal catch-up run, the migrators stay alive and watch src/content/
+for saved `index.mdx` files (inotify on Linux, mtime polling elsewhere).
+Saves are debounced, so an editor writing a file in several steps triggers
+one migration. Each saved file is re-scanned and its asset spans (images,
+Giphy links, Mermaid and D2 blocks) are diffed against the last known state.
+Only the migrators whose kind of asset was added or changed run, so fixing a
+typo in prose costs a scan and nothing else.
+
+Migrators are built once, so the HTTP session, R2 client, upload pool,
+encoder processes and render container stay warm between saves, and a new
+diagram is live on R2 a second or two after it is written.
+
+Usage:
+    python scripts/<migrator>.py --watch        # one migrator
+    python scripts/content_watcher.py           # Giphy, images, Mermaid and D2 together
+        [--jobs N] [--debounce SECONDS] [--poll] [--trace PATH]
+"""
+
+import os
+import time
+import ctypes
+import select
+import struct
+import argparse
+import ctypes.util
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from mdx_scanner import scan_mdx
+from tracing import tracer
+
+DEFAULT_CONTENT_DIR = Path("src/content")
+DEFAULT_DEBOUNCE = 0.3
+DEFAULT_POLL_INTERVAL = 0.5
+
+# Only index.mdx files are migrated (see each migrator's process_blog_post)
+WATCHED_NAME = "index.mdx"
+
+# Kind of asset span each migrator (by STATE_NAME) migrates
+ASSET_KINDS = {
+    'giphy': 'giphy',
+    'images': 'image',
+    'mermaid': 'mermaid',
+    'd2': 'd2',
+    'docker-d2': 'd2',
+}
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def asset_spans(mdx_file: Path) -> Set[Tuple[str, str]]:
+    """(kind, source) for every migratable asset in an MDX file"""
+    scan = scan_mdx(mdx_file)
+    return (
+        {('image', ref.full_match) for ref in scan.image_refs}
+        | {('giphy', link.url) for link in scan.giphy_links}
+        | {('mermaid', block.code) for block in scan.mermaid_blocks}
+        | {('d2', block.code) for block in scan.d2_blocks}
+    )
+
+
+class _InotifyBackend:
+    """Recursive inotify watch on a directory tree, read with a timeout"""
+    name = "inotify"
+
+    def __init__(self, root: Path):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches: Dict[int, Path] = {}
+        self._add_tree(root)
+
+    def _add_tree(self, directory: Path) -> List[Path]:
+        """Watch directory and everything below it; returns the files already in it"""
+        found = []
+        for current, subdirs, files in os.walk(directory):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(current), WATCH_MASK)
+            if wd >= 0:
+                self._watches[wd] = Path(current)
+            found.extend(Path(current) / name for name in files)
+        return found
+
+    def read(self, timeout: Optional[float]) -> List[Path]:
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory / name
+            if mask & IN_ISDIR:
+                # A new post directory: watch it, and pick up files written before the watch existed
+                paths.extend(self._add_tree(path))
+            else:
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _PollingBackend:
+    """mtime/size snapshots of every MDX file, for systems without inotify"""
+    name = "polling"
+
+    def __init__(self, root: Path, interval: float = DEFAULT_POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self._snapshot = self._take_snapshot()
+
+    def _take_snapshot(self) -> Dict[Path, Tuple[int, int]]:
+        snapshot = {}
+        for path in self.root.rglob(WATCHED_NAME):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def read(self, timeout: Optional[float]) -> List[Path]:
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        snapshot = self._take_snapshot()
+        changed = [path for path, signature in snapshot.items() if self._snapshot.get(path) != signature]
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class ContentWatcher:
+    def __init__(self, root: Path = DEFAULT_CONTENT_DIR, debounce: float = DEFAULT_DEBOUNCE, poll: bool = False):
+        self.root = root
+        self.debounce = debounce
+        self.backend = None
+        if not poll:
+            try:
+                self.backend = _InotifyBackend(root)
+            except (OSError, AttributeError):
+                # No inotify (macOS, BSD, some containers)
+                pass
+        if self.backend is None:
+            self.backend = _PollingBackend(root)
+
+    def batches(self) -> Iterator[Set[Path]]:
+        """Yield sets of saved index.mdx files, each once no further save came within the debounce window"""
+        while True:
+            changed = {path for path in self.backend.read(None) if path.name == WATCHED_NAME}
+            if not changed:
+                continue
+            while True:
+                more = self.backend.read(self.debounce)
+                if not more:
+                    break
+                changed.update(path for path in more if path.name == WATCHED_NAME)
+            yield changed
+
+    def close(self):
+        self.backend.close()
+
+
+def _migrate_saved_file(migrators: list, mdx_file: Path, new_spans: Set[Tuple[str, str]]):
+    kinds = {kind for kind, _ in new_spans}
+    due = [migrator for migrator in migrators if ASSET_KINDS.get(migrator.STATE_NAME) in kinds]
+    if not due:
+        return
+
+    started = time.monotonic()
+    with tracer.context(post=mdx_file.parent.name):
+        for migrator in due:
+            try:
+                migrator.process_blog_post(mdx_file.parent)
+            except Exception as e:
+                print(f"Error processing {mdx_file.parent}: {e}")
+    print(f"  ⏱  {mdx_file} done in {time.monotonic() - started:.2f}s")
+
+
+def watch_posts(migrators: list, content_dir: Path = DEFAULT_CONTENT_DIR,
+                debounce: float = DEFAULT_DEBOUNCE, poll: bool = False):
+    """Migrate new and changed assets of every saved index.mdx until interrupted"""
+    watcher = ContentWatcher(content_dir, debounce, poll)
+    known = {mdx_file: asset_spans(mdx_file) for mdx_file in content_dir.rglob(WATCHED_NAME)}
+
+    # Keep encoder processes alive between saves
+    for migrator in migrators:
+        if getattr(migrator, 'jobs', 1) > 1 and getattr(migrator, 'executor', None) is None:
+            from concurrent.futures import ProcessPoolExecutor
+            migrator.executor = ProcessPoolExecutor(max_workers=migrator.jobs)
+
+    print(f"Watching {content_dir} for saved {WATCHED_NAME} files ({watcher.backend.name}); press Ctrl-C to stop")
+    try:
+        for batch in watcher.batches():
+            for mdx_file in sorted(batch):
+                if not mdx_file.exists():
+                    known.pop(mdx_file, None)
+                    continue
+
+                spans = asset_spans(mdx_file)
+                new_spans = spans - known.get(mdx_file, set())
+                known[mdx_file] = spans
+                if not new_spans:
+                    continue
+
+                print(f"Saved: {mdx_file} ({len(new_spans)} new or changed assets)")
+                _migrate_saved_file(migrators, mdx_file, new_spans)
+
+                # Our own rewrite triggers another event; it must not look like a new edit
+                known[mdx_file] = asset_spans(mdx_file)
+    except KeyboardInterrupt:
+        print("\nStopped watching")
+    finally:
+        watcher.close()
+        for migrator in migrators:
+            if getattr(migrator, 'executor', None) is not None:
+                migrator.executor.shutdown()
+                migrator.executor = None
+
+
+def main():
+    """Run the Giphy, image, Mermaid and D2 migrators once, then keep them warm and watch"""
+    # Imported here: every migrator imports this module for its own --watch
+    from migrate_giphy_to_r2 import GiphyToR2Migrator
+    from migrate_images_to_r2 import ImageToR2Migrator
+    from migrate_mermaid_to_r2 import MermaidToR2Migrator
+    from migrate_d2_to_r2 import D2ToR2Migrator
+
+    parser = argparse.ArgumentParser(description="Migrate blog assets to R2 as MDX files are saved")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help='Number of parallel AVIF encoder processes (default: CPU count)')
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE,
+                        help=f'Seconds without further saves before migrating (default: {DEFAULT_DEBOUNCE})')
+    parser.add_argument('--poll', action='store_true', help='Poll for changes instead of using inotify')
+    parser.add_argument(
+        '--trace',
+        metavar='PATH',
+        help='Record per-stage spans and write them to PATH as Chrome trace JSON, '
+             'plus a p50/p95/max summary (default: MIGRATION_TRACE)'
+    )
+    args = parser.parse_args()
+    tracer.start(args.trace)
+
+    migrators = []
+    try:
+        for name, build in (
+            ('Giphy', GiphyToR2Migrator),
+            ('image', lambda: ImageToR2Migrator(jobs=args.jobs)),
+            ('Mermaid', MermaidToR2Migrator),
+            ('D2', D2ToR2Migrator),
+        ):
+            try:
+                migrators.append(build())
+            except Exception as e:
+                # e.g. R2_BUCKET_NAME missing; the other kinds are still migrated
+                print(f"⚠️  Not watching {name} assets: {e}")
+        if not migrators:
+            return 1
+
+        for migrator in migrators:
+            migrator.migrate_all_posts()
+        watch_posts(migrators, debounce=args.debounce, poll=args.poll)
+    finally:
+        for migrator in migrators:
+            if hasattr(migrator, 'fetcher'):
+                migrator.fetcher.close()
+            migrator.uploader.close()
+        trace_summary = tracer.finish()
+        if trace_summary:
+            print(trace_summary)
+
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Shared post-processing for rendered diagrams: padding, rounded corners and
+flattening onto a white background, ready for AVIF encoding.
+
+The output canvas is allocated once at its final padded size and the rendered
+PNG is alpha-composited straight into it, so there is no padded RGBA copy,
+no full-size mask and no second RGB buffer. Only the four corners outside the
+rounded rectangle differ from a plain padded flatten; they are painted with
+small per-radius masks that are built once and cached.
+"""
+
+import io
+from functools import lru_cache
+from typing import Tuple
+
+from lazy_import import lazy_import
+from tracing import tracer
+
+Image = lazy_import('PIL.Image')
+ImageDraw = lazy_import('PIL.ImageDraw')
+
+# Bump when the output of round_and_flatten changes, so render caches re-render
+POSTPROCESS_VERSION = 2
+
+WHITE = (255, 255, 255)
+
+
+@lru_cache(maxsize=32)
+def corner_masks(radius: int) -> Tuple['Image.Image', 'Image.Image', 'Image.Image', 'Image.Image']:
+    """Masks (255 = outside the rounded rectangle) for the TL, TR, BL and BR corners"""
+    # Pillow only draws corners identical to a full-canvas rounded rectangle once the
+    # straight edges are long enough, hence 4 * radius rather than the bare minimum
+    size = 4 * radius
+    shape = Image.new('L', (size, size), 255)
+    ImageDraw.Draw(shape).rounded_rectangle([(0, 0), (size - 1, size - 1)], radius=radius, fill=0)
+
+    return (
+        shape.crop((0, 0, radius, radius)),
+        shape.crop((size - radius, 0, size, radius)),
+        shape.crop((0, size - radius, radius, size)),
+        shape.crop((size - radius, size - radius, size, size)),
+    )
+
+
+def round_and_flatten(png_data: bytes, padding: int, radius: int,
+                      background: Tuple[int, int, int] = WHITE,
+                      corner_color: Tuple[int, int, int] = WHITE) -> 'Image.Image':
+    """Pad a rendered diagram, round its corners and flatten it onto `background` as RGB"""
+    with tracer.span('corners', bytes_in=len(png_data)):
+        return _round_and_flatten(png_data, padding, radius, background, corner_color)
+
+
+def _round_and_flatten(png_data: bytes, padding: int, radius: int, background: Tuple[int, int, int],
+                       corner_color: Tuple[int, int, int]) -> 'Image.Image':
+    with Image.open(io.BytesIO(png_data)) as img:
+        img.load()
+        width = img.width + 2 * padding
+        height = img.height + 2 * padding
+        canvas = Image.new('RGB', (width, height), background)
+
+        # Composite in place using the diagram's own alpha as the paste mask
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            rgba = img if img.mode == 'RGBA' else img.convert('RGBA')
+            canvas.paste(rgba, (padding, padding), rgba)
+        else:
+            canvas.paste(img.convert('RGB') if img.mode != 'RGB' else img, (padding, padding))
+
+    radius = min(radius, width // 2, height // 2)
+    if radius > 0:
+        top_left, top_right, bottom_left, bottom_right = corner_masks(radius)
+        canvas.paste(corner_color, (0, 0, radius, radius), top_left)
+        canvas.paste(corner_color, (width - radius, 0, width, radius), top_right)
+        canvas.paste(corner_color, (0, height - radius, radius, height), bottom_left)
+        canvas.paste(corner_color, (width - radius, height - radius, width, height), bottom_right)
+
+    return canvas
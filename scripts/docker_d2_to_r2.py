@@ -16,7 +16,8 @@ Requirements:
 - Pillow (for image processing)
 
 Usage:
-    python docker_d2_to_r2.py [--blog-post BLOG_NAME] [--dry-run] [--verbose]
+    python docker_d2_to_r2.py [--blog-post BLOG_NAME] [--dry-run] [--verbose] [--watch] [--trace PATH]
+                             [--stage] [--shard I/N] [MDX_FILE ...]
 
 Environment variables required:
 - R2_ACCESS_KEY_ID
@@ -28,23 +29,129 @@ Environment variables required:
 
 import os
 import re
-import hashlib
+import uuid
+import atexit
+import shutil
 import subprocess
 import tempfile
 import argparse
 import logging
+from concurrent.futures import Future
+from functools import cached_property
 from pathlib import Path
 from typing import List, Dict, Tuple, Optional
-import boto3
-from botocore.exceptions import ClientError
-from dotenv import load_dotenv
-from PIL import Image, ImageDraw
+from render_cache import RenderCache
+from image_quality import AvifEncoding, encode_avif, target_ssim_from_env
+from diagram_postprocess import POSTPROCESS_VERSION, round_and_flatten
+from mdx_scanner import scan_mdx
+from r2_uploader import R2UploadScheduler, content_hash, r2_client_config
+from migration_state import MigrationState, MIGRATED, FAILED
+from content_watcher import watch_posts
+from post_selection import file_signatures, select_posts, stage_rewritten
+from sharding import DEFAULT_MANIFEST_DIR, Shard
+from lazy_import import lazy_import, load_dotenv
+from tracing import tracer
+
+boto3 = lazy_import('boto3')
 
 # Load environment variables
 load_dotenv()
 
+D2_IMAGE = 'terrastruct/d2'
+
+# d2 CLI flags and post-processing parameters; both are part of the render cache key
+D2_RENDER_FLAGS = [
+    '--theme', '1',                # Vanilla Nitro - light theme
+    '--pad', '0',                  # No padding (we'll add it ourselves)
+    '--scale', '2',                # Higher resolution
+]
+POSTPROCESS_PARAMS = {'padding': 20, 'radius': 12, 'quality': 85, 'speed': 6, 'version': POSTPROCESS_VERSION}
+
+class D2RenderContainer:
+    """Long-lived d2 container that renders diagrams through `docker exec`.
+
+    Starting a container per diagram pays for create/start/teardown and a bind
+    mount every time; keeping one warm leaves only the d2 layout time per render.
+    """
+
+    def __init__(self, logger: logging.Logger, image: str = D2_IMAGE):
+        self.logger = logger
+        self.image = image
+        self.container_id: Optional[str] = None
+        self.workdir: Optional[Path] = None
+
+    def start(self):
+        """Start the container (idle until diagrams are exec'd into it)"""
+        if self.container_id:
+            return
+
+        self.workdir = Path(tempfile.mkdtemp(prefix='d2-render-'))
+        # The d2 user inside the container needs write access to the mount
+        os.chmod(self.workdir, 0o777)
+
+        docker_cmd = [
+            'docker', 'run', '-d', '--rm',
+            '--entrypoint', 'sleep',
+            '-v', f"{self.workdir}:/workspace",
+            self.image,
+            'infinity'
+        ]
+        self.logger.debug(f"Running Docker command: {' '.join(docker_cmd)}")
+        with tracer.span('container-start', asset=self.image):
+            result = subprocess.run(docker_cmd, capture_output=True, check=True, text=True)
+        self.container_id = result.stdout.strip()
+
+        # Make sure the container never outlives the run, even on errors
+        atexit.register(self.stop)
+        self.logger.info(f"Started D2 render container {self.container_id[:12]}")
+
+    def render(self, d2_code: str) -> bytes:
+        """Render D2 code to PNG and return the PNG bytes"""
+        self.start()
+
+        name = uuid.uuid4().hex
+        d2_file = self.workdir / f"{name}.d2"
+        png_file = self.workdir / f"{name}.png"
+        with open(d2_file, 'w', encoding='utf-8') as f:
+            f.write(d2_code)
+
+        try:
+            docker_cmd = [
+                'docker', 'exec', self.container_id,
+                'd2',
+                *D2_RENDER_FLAGS,
+                f"/workspace/{name}.d2",
+                f"/workspace/{name}.png"
+            ]
+            self.logger.debug(f"Running Docker command: {' '.join(docker_cmd)}")
+            result = subprocess.run(docker_cmd, capture_output=True, check=True, text=True)
+
+            if result.stderr:
+                self.logger.debug(f"D2 stderr: {result.stderr}")
+
+            # Read the PNG straight from the renderer output in the mounted directory
+            with open(png_file, 'rb') as f:
+                return f.read()
+        finally:
+            d2_file.unlink(missing_ok=True)
+            png_file.unlink(missing_ok=True)
+
+    def stop(self):
+        """Remove the container and its work directory"""
+        if self.container_id:
+            subprocess.run(['docker', 'rm', '-f', self.container_id], capture_output=True)
+            self.logger.debug(f"Removed D2 render container {self.container_id[:12]}")
+            self.container_id = None
+
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
+
 class DockerD2ToR2Migrator:
-    def __init__(self, verbose: bool = False, dry_run: bool = False):
+    # Key under which this migrator's progress is stored in the state database
+    STATE_NAME = 'docker-d2'
+    
+    def __init__(self, verbose: bool = False, dry_run: bool = False, shard: Optional[Shard] = None):
         self.blog_content_dir = Path("src/content/blog")
         self.verbose = verbose
         self.dry_run = dry_run
@@ -58,18 +165,36 @@ class DockerD2ToR2Migrator:
         self.logger = logging.getLogger(__name__)
         
         if not self.dry_run:
-            self.r2_client = self._setup_r2_client()
             self.bucket_name = os.getenv("R2_BUCKET_NAME")
             self.r2_public_url = os.getenv("R2_PUBLIC_URL", f"https://{self.bucket_name}.r2.dev")
             
             if not self.bucket_name:
                 raise ValueError("R2_BUCKET_NAME environment variable is required")
+            
+            # Uploads run concurrently in the background
+            self.uploader = R2UploadScheduler(self._setup_r2_client, self.bucket_name, self.r2_public_url)
+        else:
+            self.uploader = None
         
-        # Check if Docker is available
-        self._check_docker()
+        # Per-file record of what has already been migrated
+        self.state = MigrationState()
+
+        # A shard only migrates part of each file, which must not be remembered as done
+        self.shard = shard or Shard()
+        if self.shard.active:
+            self.state.enabled = False
+        
+        # Cache of final AVIF bytes keyed on diagram source and render settings
+        self.render_cache = RenderCache()
         
-        # Pull D2 Docker image if needed
-        self._ensure_d2_image()
+        # Optional SSIM target replacing the fixed AVIF quality
+        self.target_ssim = target_ssim_from_env()
+        self.postprocess_params = POSTPROCESS_PARAMS
+        if self.target_ssim:
+            self.postprocess_params = dict(POSTPROCESS_PARAMS, target_ssim=self.target_ssim)
+        
+        # Warm d2 container, started on the first render that misses the cache
+        self.render_container = D2RenderContainer(self.logger)
     
     def _setup_r2_client(self):
         """Setup Cloudflare R2 client using boto3"""
@@ -85,9 +210,16 @@ class DockerD2ToR2Migrator:
             endpoint_url=endpoint_url,
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key,
-            region_name='auto'
+            region_name='auto',
+            config=r2_client_config()
         )
     
+    @cached_property
+    def d2_image_id(self) -> str:
+        """ID of the D2 image, checked (and pulled) on the first diagram that needs a cache key"""
+        self._check_docker()
+        return self._ensure_d2_image()
+
     def _check_docker(self):
         """Check if Docker is available"""
         try:
@@ -98,20 +230,26 @@ class DockerD2ToR2Migrator:
                 "Docker not found. Please install Docker from: https://docs.docker.com/get-docker/"
             )
     
-    def _ensure_d2_image(self):
-        """Ensure D2 Docker image is available"""
+    def _ensure_d2_image(self) -> str:
+        """Ensure D2 Docker image is available and return its image ID"""
         try:
             # Check if image exists locally
             result = subprocess.run([
-                'docker', 'images', 'terrastruct/d2', '--format', '{{.Repository}}:{{.Tag}}'
+                'docker', 'images', D2_IMAGE, '--format', '{{.Repository}}:{{.Tag}}'
             ], capture_output=True, check=True, text=True)
             
-            if 'terrastruct/d2' in result.stdout:
+            if D2_IMAGE in result.stdout:
                 self.logger.info("D2 Docker image found locally")
             else:
                 self.logger.info("Pulling D2 Docker image...")
-                subprocess.run(['docker', 'pull', 'terrastruct/d2'], check=True)
+                subprocess.run(['docker', 'pull', D2_IMAGE], check=True)
                 self.logger.info("D2 Docker image pulled successfully")
+            
+            # The image ID identifies the exact d2 build used for rendering
+            result = subprocess.run([
+                'docker', 'image', 'inspect', D2_IMAGE, '--format', '{{.Id}}'
+            ], capture_output=True, check=True, text=True)
+            return result.stdout.strip()
                 
         except subprocess.CalledProcessError as e:
             self.logger.error(f"Failed to ensure D2 Docker image: {e}")
@@ -119,158 +257,36 @@ class DockerD2ToR2Migrator:
     
     def find_d2_blocks_with_headings(self, file_path: Path) -> List[Tuple[str, int, int, str]]:
         """Find all D2 code blocks in a markdown file with their preceding headings"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        # Find all d2 code blocks with their positions and headings
-        d2_blocks = []
-        lines = content.split('\n')
-
-        i = 0
-        while i < len(lines):
-            if lines[i].strip() == '```d2':
-                start_line = i
-                i += 1
-                d2_code = []
-
-                # Find the end of the code block
-                while i < len(lines) and lines[i].strip() != '```':
-                    d2_code.append(lines[i])
-                    i += 1
-
-                if i < len(lines):  # Found closing ```
-                    end_line = i
-
-                    # Find the preceding heading
-                    heading = self._find_preceding_heading(lines, start_line)
-
-                    d2_blocks.append(('\n'.join(d2_code), start_line, end_line, heading))
-
-            i += 1
-
-        return d2_blocks
-
-    def _find_preceding_heading(self, lines: List[str], d2_start_line: int) -> str:
-        """Find the most recent heading before the D2 block"""
-        # Look backwards from the D2 block to find a heading
-        for i in range(d2_start_line - 1, -1, -1):
-            line = lines[i].strip()
-
-            # Check for markdown headings (### or ##)
-            if line.startswith('###') and not line.startswith('####'):
-                # Extract heading text (remove ### and clean up)
-                heading = line.replace('###', '').strip()
-                return heading
-            elif line.startswith('##') and not line.startswith('###'):
-                # Extract heading text (remove ## and clean up)
-                heading = line.replace('##', '').strip()
-                return heading
-
-        # Fallback to generic name if no heading found
-        return "Algorithm Diagram"
-    
-    def render_d2_to_png_with_docker(self, d2_code: str) -> str:
-        """Render D2 code to PNG using Docker"""
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_path = Path(temp_dir)
-            
-            # Create D2 input file
-            d2_file = temp_path / "diagram.d2"
-            with open(d2_file, 'w', encoding='utf-8') as f:
-                f.write(d2_code)
-            
-            # Output PNG file
-            png_file = temp_path / "diagram.png"
-            
-            try:
-                # Run D2 in Docker container
-                docker_cmd = [
-                    'docker', 'run', '--rm',
-                    '-v', f"{temp_path}:/workspace",
-                    'terrastruct/d2',
-                    '--theme', '1',                # Vanilla Nitro - light theme
-                    '--pad', '0',                  # No padding (we'll add it ourselves)
-                    '--scale', '2',                # Higher resolution
-                    '/workspace/diagram.d2',
-                    '/workspace/diagram.png'
-                ]
-                
-                self.logger.debug(f"Running Docker command: {' '.join(docker_cmd)}")
-                result = subprocess.run(docker_cmd, capture_output=True, check=True, text=True)
-                
-                if result.stderr:
-                    self.logger.debug(f"D2 stderr: {result.stderr}")
-                
-                # Copy PNG to a permanent location
-                permanent_png = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-                permanent_png.close()
-                
-                with open(png_file, 'rb') as src, open(permanent_png.name, 'wb') as dst:
-                    dst.write(src.read())
-                
-                return permanent_png.name
-                
-            except subprocess.CalledProcessError as e:
-                self.logger.error(f"Error rendering D2 diagram with Docker: {e}")
-                if e.stderr:
-                    self.logger.error(f"Docker stderr: {e.stderr}")
-                raise
+        return list(scan_mdx(file_path).d2_blocks)
     
-    def add_rounded_corners_and_convert_to_avif(self, png_path: str) -> bytes:
-        """Add rounded corners to PNG and convert to AVIF format (no borders)"""
-        avif_path = png_path.replace('.png', '.avif')
-
+    def render_d2_to_png_with_docker(self, d2_code: str) -> bytes:
+        """Render D2 code to PNG bytes using the persistent Docker container"""
         try:
-            with Image.open(png_path) as img:
-                # Ensure RGBA mode for transparency handling
-                if img.mode != 'RGBA':
-                    img = img.convert('RGBA')
-
-                # Add padding
-                padding = 20
-                new_width = img.width + (padding * 2)
-                new_height = img.height + (padding * 2)
-
-                # Create new image with transparent padding
-                padded_img = Image.new('RGBA', (new_width, new_height), (255, 255, 255, 0))
-                padded_img.paste(img, (padding, padding), img)
-
-                # Create rounded rectangle mask
-                mask = Image.new('L', (new_width, new_height), 0)
-                draw = ImageDraw.Draw(mask)
-
-                # Draw rounded rectangle
-                radius = 12
-                draw.rounded_rectangle(
-                    [(0, 0), (new_width - 1, new_height - 1)],
-                    radius=radius,
-                    fill=255
-                )
-
-                # Create final image with white background
-                final_img = Image.new('RGB', (new_width, new_height), (255, 255, 255))
-                
-                # Paste the padded image using the mask
-                final_img.paste(padded_img, (0, 0), mask)
-
-                final_img.save(avif_path, 'AVIF', quality=85, speed=6)
-
-            # Read AVIF data
-            with open(avif_path, 'rb') as f:
-                avif_data = f.read()
-
-            return avif_data
-
-        finally:
-            # Clean up temporary files
-            for temp_path in [png_path, avif_path]:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
+            return self.render_container.render(d2_code)
+        except subprocess.CalledProcessError as e:
+            self.logger.error(f"Error rendering D2 diagram with Docker: {e}")
+            if e.stderr:
+                self.logger.error(f"Docker stderr: {e.stderr}")
+            raise
+    
+    def add_rounded_corners_and_convert_to_avif(self, png_data: bytes) -> AvifEncoding:
+        """Add padding and rounded corners on white to PNG bytes and convert to AVIF (no borders)"""
+        flattened = round_and_flatten(
+            png_data,
+            padding=POSTPROCESS_PARAMS['padding'],
+            radius=POSTPROCESS_PARAMS['radius']
+        )
+        return encode_avif(
+            flattened,
+            quality=POSTPROCESS_PARAMS['quality'],
+            speed=POSTPROCESS_PARAMS['speed'],
+            target_ssim=self.target_ssim
+        )
 
-    def generate_filename(self, d2_code: str, index: int) -> str:
-        """Generate a unique filename for the diagram"""
-        # Create a hash of the d2 code for uniqueness
-        code_hash = hashlib.md5(d2_code.encode()).hexdigest()[:8]
+    def generate_filename(self, d2_code: str, index: int, avif_data: bytes) -> str:
+        """Generate a content-addressed filename for the rendered diagram"""
+        # Hash the rendered bytes, not the source, so a re-render with new settings gets a new key
+        code_hash = content_hash(avif_data)
 
         # Try to extract a meaningful name from the first few lines
         lines = d2_code.strip().split('\n')
@@ -307,26 +323,22 @@ class DockerD2ToR2Migrator:
 
         return f"{diagram_name}-{index + 1}-{code_hash}.avif"
 
-    def upload_to_r2(self, avif_data: bytes, blog_folder: str, filename: str) -> str:
-        """Upload AVIF to R2 and return the public URL"""
+    def submit_upload_to_r2(self, avif_data: bytes, blog_folder: str, filename: str) -> Future:
+        """Queue an AVIF upload to R2; the Future resolves to the public URL"""
         if self.dry_run:
             self.logger.info(f"[DRY RUN] Would upload {filename} to R2")
-            return f"https://example.com/blogs/{blog_folder}/{filename}"
+            future = Future()
+            future.set_result(f"https://example.com/blogs/{blog_folder}/{filename}")
+            return future
 
         key = f"blogs/{blog_folder}/{filename}"
+        return self.uploader.submit(key, avif_data, 'image/avif')
 
+    def upload_to_r2(self, avif_data: bytes, blog_folder: str, filename: str) -> str:
+        """Upload AVIF to R2 and return the public URL"""
+        from botocore.exceptions import ClientError
         try:
-            self.r2_client.put_object(
-                Bucket=self.bucket_name,
-                Key=key,
-                Body=avif_data,
-                ContentType='image/avif',
-                CacheControl='public, max-age=31536000'  # Cache for 1 year
-            )
-
-            # Return the public URL
-            return f"{self.r2_public_url}/{key}"
-
+            return self.submit_upload_to_r2(avif_data, blog_folder, filename).result()
         except ClientError as e:
             self.logger.error(f"Error uploading to R2: {e}")
             raise
@@ -362,10 +374,16 @@ class DockerD2ToR2Migrator:
             self.logger.warning(f"  No index.mdx found in {blog_path}")
             return 0
 
+        # Skip files that have not changed since they were fully migrated
+        if self.state.is_unchanged(self.STATE_NAME, mdx_file):
+            self.logger.info("  Unchanged since last migration")
+            return 0
+
         # Find D2 blocks with headings
         d2_blocks = self.find_d2_blocks_with_headings(mdx_file)
         if not d2_blocks:
             self.logger.info(f"  No D2 diagrams found")
+            self._record_state(mdx_file, [])
             return 0
 
         self.logger.info(f"  Found {len(d2_blocks)} D2 diagrams")
@@ -373,42 +391,86 @@ class DockerD2ToR2Migrator:
         # Use blog folder name for R2 organization
         blog_folder = blog_path.name
         replacements = []
+        outcomes = []
+        uploads = []
 
         for index, (d2_code, start_line, end_line, heading) in enumerate(d2_blocks):
+            # Assets of other shards are left for their runners
+            if not self.shard.owns(blog_folder, d2_code):
+                continue
+
             try:
                 self.logger.info(f"    Processing diagram {index + 1}/{len(d2_blocks)}")
 
-                # Render D2 to PNG using Docker
-                png_path = self.render_d2_to_png_with_docker(d2_code)
-
-                # Add rounded corners and convert PNG to AVIF (no borders)
-                avif_data = self.add_rounded_corners_and_convert_to_avif(png_path)
+                cache_key = RenderCache.make_key(
+                    d2_code, 'docker-d2', self.d2_image_id, D2_RENDER_FLAGS, self.postprocess_params
+                )
+                avif_data = self.render_cache.get(cache_key)
+                metrics = self.render_cache.get_meta(cache_key)
+
+                if avif_data is None:
+                    with tracer.context(asset=f"diagram-{index + 1}"):
+                        # Render D2 to PNG using Docker
+                        with tracer.span('render') as span:
+                            png_data = self.render_d2_to_png_with_docker(d2_code)
+                            span.bytes_out = len(png_data)
+
+                        # Add rounded corners and convert PNG to AVIF (no borders)
+                        encoding = self.add_rounded_corners_and_convert_to_avif(png_data)
+                    avif_data, metrics = encoding.data, encoding.metrics()
+                    self.render_cache.put(cache_key, avif_data, metrics)
+                else:
+                    self.logger.info("    Using cached render")
 
                 # Generate filename
-                filename = self.generate_filename(d2_code, index)
+                filename = self.generate_filename(d2_code, index, avif_data)
                 self.logger.info(f"    Generated filename: {filename}")
 
-                # Upload to R2
-                r2_url = self.upload_to_r2(avif_data, blog_folder, filename)
-                replacements.append((start_line, end_line, r2_url, heading))
-
-                self.logger.info(f"    ✓ Migrated to: {r2_url}")
+                # Upload to R2 in the background while the next diagram renders
+                upload = self.submit_upload_to_r2(avif_data, blog_folder, filename)
+                uploads.append((index, start_line, end_line, heading, upload, metrics))
 
             except Exception as e:
                 self.logger.error(f"    ✗ Failed to migrate diagram {index + 1}: {e}")
+                outcomes.append((f"diagram-{index + 1}", FAILED, str(e)))
                 if self.verbose:
                     import traceback
                     self.logger.debug(traceback.format_exc())
                 continue
 
+        # Only rewrite the file once every upload of the post has been confirmed
+        for index, start_line, end_line, heading, upload, metrics in uploads:
+            try:
+                r2_url = upload.result()
+                replacements.append((start_line, end_line, r2_url, heading))
+                outcomes.append((f"diagram-{index + 1}", MIGRATED, r2_url, metrics))
+                self.logger.info(f"    ✓ Migrated to: {r2_url}")
+            except Exception as e:
+                self.logger.error(f"    ✗ Failed to migrate diagram {index + 1}: {e}")
+                outcomes.append((f"diagram-{index + 1}", FAILED, str(e)))
+
         # Replace D2 blocks in the file
         if replacements:
-            self.replace_d2_blocks_in_file(mdx_file, replacements)
+            with tracer.span('rewrite', asset=str(mdx_file)):
+                self.replace_d2_blocks_in_file(mdx_file, replacements)
             self.logger.info(f"  ✓ Updated {len(replacements)} diagrams in {mdx_file}")
 
+        self._record_state(mdx_file, outcomes)
         return len(replacements)
 
-    def migrate_all_posts(self, specific_blog: Optional[str] = None):
+    def _record_state(self, mdx_file: Path, outcomes: List[Tuple[str, str, str]]):
+        """Record migration outcomes unless this is a dry run"""
+        if not self.dry_run:
+            self.state.record(self.STATE_NAME, mdx_file, outcomes)
+
+    def close(self):
+        """Tear down the render container and wait for pending uploads"""
+        self.render_container.stop()
+        if self.uploader:
+            self.uploader.close()
+
+    def migrate_all_posts(self, specific_blog: Optional[str] = None,
+                          blog_posts: Optional[List[Path]] = None):
         """Migrate D2 diagrams in all blog posts or a specific one"""
         if not self.blog_content_dir.exists():
             self.logger.error(f"Blog content directory not found: {self.blog_content_dir}")
@@ -423,7 +485,7 @@ class DockerD2ToR2Migrator:
                 self.logger.error(f"Blog post not found: {blog_path}")
                 return
             blog_posts = [blog_path]
-        else:
+        elif blog_posts is None:
             # Process all blog posts
             blog_posts = [d for d in self.blog_content_dir.iterdir() if d.is_dir()]
 
@@ -432,7 +494,8 @@ class DockerD2ToR2Migrator:
 
         for blog_path in blog_posts:
             try:
-                migrated_count = self.process_blog_post(blog_path)
+                with tracer.context(post=blog_path.name), self.shard.recording(blog_path / "index.mdx"):
+                    migrated_count = self.process_blog_post(blog_path)
                 total_migrated += migrated_count
             except Exception as e:
                 self.logger.error(f"Error processing {blog_path}: {e}")
@@ -445,6 +508,9 @@ class DockerD2ToR2Migrator:
 
         self.logger.info("-" * 50)
         self.logger.info(f"Migration complete! Total diagrams migrated: {total_migrated}")
+        self.logger.info(self.render_cache.summary())
+        if self.uploader:
+            self.logger.info(self.uploader.summary())
 
 def main():
     """Main function"""
@@ -464,14 +530,71 @@ def main():
         help='Enable verbose logging'
     )
 
+    parser.add_argument(
+        'files',
+        nargs='*',
+        metavar='MDX_FILE',
+        help='Only migrate the posts of these index.mdx files, e.g. the staged ones (default: all posts)'
+    )
+
+    parser.add_argument(
+        '--stage',
+        action='store_true',
+        help='git add the MDX files this run rewrote'
+    )
+
+    parser.add_argument(
+        '--shard',
+        type=Shard.parse,
+        metavar='I/N',
+        help='Only migrate shard I of N (0-based) and record the MDX rewrites in a manifest '
+             'for merge_shards.py instead of applying them'
+    )
+
+    parser.add_argument(
+        '--shard-manifest',
+        metavar='PATH',
+        help=f'Where to write the shard manifest (default: {DEFAULT_MANIFEST_DIR}/<migrator>-<i>-of-<n>.json)'
+    )
+
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='After migrating, keep running and migrate the new assets of every saved index.mdx'
+    )
+
+    parser.add_argument(
+        '--trace',
+        metavar='PATH',
+        help='Record per-stage spans and write them to PATH as Chrome trace JSON, '
+             'plus a p50/p95/max summary (default: MIGRATION_TRACE)'
+    )
+
     args = parser.parse_args()
+    tracer.start(args.trace)
 
     try:
-        migrator = DockerD2ToR2Migrator(verbose=args.verbose, dry_run=args.dry_run)
-        migrator.migrate_all_posts(specific_blog=args.blog_post)
+        migrator = DockerD2ToR2Migrator(verbose=args.verbose, dry_run=args.dry_run, shard=args.shard)
+        blog_posts = select_posts(migrator.blog_content_dir, args.files)
+        if args.blog_post:
+            blog_posts = [migrator.blog_content_dir / args.blog_post]
+        before = file_signatures(blog_posts)
+        migrator.migrate_all_posts(specific_blog=args.blog_post, blog_posts=blog_posts)
+        if args.stage:
+            stage_rewritten(before)
+        if migrator.shard.active:
+            manifest = migrator.shard.write_manifest(migrator.STATE_NAME, args.shard_manifest)
+            migrator.logger.info(f"Shard {migrator.shard} manifest: {manifest}")
+        if args.watch:
+            watch_posts([migrator])
+        migrator.close()
     except Exception as e:
         print(f"Error: {e}")
         return 1
+    finally:
+        trace_summary = tracer.finish()
+        if trace_summary:
+            print(trace_summary)
 
     return 0
 
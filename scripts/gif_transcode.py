@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Animated GIF transcoding for the image and Giphy migration scripts.
+
+GIFs are the heaviest assets on the blog. With transcoding enabled, every GIF
+is additionally converted to:
+
+- an animated WebP or AVIF (Pillow, frame timing and looping preserved)
+- a muted, looping H.264 MP4 (ffmpeg, only if it is installed)
+
+The markdown reference is then rewritten into a `<video>` embed, or a
+`<picture>` with the animated image when there is no MP4, that keeps the
+original GIF as fallback, so browsers download a file that is typically a
+fraction of the GIF's size. Browsers that play `<video>` never render its
+fallback content, so the animated image is only made when there is no MP4.
+A rendition that does not come out smaller than the GIF is dropped.
+"""
+
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+from typing import NamedTuple, Optional, Tuple
+
+from lazy_import import lazy_import
+from tracing import tracer
+
+Image = lazy_import('PIL.Image')
+
+# Pillow format name, content type and encoder options per animated image format
+ANIMATED_FORMATS = {
+    # allow_mixed picks lossy or lossless per frame, which keeps flat, palette-style GIFs small
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4, 'allow_mixed': True}),
+    'avif': ('AVIF', 'image/avif', {'quality': 60, 'speed': 6}),
+}
+
+DEFAULT_ANIMATED_FORMAT = 'webp'
+
+# H.264 settings: even dimensions and yuv420p for universal playback, no audio track
+FFMPEG_ARGS = [
+    '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+    '-c:v', 'libx264', '-preset', 'slow', '-crf', '28',
+    '-pix_fmt', 'yuv420p', '-movflags', '+faststart', '-an',
+]
+
+
+class GifRenditions(NamedTuple):
+    # Extension (e.g. 'webp') and bytes of the animated image rendition
+    image_ext: str
+    # None when there is an MP4 or when it would not be smaller than the GIF
+    image: Optional[bytes]
+    # None without ffmpeg, for single-frame GIFs or when not smaller than the GIF
+    mp4: Optional[bytes]
+    size: Tuple[int, int]
+    animated: bool
+
+    @property
+    def any(self) -> bool:
+        return self.image is not None or self.mp4 is not None
+
+    def metrics(self, gif_bytes: int) -> dict:
+        """Rendition sizes in the form stored with each migrated asset"""
+        return {
+            'gif_bytes': gif_bytes,
+            f'{self.image_ext}_bytes': len(self.image) if self.image is not None else None,
+            'mp4_bytes': len(self.mp4) if self.mp4 is not None else None,
+        }
+
+
+def encode_mp4(gif_data: bytes) -> Optional[bytes]:
+    """Transcode a GIF into a muted looping-friendly MP4, or None without ffmpeg"""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        return None
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = os.path.join(temp_dir, 'out.mp4')
+        subprocess.run(
+            [ffmpeg, '-hide_banner', '-loglevel', 'error', '-f', 'gif', '-i', 'pipe:0', *FFMPEG_ARGS, output_path],
+            input=gif_data,
+            capture_output=True,
+            check=True
+        )
+        with open(output_path, 'rb') as f:
+            return f.read()
+
+
+def transcode_gif(gif_data: bytes, image_format: str = DEFAULT_ANIMATED_FORMAT) -> GifRenditions:
+    """Convert GIF bytes into an MP4 for animations, or an animated image when there is no MP4.
+
+    Lives at module level so it can run in ProcessPoolExecutor workers.
+    """
+    pil_format, _, options = ANIMATED_FORMATS[image_format]
+
+    with Image.open(io.BytesIO(gif_data)) as img:
+        animated = getattr(img, 'is_animated', False)
+        size = img.size
+
+    # Only keep renditions that actually save bytes
+    mp4 = None
+    if animated:
+        with tracer.span('transcode-mp4', bytes_in=len(gif_data)) as span:
+            mp4 = encode_mp4(gif_data)
+            span.bytes_out = len(mp4) if mp4 is not None else None
+        if mp4 is not None and len(mp4) >= len(gif_data):
+            mp4 = None
+
+    # The <video> embed only ever falls back to the GIF, so an MP4 makes the animated image useless
+    image = None
+    if mp4 is None:
+        with tracer.span('transcode', bytes_in=len(gif_data)) as span:
+            with Image.open(io.BytesIO(gif_data)) as img:
+                output = io.BytesIO()
+                img.save(output, pil_format, save_all=animated, **options)
+            image = output.getvalue()
+            span.bytes_out = len(image)
+        if len(image) >= len(gif_data):
+            image = None
+    return GifRenditions(image_format, image, mp4, size, animated)
+
+
+def content_type_for(image_ext: str) -> str:
+    return ANIMATED_FORMATS[image_ext][1]
+
+
+def build_gif_embed(alt_text: str, gif_url: str, image_url: Optional[str], image_ext: str,
+                    mp4_url: Optional[str], size: Tuple[int, int]) -> str:
+    """Build a <video> (or, without an MP4, <picture>) element that falls back to the original GIF"""
+    alt = alt_text.replace('"', '&quot;')
+    dimensions = f'width="{size[0]}" height="{size[1]}"'
+    img = f'<img src="{gif_url}" alt="{alt}" {dimensions} loading="lazy" decoding="async" />'
+    if mp4_url is not None:
+        # Only browsers without <video> support render its content, so the GIF is all it needs
+        return (
+            f'<video autoplay loop muted playsinline {dimensions} aria-label="{alt}">'
+            f'<source src="{mp4_url}" type="video/mp4" />{img}</video>'
+        )
+
+    if image_url is None:
+        return img
+    return f'<picture><source srcset="{image_url}" type="{content_type_for(image_ext)}" />{img}</picture>'
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+On-disk HTTP cache for remote image and GIF downloads.
+
+Every remote asset the migrators fetch is stored under a hash of its URL as
+`<cache-dir>/<key[:2]>/<key>.body`, with the response's validators (ETag,
+Last-Modified) and freshness lifetime in a `<key>.json` sidecar.
+
+- A fresh entry (Cache-Control max-age / Expires, or 10% of the time since
+  Last-Modified, capped at a day) is served without touching the network
+- A stale entry is revalidated with If-None-Match / If-Modified-Since; a 304
+  serves the stored body and refreshes its lifetime
+- Responses marked no-store are never stored
+
+Every hit refreshes the entry's mtime, and when the cache grows past its size
+budget the least recently used entries are evicted first.
+
+Environment variables (optional):
+- HTTP_CACHE_DIR (default: .cache/http)
+- HTTP_CACHE_MAX_MB (default: 1024)
+- HTTP_CACHE_DISABLE (set to 1 to always download in full)
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Mapping, Optional
+
+from spooled_body import READ_CHUNK_SIZE, SpooledBody
+
+DEFAULT_CACHE_DIR = ".cache/http"
+DEFAULT_MAX_MB = 1024
+
+# Heuristic lifetime for responses with Last-Modified but no explicit freshness (RFC 9111 4.2.2)
+HEURISTIC_FRACTION = 0.1
+MAX_HEURISTIC_SECONDS = 24 * 60 * 60
+
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    from email.utils import parsedate_to_datetime
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(headers: Mapping[str, str], now: float) -> Optional[float]:
+    """Seconds a response stays fresh; None when it must not be stored at all"""
+    cache_control = headers.get('Cache-Control', '').lower()
+    if 'no-store' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return 0.0
+
+    age = headers.get('Age', '')
+    age = int(age) if age.isdigit() else 0
+    max_age = re.search(r'(?:^|[,\s])max-age=(\d+)', cache_control)
+    if max_age:
+        return max(0.0, int(max_age.group(1)) - age)
+
+    date = _http_date(headers.get('Date')) or now
+    expires = _http_date(headers.get('Expires'))
+    if expires is not None:
+        return max(0.0, expires - date)
+
+    last_modified = _http_date(headers.get('Last-Modified'))
+    if last_modified is not None:
+        return min(max(0.0, date - last_modified) * HEURISTIC_FRACTION, MAX_HEURISTIC_SECONDS)
+
+    return 0.0
+
+
+class CacheEntry:
+    def __init__(self, key: str, body_path: Path, meta: dict):
+        self.key = key
+        self.body_path = body_path
+        self.meta = meta
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.time() < self.meta.get('fresh_until', 0)
+
+    def validators(self) -> Dict[str, str]:
+        """Conditional request headers that revalidate this entry"""
+        headers = {}
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('last_modified'):
+            headers['If-Modified-Since'] = self.meta['last_modified']
+        return headers
+
+
+class _EntryWriter:
+    """Tees a response body into a cache entry, committed only once it was read in full"""
+
+    def __init__(self, cache: 'HttpCache', url: str, headers: Mapping[str, str], lifetime: float):
+        self.cache = cache
+        self.url = url
+        self.headers = headers
+        self.lifetime = lifetime
+        self.key = cache.make_key(url)
+        self.size = 0
+
+        body_path = cache._body_path(self.key)
+        body_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, self._temp_path = tempfile.mkstemp(dir=body_path.parent, suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+
+    def tee(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        for chunk in chunks:
+            self._file.write(chunk)
+            self.size += len(chunk)
+            yield chunk
+
+    def __enter__(self) -> '_EntryWriter':
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self._file.close()
+        if exc_type is not None:
+            os.unlink(self._temp_path)
+            return
+        self.cache._commit(self)
+
+
+class HttpCache:
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.cache_dir = Path(cache_dir or os.getenv("HTTP_CACHE_DIR", DEFAULT_CACHE_DIR))
+        if max_bytes is None:
+            max_bytes = int(os.getenv("HTTP_CACHE_MAX_MB", DEFAULT_MAX_MB)) * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.enabled = os.getenv("HTTP_CACHE_DISABLE", "0") != "1"
+
+        # Downloads run on several threads; the running total and counters are shared
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.bytes_from_cache = 0
+        self.bytes_downloaded = 0
+
+    @staticmethod
+    def make_key(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _body_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.body"
+
+    def _meta_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        """The stored entry for a URL, fresh or stale, or None"""
+        if not self.enabled:
+            return None
+        key = self.make_key(url)
+        try:
+            with open(self._meta_path(key), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        body_path = self._body_path(key)
+        if meta.get('url') != url or not body_path.exists():
+            return None
+        return CacheEntry(key, body_path, meta)
+
+    def open_body(self, entry: CacheEntry, max_bytes: Optional[int] = None) -> Optional[SpooledBody]:
+        """Spool a stored body and count it as served from the cache; None if it was evicted meanwhile"""
+        try:
+            with open(entry.body_path, 'rb') as f:
+                body = SpooledBody.from_chunks(iter(lambda: f.read(READ_CHUNK_SIZE), b''), max_bytes=max_bytes)
+        except FileNotFoundError:
+            return None
+
+        # Refresh mtime so LRU eviction keeps recently used entries
+        try:
+            os.utime(entry.body_path)
+        except OSError:
+            pass
+
+        with self._lock:
+            self.bytes_from_cache += body.size
+        return body
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def record_revalidated(self, entry: CacheEntry, headers: Mapping[str, str]):
+        """Extend a stale entry's lifetime after a 304, taking any updated validators"""
+        now = time.time()
+        lifetime = freshness_lifetime(headers, now)
+        entry.meta['fresh_until'] = now + (lifetime or 0.0)
+        if headers.get('ETag'):
+            entry.meta['etag'] = headers['ETag']
+        if headers.get('Last-Modified'):
+            entry.meta['last_modified'] = headers['Last-Modified']
+        self._write_meta(entry.key, entry.meta)
+
+        with self._lock:
+            self.revalidated += 1
+
+    def writer(self, url: str, headers: Mapping[str, str]) -> Optional[_EntryWriter]:
+        """A writer that stores a 200 response while it streams, or None if it must not be stored"""
+        with self._lock:
+            self.misses += 1
+        if not self.enabled:
+            return None
+        lifetime = freshness_lifetime(headers, time.time())
+        if lifetime is None or not (headers.get('ETag') or headers.get('Last-Modified') or lifetime):
+            # Neither fresh nor revalidatable; storing it would never save a byte
+            return None
+        return _EntryWriter(self, url, headers, lifetime)
+
+    def record_download(self, size: int):
+        with self._lock:
+            self.bytes_downloaded += size
+
+    def _write_meta(self, key: str, meta: dict):
+        meta_path = self._meta_path(key)
+        fd, temp_path = tempfile.mkstemp(dir=meta_path.parent, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, meta_path)
+
+    def _commit(self, writer: _EntryWriter):
+        body_path = self._body_path(writer.key)
+        previous_size = body_path.stat().st_size if body_path.exists() else 0
+
+        # Write atomically so a crashed run never leaves a truncated entry
+        os.replace(writer._temp_path, body_path)
+        self._write_meta(writer.key, {
+            'url': writer.url,
+            'etag': writer.headers.get('ETag'),
+            'last_modified': writer.headers.get('Last-Modified'),
+            'fresh_until': time.time() + writer.lifetime,
+            'size': writer.size,
+        })
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_total_bytes()
+            else:
+                self._total_bytes += writer.size - previous_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _iter_entries(self):
+        if not self.cache_dir.exists():
+            return
+        for shard in self.cache_dir.iterdir():
+            if shard.is_dir():
+                yield from shard.glob('*.body')
+
+    def _scan_total_bytes(self) -> int:
+        return sum(entry.stat().st_size for entry in self._iter_entries())
+
+    def _evict(self):
+        """Delete least recently used entries until the cache fits its budget"""
+        entries = []
+        for entry in self._iter_entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+                total -= size
+            except FileNotFoundError:
+                pass
+            entry.with_suffix('.json').unlink(missing_ok=True)
+
+        self._total_bytes = total
+
+    def summary(self) -> str:
+        """Human readable hit/miss summary for end-of-run output"""
+        if not self.enabled:
+            return "HTTP cache disabled"
+        return (
+            f"HTTP cache: {self.hits} fresh hits, {self.revalidated} revalidated (304), {self.misses} downloads; "
+            f"{self.bytes_from_cache} bytes served from cache, {self.bytes_downloaded} bytes downloaded "
+            f"({self.cache_dir})"
+        )
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Shared HTTP fetch layer for the migration scripts.
+
+A single pooled `requests.Session` keeps keep-alive connections open per host,
+so consecutive downloads from the same CDN reuse one TCP/TLS handshake.
+Downloads run on a thread pool whose size bounds the global concurrency, and
+a per-host `AdaptiveLimiter` (see adaptive_limit.py) caps the requests in
+flight to each origin: it starts at `per_host`, grows while the host answers
+promptly and backs off (retrying with jitter) when it throttles. Fetching all remote references of a post in parallel makes its
+wall-clock time approach that of the slowest single download.
+
+Bodies are streamed chunk by chunk into a `SpooledBody`, which enforces a
+maximum size and hashes the bytes while they arrive, so pass-through assets
+such as GIFs can go to R2 without ever being held in memory in full.
+
+Responses go through an on-disk `HttpCache` (see http_cache.py): fresh
+entries are served without a request, stale ones are revalidated with a
+conditional GET, so a repeat run only downloads what changed at the origin.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Union
+from urllib.parse import urlparse
+
+from adaptive_limit import AdaptiveLimiter
+from http_cache import CacheEntry, HttpCache
+from lazy_import import lazy_import
+from spooled_body import READ_CHUNK_SIZE, BodyTooLargeError, SpooledBody
+from tracing import tracer
+
+requests = lazy_import('requests')
+
+DEFAULT_MAX_CONNECTIONS = 16
+DEFAULT_PER_HOST = 6
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_DOWNLOAD_BYTES = 100 * 1024 * 1024
+
+
+class HttpFetcher:
+    def __init__(self, max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 per_host: int = DEFAULT_PER_HOST, timeout: int = DEFAULT_TIMEOUT,
+                 headers: Optional[Dict[str, str]] = None,
+                 max_download_bytes: int = DEFAULT_MAX_DOWNLOAD_BYTES,
+                 cache: Optional[HttpCache] = None):
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_download_bytes = max_download_bytes
+        self.cache = cache if cache is not None else HttpCache()
+
+        # The session (and requests itself) is set up on the first request, not by runs that download nothing
+        self.headers = headers
+        self._session: Optional[requests.Session] = None
+        self._session_lock = threading.Lock()
+
+        self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='fetch')
+        self._host_limits: Dict[str, AdaptiveLimiter] = {}
+        self._host_limits_lock = threading.Lock()
+
+    @property
+    def session(self) -> 'requests.Session':
+        with self._session_lock:
+            if self._session is None:
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                if self.headers:
+                    session.headers.update(self.headers)
+
+                # One connection pool per host, each large enough for the highest per-host limit
+                adapter = HTTPAdapter(pool_connections=self.max_connections, pool_maxsize=self.max_connections)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def _host_limit(self, url: str) -> AdaptiveLimiter:
+        host = urlparse(url).netloc.lower()
+        with self._host_limits_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = AdaptiveLimiter(host, self.per_host, self.max_connections)
+            return self._host_limits[host]
+
+    def fetch_stream(self, url: str) -> SpooledBody:
+        """Stream a URL into a SpooledBody on the calling thread, respecting the per-host limit"""
+        entry = self.cache.lookup(url)
+        if entry is not None and entry.is_fresh:
+            with tracer.span('http-cache', asset=url) as span:
+                body = self.cache.open_body(entry, self.max_download_bytes)
+                if body is not None:
+                    self.cache.record_hit()
+                    span.bytes_out = body.size
+                    return body
+            entry = None
+
+        return self._host_limit(url).run(lambda: self._request(url, entry))
+
+    def _request(self, url: str, entry: Optional[CacheEntry]) -> SpooledBody:
+        """One GET (conditional if a stale entry exists); throttling surfaces as an HTTPError"""
+        with tracer.span('download', asset=url) as span:
+            headers = entry.validators() if entry is not None else {}
+            with self.session.get(url, timeout=self.timeout, stream=True, headers=headers) as response:
+                if response.status_code == 304 and entry is not None:
+                    body = self.cache.open_body(entry, self.max_download_bytes)
+                    if body is not None:
+                        self.cache.record_revalidated(entry, response.headers)
+                        span.bytes_out = body.size
+                        return body
+                    # Evicted since the lookup; fetch it in full instead
+                    return self._download(url, span)
+                return self._read_response(url, response, span)
+
+    def _download(self, url: str, span) -> SpooledBody:
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            return self._read_response(url, response, span)
+
+    def _read_response(self, url: str, response: 'requests.Response', span) -> SpooledBody:
+        """Spool a 200 response, storing it in the cache as it streams"""
+        response.raise_for_status()
+
+        declared = response.headers.get('Content-Length')
+        if declared and declared.isdigit() and int(declared) > self.max_download_bytes:
+            raise BodyTooLargeError(
+                f"{url} is {declared} bytes, over the {self.max_download_bytes} byte limit"
+            )
+
+        chunks = response.iter_content(chunk_size=READ_CHUNK_SIZE)
+        writer = self.cache.writer(url, response.headers)
+        if writer is None:
+            body = SpooledBody.from_chunks(chunks, max_bytes=self.max_download_bytes)
+        else:
+            with writer:
+                body = SpooledBody.from_chunks(writer.tee(chunks), max_bytes=self.max_download_bytes)
+        self.cache.record_download(body.size)
+        span.bytes_out = body.size
+        return body
+
+    def fetch(self, url: str) -> bytes:
+        """Download a URL into memory on the calling thread"""
+        body = self.fetch_stream(url)
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def submit(self, url: str) -> Future:
+        """Start downloading a URL into memory in the background"""
+        return self._executor.submit(tracer.bind(self.fetch), url)
+
+    def submit_stream(self, url: str) -> Future:
+        """Start streaming a URL into a SpooledBody in the background"""
+        return self._executor.submit(tracer.bind(self.fetch_stream), url)
+
+    def fetch_all(self, urls: Iterable[str]) -> Dict[str, Union[bytes, Exception]]:
+        """Download several URLs in parallel; failures are returned as exceptions"""
+        futures = {url: self.submit(url) for url in dict.fromkeys(urls)}
+
+        results: Dict[str, Union[bytes, Exception]] = {}
+        for url, future in futures.items():
+            try:
+                results[url] = future.result()
+            except Exception as e:
+                results[url] = e
+        return results
+
+    def summary(self) -> str:
+        """Cache statistics plus any host that throttled us, for end-of-run output"""
+        lines = [self.cache.summary()]
+        lines.extend(line for line in (limit.summary() for limit in self._host_limits.values()) if line)
+        return "\n".join(lines)
+
+    def close(self):
+        """Stop the worker threads and close pooled connections"""
+        self._executor.shutdown(wait=True)
+        if self._session is not None:
+            self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Deferred imports of the migration scripts' heavy dependencies.
+
+boto3, requests, Pillow and NumPy together take several hundred milliseconds
+to import, yet `--help`, a dry run or a run over an unchanged corpus never
+touches them. `lazy_import` returns a module whose code only runs on its
+first attribute access (`importlib.util.LazyLoader`), so these scripts keep
+their module-level `Image.open(...)` / `np.asarray(...)` style and only pay
+for a dependency once it is actually used.
+
+Annotations that name a lazy module's types (`'Image.Image'`) are quoted so
+defining a function does not load the module. python-dotenv is only imported
+when there is a `.env` file to load.
+"""
+
+import sys
+import importlib.util
+from pathlib import Path
+from types import ModuleType
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Module `name`, loaded on first attribute access; already imported modules are returned as is"""
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load_dotenv():
+    """dotenv.load_dotenv(), importing python-dotenv only when there is a .env file to read
+
+    Searches this directory and its parents, as dotenv does from the calling script.
+    """
+    here = Path(__file__).resolve().parent
+    for directory in (here, *here.parents):
+        env_file = directory / '.env'
+        if env_file.is_file():
+            from dotenv import load_dotenv as load
+            load(env_file)
+            return
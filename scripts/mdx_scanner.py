@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Single-pass MDX asset scanner shared by all migration scripts.
+
+Each file is read once and tokenized in one linear pass over its lines:
+
+- ```mermaid and ```d2 fences become diagram blocks with their line span and
+  the most recent `##`/`###` heading before them
+- every other fenced code block is skipped, so image links or Giphy URLs shown
+  as code samples are never migrated
+- the remaining prose is searched for markdown images, HTML <img> tags and
+  Giphy links
+
+Results are memoized per (path, mtime, size), so every migrator running in
+the same process reuses one scan until the file is rewritten.
+"""
+
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Tuple
+
+from tracing import tracer
+
+# Markdown image syntax ![alt](src)
+MARKDOWN_IMAGE_PATTERN = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
+
+# HTML img tags <img src="..." alt="..." />
+HTML_IMAGE_PATTERN = re.compile(
+    r'<img[^>]+src=["\']([^"\']+)["\'][^>]*(?:alt=["\']([^"\']*)["\'][^>]*)?/?>',
+    re.IGNORECASE
+)
+
+# Giphy media hosts (media.giphy.com, media0-4.giphy.com, i.giphy.com)
+GIPHY_URL = r'https://(?:media[0-9]*|i)\.giphy\.com/'
+
+# Giphy links in markdown image format
+GIPHY_PATTERN = re.compile(r'!\[([^\]]*)\]\((' + GIPHY_URL + r'[^)]+)\)')
+
+# Fence languages that are turned into diagram blocks
+DIAGRAM_LANGUAGES = ('mermaid', 'd2')
+
+DEFAULT_HEADING = "Algorithm Diagram"
+
+
+class ImageRef(NamedTuple):
+    full_match: str
+    alt_text: str
+    src: str
+
+
+class GiphyLink(NamedTuple):
+    alt_text: str
+    url: str
+
+
+class DiagramBlock(NamedTuple):
+    code: str
+    start_line: int
+    end_line: int
+    heading: str
+
+
+class MdxScan(NamedTuple):
+    image_refs: List[ImageRef]
+    giphy_links: List[GiphyLink]
+    mermaid_blocks: List[DiagramBlock]
+    d2_blocks: List[DiagramBlock]
+
+
+_scan_cache: Dict[str, Tuple[Tuple[int, int], MdxScan]] = {}
+
+
+def _heading_text(line: str) -> str:
+    """Return the text of a `##` or `###` heading, or '' for any other line"""
+    if line.startswith('###') and not line.startswith('####'):
+        return line.replace('###', '').strip()
+    if line.startswith('##') and not line.startswith('###'):
+        return line.replace('##', '').strip()
+    return ''
+
+
+def _fence_marker(line: str) -> str:
+    """Return the fence characters (``` or ~~~...) that open a code block, or ''"""
+    match = re.match(r'(`{3,}|~{3,})', line)
+    return match.group(1) if match else ''
+
+
+def is_giphy_link(ref: ImageRef) -> bool:
+    """True for the markdown Giphy links migrate_giphy_to_r2.py migrates (not <img> tags on Giphy hosts)"""
+    return GIPHY_PATTERN.fullmatch(ref.full_match) is not None
+
+
+def scan_content(content: str) -> MdxScan:
+    """Tokenize MDX content in one linear pass"""
+    lines = content.split('\n')
+    diagrams: Dict[str, List[DiagramBlock]] = {lang: [] for lang in DIAGRAM_LANGUAGES}
+    prose_segments: List[str] = []
+    prose: List[str] = []
+    heading = DEFAULT_HEADING
+
+    i = 0
+    while i < len(lines):
+        stripped = lines[i].strip()
+        marker = _fence_marker(stripped)
+
+        if not marker:
+            prose.append(lines[i])
+            heading = _heading_text(stripped) or heading
+            i += 1
+            continue
+
+        # Close the current prose segment at every fence
+        prose_segments.append('\n'.join(prose))
+        prose = []
+
+        language = stripped[len(marker):].strip()
+        start_line = i
+        i += 1
+
+        if marker == '```' and language in DIAGRAM_LANGUAGES:
+            code = []
+            while i < len(lines) and lines[i].strip() != '```':
+                code.append(lines[i])
+                i += 1
+            if i < len(lines):  # Found closing ```
+                diagrams[language].append(DiagramBlock('\n'.join(code), start_line, i, heading))
+        else:
+            # Unrelated code block: skip to its closing fence
+            while i < len(lines):
+                closing = lines[i].strip()
+                if closing.startswith(marker) and not closing.lstrip(marker[0]):
+                    break
+                i += 1
+        i += 1
+
+    prose_segments.append('\n'.join(prose))
+
+    image_refs = []
+    giphy_links = []
+    for segment in prose_segments:
+        for match in MARKDOWN_IMAGE_PATTERN.finditer(segment):
+            image_refs.append(ImageRef(match.group(0), match.group(1), match.group(2)))
+        for match in HTML_IMAGE_PATTERN.finditer(segment):
+            image_refs.append(ImageRef(match.group(0), match.group(2) or "", match.group(1)))
+        for match in GIPHY_PATTERN.finditer(segment):
+            giphy_links.append(GiphyLink(match.group(1), match.group(2)))
+
+    return MdxScan(image_refs, giphy_links, diagrams['mermaid'], diagrams['d2'])
+
+
+def scan_mdx(file_path: Path) -> MdxScan:
+    """Scan an MDX file, reusing the previous result while the file is unchanged"""
+    key = os.path.abspath(file_path)
+    stat = os.stat(key)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _scan_cache.get(key)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    with tracer.span('scan', asset=str(file_path), bytes_in=stat.st_size):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            result = scan_content(f.read())
+
+    _scan_cache[key] = (signature, result)
+    return result
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Apply the MDX rewrites of a sharded migration run.
+
+Each `--shard i/n` run of a migrator writes a manifest of character-range
+edits against the checked-out MDX files (see sharding.py). Run this once,
+on the same commit the shards ran on, after collecting every manifest:
+edits for the same file from all shards and migrators are applied together.
+A file that changed since the shards ran, or whose edits overlap, is left
+untouched and reported.
+
+Usage:
+    python merge_shards.py [--dry-run] [MANIFEST ...]   # default: .cache/shards/*.json
+"""
+
+import json
+import argparse
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+from migration_state import hash_file
+from sharding import DEFAULT_MANIFEST_DIR, MANIFEST_VERSION, Edit, apply_edits
+
+
+def load_manifests(paths: List[Path]) -> Tuple[Dict[str, Dict[str, List]], List[str]]:
+    """Edits per file grouped by base hash, plus warnings about incomplete shard sets"""
+    files: Dict[str, Dict[str, List]] = {}
+    shards_seen: Dict[Tuple[str, int], Set[int]] = {}
+
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError(f"{path}: unsupported manifest version {manifest.get('version')}")
+
+        index, count = manifest['shard']
+        shards_seen.setdefault((manifest['migrator'], count), set()).add(index)
+        for mdx_file, entry in manifest['files'].items():
+            bases = files.setdefault(mdx_file, {})
+            bases.setdefault(entry['base'], []).extend(Edit(*edit) for edit in entry['edits'])
+
+    warnings = []
+    for (migrator, count), indices in sorted(shards_seen.items()):
+        missing = sorted(set(range(count)) - indices)
+        if missing:
+            warnings.append(f"{migrator}: no manifest for shard(s) "
+                            f"{', '.join(f'{i}/{count}' for i in missing)}")
+    return files, warnings
+
+
+def merge(files: Dict[str, Dict[str, List]], dry_run: bool = False) -> Tuple[int, List[str]]:
+    """Apply the edits of every file; returns the number of files rewritten and any errors"""
+    rewritten = 0
+    errors = []
+    for mdx_file, bases in sorted(files.items()):
+        path = Path(mdx_file)
+        if len(bases) > 1 or not path.exists() or hash_file(path) not in bases:
+            errors.append(f"{mdx_file}: changed since the shards ran; not rewritten")
+            continue
+
+        edits = next(iter(bases.values()))
+        original = path.read_text(encoding='utf-8')
+        try:
+            content = apply_edits(original, edits)
+        except ValueError as e:
+            errors.append(f"{mdx_file}: {e}; not rewritten")
+            continue
+
+        if content != original:
+            if not dry_run:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+            rewritten += 1
+            print(f"  ✓ {mdx_file}: {len(edits)} edit(s)")
+    return rewritten, errors
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Apply the MDX rewrites of sharded migration runs")
+    parser.add_argument(
+        'manifests',
+        nargs='*',
+        metavar='MANIFEST',
+        help=f'Shard manifests to apply (default: {DEFAULT_MANIFEST_DIR}/*.json)'
+    )
+
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Check that the manifests apply cleanly without writing any file'
+    )
+
+    args = parser.parse_args()
+
+    paths = [Path(p) for p in args.manifests] or sorted(Path(DEFAULT_MANIFEST_DIR).glob('*.json'))
+    if not paths:
+        print(f"No shard manifests found in {DEFAULT_MANIFEST_DIR}")
+        return 1
+
+    try:
+        files, warnings = load_manifests(paths)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error: {e}")
+        return 1
+
+    print(f"Merging {len(paths)} shard manifest(s) covering {len(files)} MDX file(s)")
+    for warning in warnings:
+        print(f"⚠️  {warning}")
+
+    rewritten, errors = merge(files, dry_run=args.dry_run)
+    for error in errors:
+        print(f"✗ {error}")
+
+    print(f"{'Would rewrite' if args.dry_run else 'Rewrote'} {rewritten} MDX file(s)")
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    exit(main())
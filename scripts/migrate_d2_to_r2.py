@@ -15,7 +15,7 @@ Requirements:
 - d2 (CLI tool for rendering D2 diagrams)
 
 Usage:
-    python migrate_d2_to_r2.py
+    python migrate_d2_to_r2.py [--watch] [--trace PATH] [--stage] [--shard I/N] [MDX_FILE ...]
 
 Environment variables required:
 - R2_ACCESS_KEY_ID
@@ -26,32 +26,70 @@ Environment variables required:
 """
 
 import os
+import argparse
 import re
-import hashlib
 import subprocess
 import tempfile
+from concurrent.futures import Future
+from functools import cached_property
 from pathlib import Path
-from typing import List, Dict, Tuple
-import boto3
-from botocore.exceptions import ClientError
-from dotenv import load_dotenv
-from PIL import Image, ImageDraw
+from typing import List, Dict, Optional, Tuple
+from render_cache import RenderCache
+from image_quality import AvifEncoding, encode_avif, target_ssim_from_env
+from diagram_postprocess import POSTPROCESS_VERSION, round_and_flatten
+from mdx_scanner import scan_mdx
+from r2_uploader import R2UploadScheduler, content_hash, r2_client_config
+from migration_state import MigrationState, MIGRATED, FAILED
+from content_watcher import watch_posts
+from post_selection import file_signatures, select_posts, stage_rewritten
+from sharding import DEFAULT_MANIFEST_DIR, Shard
+from lazy_import import lazy_import, load_dotenv
+from tracing import tracer
+
+boto3 = lazy_import('boto3')
 
 # Load environment variables
 load_dotenv()
 
+# d2 CLI flags and post-processing parameters; both are part of the render cache key
+D2_RENDER_FLAGS = [
+    '--theme', '0',                # Neutral Default theme
+    '--pad', '20',                 # Add padding
+    '--scale', '2',                # Higher resolution
+]
+POSTPROCESS_PARAMS = {'padding': 10, 'radius': 8, 'quality': 85, 'speed': 6, 'version': POSTPROCESS_VERSION}
+
 class D2ToR2Migrator:
-    def __init__(self):
+    # Key under which this migrator's progress is stored in the state database
+    STATE_NAME = 'd2'
+    
+    def __init__(self, shard: Optional[Shard] = None):
         self.blog_content_dir = Path("src/content/blog")
-        self.r2_client = self._setup_r2_client()
         self.bucket_name = os.getenv("R2_BUCKET_NAME")
         self.r2_public_url = os.getenv("R2_PUBLIC_URL", f"https://{self.bucket_name}.r2.dev")
         
         if not self.bucket_name:
             raise ValueError("R2_BUCKET_NAME environment variable is required")
         
-        # Check if d2 CLI is available
-        self._check_d2_cli()
+        # Uploads run concurrently in the background
+        self.uploader = R2UploadScheduler(self._setup_r2_client, self.bucket_name, self.r2_public_url)
+        
+        # Per-file record of what has already been migrated
+        self.state = MigrationState()
+        
+        # A shard only migrates part of each file, which must not be remembered as done
+        self.shard = shard or Shard()
+        if self.shard.active:
+            self.state.enabled = False
+        
+        # Cache of final AVIF bytes keyed on diagram source and render settings
+        self.render_cache = RenderCache()
+        
+        # Optional SSIM target replacing the fixed AVIF quality
+        self.target_ssim = target_ssim_from_env()
+        self.postprocess_params = POSTPROCESS_PARAMS
+        if self.target_ssim:
+            self.postprocess_params = dict(POSTPROCESS_PARAMS, target_ssim=self.target_ssim)
     
     def _setup_r2_client(self):
         """Setup Cloudflare R2 client using boto3"""
@@ -67,13 +105,20 @@ class D2ToR2Migrator:
             endpoint_url=endpoint_url,
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key,
-            region_name='auto'
+            region_name='auto',
+            config=r2_client_config()
         )
     
-    def _check_d2_cli(self):
-        """Check if d2 CLI is available"""
+    @cached_property
+    def d2_version(self) -> str:
+        """d2 CLI version, probed on the first diagram that needs a cache key"""
+        return self._check_d2_cli()
+    
+    def _check_d2_cli(self) -> str:
+        """Check if d2 CLI is available and return its version"""
         try:
-            subprocess.run(['d2', '--version'], capture_output=True, check=True)
+            result = subprocess.run(['d2', '--version'], capture_output=True, check=True, text=True)
+            return result.stdout.strip()
         except (subprocess.CalledProcessError, FileNotFoundError):
             raise RuntimeError(
                 "d2 CLI not found. Please install it from: https://d2lang.com/tour/install"
@@ -81,122 +126,57 @@ class D2ToR2Migrator:
     
     def find_d2_blocks(self, file_path: Path) -> List[Tuple[str, int, int]]:
         """Find all D2 code blocks in a markdown file"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Find all d2 code blocks with their positions
-        d2_blocks = []
-        lines = content.split('\n')
-        
-        i = 0
-        while i < len(lines):
-            if lines[i].strip() == '```d2':
-                start_line = i
-                i += 1
-                d2_code = []
-                
-                # Find the end of the code block
-                while i < len(lines) and lines[i].strip() != '```':
-                    d2_code.append(lines[i])
-                    i += 1
-                
-                if i < len(lines):  # Found closing ```
-                    end_line = i
-                    d2_blocks.append(('\n'.join(d2_code), start_line, end_line))
-                
-            i += 1
-        
-        return d2_blocks
+        return [
+            (block.code, block.start_line, block.end_line)
+            for block in scan_mdx(file_path).d2_blocks
+        ]
     
-    def render_d2_to_png(self, d2_code: str) -> str:
-        """Render D2 code to PNG using d2 CLI"""
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.d2', delete=False) as d2_file:
-            d2_file.write(d2_code)
-            d2_file_path = d2_file.name
-        
-        png_file_path = d2_file_path.replace('.d2', '.png')
-        
-        try:
-            # Use d2 CLI to render PNG with neutral theme
-            subprocess.run([
-                'd2',
-                '--theme', '0',                # Neutral Default theme
-                '--pad', '20',                 # Add padding
-                '--scale', '2',                # Higher resolution
-                d2_file_path,
-                png_file_path
-            ], check=True, capture_output=True)
+    def render_d2_to_png(self, d2_code: str) -> bytes:
+        """Render D2 code to PNG bytes using d2 CLI"""
+        with tempfile.TemporaryDirectory(prefix='d2-render-') as temp_dir:
+            d2_file_path = os.path.join(temp_dir, 'diagram.d2')
+            png_file_path = os.path.join(temp_dir, 'diagram.png')
             
-            return png_file_path
+            with open(d2_file_path, 'w', encoding='utf-8') as d2_file:
+                d2_file.write(d2_code)
             
-        except subprocess.CalledProcessError as e:
-            print(f"Error rendering D2 diagram: {e}")
-            if e.stderr:
-                print(f"Error details: {e.stderr.decode()}")
-            raise
-        finally:
-            # Clean up d2 file
-            if os.path.exists(d2_file_path):
-                os.unlink(d2_file_path)
+            try:
+                # Use d2 CLI to render PNG with neutral theme
+                subprocess.run([
+                    'd2',
+                    *D2_RENDER_FLAGS,
+                    d2_file_path,
+                    png_file_path
+                ], check=True, capture_output=True)
+                
+            except subprocess.CalledProcessError as e:
+                print(f"Error rendering D2 diagram: {e}")
+                if e.stderr:
+                    print(f"Error details: {e.stderr.decode()}")
+                raise
+            
+            # Read the PNG straight from the renderer output; the directory is removed on exit
+            with open(png_file_path, 'rb') as f:
+                return f.read()
     
-    def add_rounded_corners_and_convert_to_avif(self, png_path: str) -> bytes:
-        """Add rounded corners to PNG and convert to AVIF format (no borders)"""
-        avif_path = png_path.replace('.png', '.avif')
-
-        try:
-            with Image.open(png_path) as img:
-                # Ensure RGBA mode for transparency handling
-                if img.mode != 'RGBA':
-                    img = img.convert('RGBA')
-
-                # Add minimal padding
-                padding = 10
-                new_width = img.width + (padding * 2)
-                new_height = img.height + (padding * 2)
-
-                # Create new image with padding
-                padded_img = Image.new('RGBA', (new_width, new_height), (0, 0, 0, 0))
-                padded_img.paste(img, (padding, padding))
-
-                # Create rounded rectangle mask
-                mask = Image.new('L', (new_width, new_height), 0)
-                draw = ImageDraw.Draw(mask)
-
-                # Draw rounded rectangle (radius = 8px, smaller radius)
-                radius = 8
-                draw.rounded_rectangle(
-                    [(0, 0), (new_width, new_height)],
-                    radius=radius,
-                    fill=255
-                )
-
-                # Apply mask to create rounded corners
-                rounded_img = Image.new('RGBA', (new_width, new_height), (0, 0, 0, 0))
-                rounded_img.paste(padded_img, (0, 0))
-                rounded_img.putalpha(mask)
-
-                # Convert to RGB with white background for AVIF (no border)
-                background = Image.new('RGB', rounded_img.size, (255, 255, 255))
-                background.paste(rounded_img, mask=rounded_img.split()[-1])
-
-                background.save(avif_path, 'AVIF', quality=85, speed=6)
-
-            # Read AVIF data
-            with open(avif_path, 'rb') as f:
-                avif_data = f.read()
-
-            return avif_data
+    def add_rounded_corners_and_convert_to_avif(self, png_data: bytes) -> AvifEncoding:
+        """Add padding and rounded corners on white to PNG bytes and convert to AVIF (no borders)"""
+        flattened = round_and_flatten(
+            png_data,
+            padding=POSTPROCESS_PARAMS['padding'],
+            radius=POSTPROCESS_PARAMS['radius']
+        )
+        return encode_avif(
+            flattened,
+            quality=POSTPROCESS_PARAMS['quality'],
+            speed=POSTPROCESS_PARAMS['speed'],
+            target_ssim=self.target_ssim
+        )
 
-        finally:
-            # Clean up temporary files
-            for temp_path in [png_path, avif_path]:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-    
-    def generate_filename(self, d2_code: str, index: int) -> str:
-        """Generate a unique filename for the diagram"""
-        # Create a hash of the d2 code for uniqueness
-        code_hash = hashlib.md5(d2_code.encode()).hexdigest()[:8]
+    def generate_filename(self, d2_code: str, index: int, avif_data: bytes) -> str:
+        """Generate a content-addressed filename for the rendered diagram"""
+        # Hash the rendered bytes, not the source, so a re-render with new settings gets a new key
+        code_hash = content_hash(avif_data)
         
         # Try to extract a meaningful name from the first few lines
         lines = d2_code.strip().split('\n')
@@ -227,22 +207,16 @@ class D2ToR2Migrator:
         
         return f"{diagram_name}-{index + 1}-{code_hash}.avif"
     
+    def submit_upload_to_r2(self, avif_data: bytes, blog_folder: str, filename: str) -> Future:
+        """Queue an AVIF upload to R2; the Future resolves to the public URL"""
+        key = f"blogs/{blog_folder}/{filename}"
+        return self.uploader.submit(key, avif_data, 'image/avif')
+    
     def upload_to_r2(self, avif_data: bytes, blog_folder: str, filename: str) -> str:
         """Upload AVIF to R2 and return the public URL"""
-        key = f"blogs/{blog_folder}/{filename}"
-        
+        from botocore.exceptions import ClientError
         try:
-            self.r2_client.put_object(
-                Bucket=self.bucket_name,
-                Key=key,
-                Body=avif_data,
-                ContentType='image/avif',
-                CacheControl='public, max-age=31536000'  # Cache for 1 year
-            )
-            
-            # Return the public URL
-            return f"{self.r2_public_url}/{key}"
-            
+            return self.submit_upload_to_r2(avif_data, blog_folder, filename).result()
         except ClientError as e:
             print(f"Error uploading to R2: {e}")
             raise
@@ -274,10 +248,16 @@ class D2ToR2Migrator:
             print(f"  No index.mdx found in {blog_path}")
             return 0
         
+        # Skip files that have not changed since they were fully migrated
+        if self.state.is_unchanged(self.STATE_NAME, mdx_file):
+            print(f"  Unchanged since last migration")
+            return 0
+        
         # Find D2 blocks
         d2_blocks = self.find_d2_blocks(mdx_file)
         if not d2_blocks:
             print(f"  No D2 diagrams found")
+            self.state.record(self.STATE_NAME, mdx_file, [])
             return 0
         
         print(f"  Found {len(d2_blocks)} D2 diagrams")
@@ -285,53 +265,87 @@ class D2ToR2Migrator:
         # Use blog folder name for R2 organization
         blog_folder = blog_path.name
         replacements = []
+        outcomes = []
+        uploads = []
         
         for index, (d2_code, start_line, end_line) in enumerate(d2_blocks):
+            # Assets of other shards are left for their runners
+            if not self.shard.owns(blog_folder, d2_code):
+                continue
+            
             try:
                 print(f"    Processing diagram {index + 1}/{len(d2_blocks)}")
                 
-                # Render D2 to PNG
-                png_path = self.render_d2_to_png(d2_code)
+                cache_key = RenderCache.make_key(
+                    d2_code, 'd2', self.d2_version, D2_RENDER_FLAGS, self.postprocess_params
+                )
+                avif_data = self.render_cache.get(cache_key)
+                metrics = self.render_cache.get_meta(cache_key)
                 
-                # Add rounded corners and convert PNG to AVIF (no borders)
-                avif_data = self.add_rounded_corners_and_convert_to_avif(png_path)
+                if avif_data is None:
+                    with tracer.context(asset=f"diagram-{index + 1}"):
+                        # Render D2 to PNG
+                        with tracer.span('render') as span:
+                            png_data = self.render_d2_to_png(d2_code)
+                            span.bytes_out = len(png_data)
+                    
+                        # Add rounded corners and convert PNG to AVIF (no borders)
+                        encoding = self.add_rounded_corners_and_convert_to_avif(png_data)
+                    avif_data, metrics = encoding.data, encoding.metrics()
+                    self.render_cache.put(cache_key, avif_data, metrics)
+                else:
+                    print(f"    Using cached render")
                 
                 # Generate filename
-                filename = self.generate_filename(d2_code, index)
+                filename = self.generate_filename(d2_code, index, avif_data)
                 print(f"    Uploading as: {filename}")
                 
-                # Upload to R2
-                r2_url = self.upload_to_r2(avif_data, blog_folder, filename)
-                replacements.append((start_line, end_line, r2_url))
-                
-                print(f"    ✓ Migrated to: {r2_url}")
+                # Upload to R2 in the background while the next diagram renders
+                upload = self.submit_upload_to_r2(avif_data, blog_folder, filename)
+                uploads.append((index, start_line, end_line, upload, metrics))
                 
             except Exception as e:
                 print(f"    ✗ Failed to migrate diagram {index + 1}: {e}")
+                outcomes.append((f"diagram-{index + 1}", FAILED, str(e)))
                 continue
         
+        # Only rewrite the file once every upload of the post has been confirmed
+        for index, start_line, end_line, upload, metrics in uploads:
+            try:
+                r2_url = upload.result()
+                replacements.append((start_line, end_line, r2_url))
+                outcomes.append((f"diagram-{index + 1}", MIGRATED, r2_url, metrics))
+                print(f"    ✓ Migrated to: {r2_url}")
+            except Exception as e:
+                print(f"    ✗ Failed to migrate diagram {index + 1}: {e}")
+                outcomes.append((f"diagram-{index + 1}", FAILED, str(e)))
+        
         # Replace D2 blocks in the file
         if replacements:
-            self.replace_d2_blocks_in_file(mdx_file, replacements)
+            with tracer.span('rewrite', asset=str(mdx_file)):
+                self.replace_d2_blocks_in_file(mdx_file, replacements)
             print(f"  ✓ Updated {len(replacements)} diagrams in {mdx_file}")
         
+        self.state.record(self.STATE_NAME, mdx_file, outcomes)
         return len(replacements)
     
-    def migrate_all_posts(self):
+    def migrate_all_posts(self, blog_posts: Optional[List[Path]] = None):
         """Migrate D2 diagrams in all blog posts"""
         if not self.blog_content_dir.exists():
             print(f"Blog content directory not found: {self.blog_content_dir}")
             return
         
         total_migrated = 0
-        blog_posts = [d for d in self.blog_content_dir.iterdir() if d.is_dir()]
+        if blog_posts is None:
+            blog_posts = [d for d in self.blog_content_dir.iterdir() if d.is_dir()]
         
         print(f"Found {len(blog_posts)} blog posts to process")
         print("-" * 50)
         
         for blog_path in blog_posts:
             try:
-                migrated_count = self.process_blog_post(blog_path)
+                with tracer.context(post=blog_path.name), self.shard.recording(blog_path / "index.mdx"):
+                    migrated_count = self.process_blog_post(blog_path)
                 total_migrated += migrated_count
             except Exception as e:
                 print(f"Error processing {blog_path}: {e}")
@@ -341,15 +355,75 @@ class D2ToR2Migrator:
         
         print("-" * 50)
         print(f"Migration complete! Total diagrams migrated: {total_migrated}")
+        print(self.uploader.summary())
+        print(self.render_cache.summary())
 
 def main():
     """Main function"""
+    parser = argparse.ArgumentParser(description="Migrate D2 diagrams to AVIF in R2")
+    parser.add_argument(
+        'files',
+        nargs='*',
+        metavar='MDX_FILE',
+        help='Only migrate the posts of these index.mdx files, e.g. the staged ones (default: all posts)'
+    )
+    
+    parser.add_argument(
+        '--stage',
+        action='store_true',
+        help='git add the MDX files this run rewrote'
+    )
+    
+    parser.add_argument(
+        '--shard',
+        type=Shard.parse,
+        metavar='I/N',
+        help='Only migrate shard I of N (0-based) and record the MDX rewrites in a manifest '
+             'for merge_shards.py instead of applying them'
+    )
+    
+    parser.add_argument(
+        '--shard-manifest',
+        metavar='PATH',
+        help=f'Where to write the shard manifest (default: {DEFAULT_MANIFEST_DIR}/<migrator>-<i>-of-<n>.json)'
+    )
+    
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='After migrating, keep running and migrate the new assets of every saved index.mdx'
+    )
+    
+    parser.add_argument(
+        '--trace',
+        metavar='PATH',
+        help='Record per-stage spans and write them to PATH as Chrome trace JSON, '
+             'plus a p50/p95/max summary (default: MIGRATION_TRACE)'
+    )
+    
+    args = parser.parse_args()
+    tracer.start(args.trace)
+    
     try:
-        migrator = D2ToR2Migrator()
-        migrator.migrate_all_posts()
+        migrator = D2ToR2Migrator(shard=args.shard)
+        blog_posts = select_posts(migrator.blog_content_dir, args.files)
+        before = file_signatures(blog_posts)
+        migrator.migrate_all_posts(blog_posts)
+        if args.stage:
+            stage_rewritten(before)
+        if migrator.shard.active:
+            manifest = migrator.shard.write_manifest(migrator.STATE_NAME, args.shard_manifest)
+            print(f"Shard {migrator.shard} manifest: {manifest}")
+        if args.watch:
+            watch_posts([migrator])
+        migrator.uploader.close()
     except Exception as e:
         print(f"Error: {e}")
         return 1
+    finally:
+        trace_summary = tracer.finish()
+        if trace_summary:
+            print(trace_summary)
     
     return 0
 
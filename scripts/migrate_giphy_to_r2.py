@@ -8,13 +8,23 @@ This script:
 3. Uploads them to Cloudflare R2 with organized folder structure
 4. Replaces the original links in blog posts
 
+Links to the same clip are downloaded once per post, whichever media* host
+or URL form they use. With --dedupe, clips linked from several posts are
+uploaded once to blogs/shared/ and every post links there.
+
+With --transcode-gifs each GIF is also converted to an MP4 (or, without one,
+an animated WebP/AVIF), and the link becomes a <video> (or <picture>) embed
+that falls back to the GIF.
+
 Requirements:
 - boto3 (for R2 interaction)
 - requests (for downloading GIFs)
 - python-dotenv (for environment variables)
+- Pillow and ffmpeg (only for --transcode-gifs)
 
 Usage:
-    python migrate_giphy_to_r2.py
+    python migrate_giphy_to_r2.py [--transcode-gifs [webp|avif]] [--dedupe] [--watch] [--trace PATH]
+                                  [--stage] [--shard I/N] [MDX_FILE ...]
 
 Environment variables required:
 - R2_ACCESS_KEY_ID
@@ -26,27 +36,83 @@ Environment variables required:
 
 import os
 import re
-import hashlib
-import requests
+import argparse
+from concurrent.futures import Executor, Future
 from pathlib import Path
-from urllib.parse import urlparse
-from typing import List, Dict, Tuple
-import boto3
-from botocore.exceptions import ClientError
-from dotenv import load_dotenv
+from typing import List, Dict, Set, Tuple, Optional, Union
+from http_fetcher import HttpFetcher
+from mdx_scanner import scan_mdx
+from r2_uploader import R2UploadScheduler, content_hash, r2_client_config
+from spooled_body import SpooledBody
+from gif_transcode import (
+    ANIMATED_FORMATS, DEFAULT_ANIMATED_FORMAT, build_gif_embed, content_type_for, transcode_gif
+)
+from migration_state import MigrationState, MIGRATED, FAILED
+from content_watcher import watch_posts
+from post_selection import file_signatures, select_posts, stage_rewritten
+from sharding import DEFAULT_MANIFEST_DIR, Shard
+from lazy_import import lazy_import, load_dotenv
+from tracing import tracer
+
+boto3 = lazy_import('boto3')
+requests = lazy_import('requests')
 
 # Load environment variables
 load_dotenv()
 
+# R2 folder (under blogs/) for clips linked from several posts
+SHARED_FOLDER = "shared"
+
+# media.giphy.com, media0-4.giphy.com and i.giphy.com serve the same /media/<id>/<file>,
+# optionally behind a v1.<token> path segment
+GIPHY_MEDIA_PATTERN = re.compile(
+    r'https?://(?:media\d*|i)\.giphy\.com/media/(?:v1\.[^/]+/)?([A-Za-z0-9]+)/([\w.-]+)'
+)
+
+def canonical_giphy_url(url: str) -> str:
+    """One URL per Giphy clip and rendition, whichever host or URL form the post links"""
+    match = GIPHY_MEDIA_PATTERN.match(url)
+    if not match:
+        return url
+    clip_id, rendition = match.groups()
+    return f"https://media.giphy.com/media/{clip_id}/{rendition}"
+
 class GiphyToR2Migrator:
-    def __init__(self):
+    # Key under which this migrator's progress is stored in the state database
+    STATE_NAME = 'giphy'
+    
+    def __init__(self, transcode_gifs: Optional[str] = None, dedupe: bool = False,
+                 shard: Optional[Shard] = None):
         self.blog_content_dir = Path("src/content/blog")
-        self.r2_client = self._setup_r2_client()
         self.bucket_name = os.getenv("R2_BUCKET_NAME")
         self.r2_public_url = os.getenv("R2_PUBLIC_URL", f"https://{self.bucket_name}.r2.dev")
         
+        # Per-file record of what has already been migrated
+        self.state = MigrationState()
+        
+        # A shard only migrates part of each file, which must not be remembered as done
+        self.shard = shard or Shard()
+        if self.shard.active:
+            self.state.enabled = False
+        
+        # Pooled HTTP client shared by every GIF download
+        self.fetcher = HttpFetcher()
+        
         if not self.bucket_name:
             raise ValueError("R2_BUCKET_NAME environment variable is required")
+        
+        # Uploads run concurrently in the background
+        self.uploader = R2UploadScheduler(self._setup_r2_client, self.bucket_name, self.r2_public_url)
+        
+        # Animated image format GIFs are transcoded to when there is no MP4; None preserves GIFs as-is.
+        # The transcoder pool only exists during migrate_all_posts
+        self.transcode_gifs = transcode_gifs
+        self.executor: Optional[Executor] = None
+        
+        # Clips linked from several posts (filled by index_shared_clips) and their queued uploads
+        self.dedupe = dedupe
+        self.shared_clips: Set[str] = set()
+        self.shared_uploads: Dict[str, tuple] = {}
     
     def _setup_r2_client(self):
         """Setup Cloudflare R2 client using boto3"""
@@ -62,81 +128,76 @@ class GiphyToR2Migrator:
             endpoint_url=endpoint_url,
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key,
-            region_name='auto'
+            region_name='auto',
+            config=r2_client_config()
         )
     
     def find_giphy_links(self, file_path: Path) -> List[Tuple[str, str]]:
-        """Find all Giphy links in a markdown file"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Regex to match Giphy links in markdown format
-        giphy_pattern = r'!\[([^\]]*)\]\((https://media[0-9]*\.giphy\.com/[^)]+)\)'
-        matches = re.findall(giphy_pattern, content)
-        
+        """Find all Giphy links in a markdown file (outside code blocks)"""
         # Filter out URLs already hosted on our R2 endpoint
-        filtered_matches = []
-        for alt_text, url in matches:
-            if not url.startswith('https://assets.barundebnath.com/'):
-                filtered_matches.append((alt_text, url))
-        
-        return filtered_matches
+        return [
+            (link.alt_text, link.url)
+            for link in scan_mdx(file_path).giphy_links
+            if not link.url.startswith('https://assets.barundebnath.com/')
+        ]
     
     def download_gif(self, url: str) -> bytes:
         """Download GIF from Giphy URL"""
         try:
-            response = requests.get(url, timeout=30)
-            response.raise_for_status()
-            return response.content
+            return self.fetcher.fetch(url)
         except requests.RequestException as e:
             print(f"Error downloading {url}: {e}")
             raise
     
-    def generate_filename(self, original_url: str, alt_text: str) -> str:
-        """Generate a unique filename for the GIF"""
-        # Extract original filename or create one from URL
-        parsed_url = urlparse(original_url)
-        original_name = Path(parsed_url.path).name
-        
-        # Create a hash of the URL for uniqueness
-        url_hash = hashlib.md5(original_url.encode()).hexdigest()[:8]
+    def generate_filename(self, alt_text: str, content: Union[bytes, SpooledBody], extension: str = '.gif') -> str:
+        """Generate a content-addressed filename for the GIF (or one of its renditions)"""
+        # Name the object after its bytes: the same clip from any media* host shares one key
+        gif_hash = content_hash(content)
         
         # Clean alt text for filename
         clean_alt = re.sub(r'[^a-zA-Z0-9\s-]', '', alt_text)
         clean_alt = re.sub(r'\s+', '-', clean_alt.strip())[:50]
         
         if clean_alt:
-            filename = f"{clean_alt}-{url_hash}.gif"
+            filename = f"{clean_alt}-{gif_hash}{extension}"
         else:
-            filename = f"giphy-{url_hash}.gif"
+            filename = f"giphy-{gif_hash}{extension}"
         
         return filename
     
+    def submit_upload_to_r2(self, gif_data: Union[bytes, SpooledBody], blog_folder: str, filename: str) -> Future:
+        """Queue a GIF upload to R2; the Future resolves to the public URL"""
+        key = f"blogs/{blog_folder}/{filename}"
+        return self.uploader.submit(key, gif_data, 'image/gif')
+    
     def upload_to_r2(self, gif_data: bytes, blog_folder: str, filename: str) -> str:
         """Upload GIF to R2 and return the public URL"""
-        key = f"blogs/{blog_folder}/{filename}"
-        
+        from botocore.exceptions import ClientError
         try:
-            self.r2_client.put_object(
-                Bucket=self.bucket_name,
-                Key=key,
-                Body=gif_data,
-                ContentType='image/gif',
-                CacheControl='public, max-age=31536000'  # Cache for 1 year
-            )
-            
-            # Return the public URL
-            return f"{self.r2_public_url}/{key}"
-            
+            return self.submit_upload_to_r2(gif_data, blog_folder, filename).result()
         except ClientError as e:
             print(f"Error uploading to R2: {e}")
             raise
     
-    def replace_links_in_file(self, file_path: Path, replacements: Dict[str, str]):
-        """Replace Giphy links with R2 links in the markdown file"""
+    def submit_transcode_gif(self, gif_data: bytes) -> Future:
+        """Schedule the MP4 or animated WebP/AVIF transcode of a GIF on the worker pool"""
+        if self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor()
+        return tracer.submit(self.executor, transcode_gif, gif_data, self.transcode_gifs)
+    
+    def replace_links_in_file(self, file_path: Path, replacements: Dict[str, str],
+                              elements: Optional[Dict[str, str]] = None):
+        """Replace Giphy links with R2 links in the markdown file
+
+        `elements` maps whole markdown images to replacement markup (<video> embeds).
+        """
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
         
+        for markdown, element in (elements or {}).items():
+            content = content.replace(markdown, element)
+        
         # Replace each Giphy URL with the corresponding R2 URL
         for giphy_url, r2_url in replacements.items():
             content = content.replace(giphy_url, r2_url)
@@ -155,10 +216,16 @@ class GiphyToR2Migrator:
             print(f"  No index.mdx found in {blog_path}")
             return 0
         
+        # Skip files that have not changed since they were fully migrated
+        if self.state.is_unchanged(self.STATE_NAME, mdx_file):
+            print(f"  Unchanged since last migration")
+            return 0
+        
         # Find Giphy links
         giphy_links = self.find_giphy_links(mdx_file)
         if not giphy_links:
             print(f"  No Giphy links found")
+            self.state.record(self.STATE_NAME, mdx_file, [])
             return 0
         
         print(f"  Found {len(giphy_links)} Giphy links")
@@ -166,64 +233,264 @@ class GiphyToR2Migrator:
         # Use blog folder name for R2 organization
         blog_folder = blog_path.name
         replacements = {}
+        elements = {}
+        outcomes = []
         
+        # Start every download of the post at once, one per clip
+        downloads = {}
+        reused = []
         for alt_text, giphy_url in giphy_links:
+            clip = canonical_giphy_url(giphy_url)
+            # Assets of other shards are left for their runners
+            if not self.shard.owns(blog_folder, clip):
+                continue
+            if clip in downloads or clip in self.shared_uploads:
+                print(f"    Same clip as an earlier link: {giphy_url}")
+                reused.append((alt_text, giphy_url, clip))
+                continue
+            print(f"    Downloading: {giphy_url}")
+            if self.transcode_gifs:
+                downloads[clip] = (alt_text, giphy_url, self.fetcher.submit(clip))
+            else:
+                # GIFs are passed through untouched, so stream them straight to R2
+                downloads[clip] = (alt_text, giphy_url, self.fetcher.submit_stream(clip))
+        
+        uploads = []
+        for clip, (alt_text, giphy_url, download) in downloads.items():
             try:
-                print(f"    Downloading: {giphy_url}")
-                gif_data = self.download_gif(giphy_url)
+                gif_data = download.result()
                 
-                filename = self.generate_filename(giphy_url, alt_text)
+                # Shared clips are named after their bytes alone, not one post's alt text
+                folder, name_alt = (SHARED_FOLDER, '') if clip in self.shared_clips else (blog_folder, alt_text)
+                filename = self.generate_filename(name_alt, gif_data)
                 print(f"    Uploading as: {filename}")
                 
-                r2_url = self.upload_to_r2(gif_data, blog_folder, filename)
-                replacements[giphy_url] = r2_url
-                
-                print(f"    ✓ Migrated to: {r2_url}")
+                with tracer.context(asset=giphy_url):
+                    transcode = self.submit_transcode_gif(gif_data) if self.transcode_gifs else None
+                gif_bytes = len(gif_data) if transcode else None
+                upload = self.submit_upload_to_r2(gif_data, folder, filename)
+                uploads.append((alt_text, giphy_url, clip, folder, name_alt, upload, transcode, gif_bytes))
                 
             except Exception as e:
                 print(f"    ✗ Failed to migrate {giphy_url}: {e}")
+                outcomes.append((giphy_url, FAILED, str(e)))
+                continue
+        
+        # Upload the transcoded renditions next to each GIF
+        rendition_uploads = {}
+        for alt_text, giphy_url, clip, folder, name_alt, upload, transcode, gif_bytes in uploads:
+            if transcode is None:
                 continue
+            try:
+                renditions = transcode.result()
+                if not renditions.any:
+                    print(f"    No rendition is smaller than the GIF ({gif_bytes} bytes), keeping it as-is")
+                    continue
+                
+                image_upload = None
+                if renditions.image is not None:
+                    image_name = self.generate_filename(name_alt, renditions.image, f".{renditions.image_ext}")
+                    print(f"    Uploading as: {image_name} ({len(renditions.image)} bytes, GIF was {gif_bytes})")
+                    image_upload = self.uploader.submit(
+                        f"blogs/{folder}/{image_name}", renditions.image, content_type_for(renditions.image_ext)
+                    )
+                mp4_upload = None
+                if renditions.mp4 is not None:
+                    mp4_name = self.generate_filename(name_alt, renditions.mp4, '.mp4')
+                    print(f"    Uploading as: {mp4_name} ({len(renditions.mp4)} bytes)")
+                    mp4_upload = self.uploader.submit(f"blogs/{folder}/{mp4_name}", renditions.mp4, 'video/mp4')
+                rendition_uploads[clip] = (renditions, image_upload, mp4_upload)
+            except Exception as e:
+                # The GIF itself still migrates; only the lighter embed is skipped
+                print(f"    ⚠️  Could not transcode {giphy_url}: {e}")
+        
+        # Shared clips uploaded here serve every later post that links them
+        for entry in uploads:
+            clip = entry[2]
+            if clip in self.shared_clips:
+                self.shared_uploads[clip] = (entry, rendition_uploads.get(clip))
+        
+        # Repeated links reuse the uploads of the clip's first link
+        first_links = {entry[2]: (entry, rendition_uploads.get(entry[2])) for entry in uploads}
+        for alt_text, giphy_url, clip in reused:
+            source = first_links.get(clip) or self.shared_uploads.get(clip)
+            if source is None:
+                outcomes.append((giphy_url, FAILED, f'same clip as failed {clip}'))
+                continue
+            entry, renditions = source
+            uploads.append((alt_text, giphy_url) + entry[2:])
+            if renditions is not None:
+                rendition_uploads[clip] = renditions
+        
+        # Only rewrite the file once every upload of the post has been confirmed
+        for alt_text, giphy_url, clip, folder, name_alt, upload, transcode, gif_bytes in uploads:
+            try:
+                r2_url = upload.result()
+                metrics = None
+                
+                if clip in rendition_uploads:
+                    renditions, image_upload, mp4_upload = rendition_uploads[clip]
+                    image_url = image_upload.result() if image_upload is not None else None
+                    mp4_url = mp4_upload.result() if mp4_upload is not None else None
+                    elements[f"![{alt_text}]({giphy_url})"] = build_gif_embed(
+                        alt_text, r2_url, image_url, renditions.image_ext, mp4_url, renditions.size
+                    )
+                    metrics = renditions.metrics(gif_bytes)
+                else:
+                    replacements[giphy_url] = r2_url
+                
+                outcomes.append((giphy_url, MIGRATED, r2_url, metrics))
+                print(f"    ✓ Migrated to: {r2_url}")
+            except Exception as e:
+                print(f"    ✗ Failed to migrate {giphy_url}: {e}")
+                outcomes.append((giphy_url, FAILED, str(e)))
         
         # Replace links in the file
-        if replacements:
-            self.replace_links_in_file(mdx_file, replacements)
-            print(f"  ✓ Updated {len(replacements)} links in {mdx_file}")
+        if replacements or elements:
+            with tracer.span('rewrite', asset=str(mdx_file)):
+                self.replace_links_in_file(mdx_file, replacements, elements)
+            print(f"  ✓ Updated {len(replacements) + len(elements)} links in {mdx_file}")
+        
+        self.state.record(self.STATE_NAME, mdx_file, outcomes)
+        return len(replacements) + len(elements)
+    
+    def index_shared_clips(self, blog_posts: List[Path]):
+        """Find the clips linked from more than one of the posts due for migration"""
+        posts_by_clip: Dict[str, Set[str]] = {}
+        for blog_path in blog_posts:
+            mdx_file = blog_path / "index.mdx"
+            if not mdx_file.exists() or self.state.is_unchanged(self.STATE_NAME, mdx_file):
+                continue
+            for _, giphy_url in self.find_giphy_links(mdx_file):
+                posts_by_clip.setdefault(canonical_giphy_url(giphy_url), set()).add(blog_path.name)
         
-        return len(replacements)
+        self.shared_clips = {clip for clip, posts in posts_by_clip.items() if len(posts) > 1}
+        print(f"{len(self.shared_clips)} clip(s) linked from several posts will be uploaded once "
+              f"to blogs/{SHARED_FOLDER}/")
     
-    def migrate_all_posts(self):
+    def migrate_all_posts(self, blog_posts: Optional[List[Path]] = None):
         """Migrate Giphy links in all blog posts"""
         if not self.blog_content_dir.exists():
             print(f"Blog content directory not found: {self.blog_content_dir}")
             return
         
         total_migrated = 0
-        blog_posts = [d for d in self.blog_content_dir.iterdir() if d.is_dir()]
+        if blog_posts is None:
+            blog_posts = [d for d in self.blog_content_dir.iterdir() if d.is_dir()]
         
         print(f"Found {len(blog_posts)} blog posts to process")
+        if self.transcode_gifs:
+            print(f"Transcoding GIFs to MP4, or to animated {self.transcode_gifs.upper()} where there is no MP4")
         print("-" * 50)
         
-        for blog_path in blog_posts:
-            try:
-                migrated_count = self.process_blog_post(blog_path)
-                total_migrated += migrated_count
-            except Exception as e:
-                print(f"Error processing {blog_path}: {e}")
-                continue
-            
+        if self.dedupe:
+            self.index_shared_clips(blog_posts)
             print()
         
+        try:
+            for blog_path in blog_posts:
+                try:
+                    with tracer.context(post=blog_path.name), self.shard.recording(blog_path / "index.mdx"):
+                        migrated_count = self.process_blog_post(blog_path)
+                    total_migrated += migrated_count
+                except Exception as e:
+                    print(f"Error processing {blog_path}: {e}")
+                    continue
+                
+                print()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+        
         print("-" * 50)
         print(f"Migration complete! Total links migrated: {total_migrated}")
+        print(self.uploader.summary())
+        print(self.fetcher.summary())
 
 def main():
     """Main function"""
+    parser = argparse.ArgumentParser(description="Migrate Giphy GIFs to R2")
+    parser.add_argument(
+        '--transcode-gifs',
+        nargs='?',
+        const=DEFAULT_ANIMATED_FORMAT,
+        choices=sorted(ANIMATED_FORMATS),
+        help='Also upload each GIF as an MP4 (or an animated image without one) and embed them with a '
+             f'<video>/<picture> element that falls back to the GIF (default format: {DEFAULT_ANIMATED_FORMAT})'
+    )
+    
+    parser.add_argument(
+        '--dedupe',
+        action='store_true',
+        help=f'Upload clips linked from several posts once, to blogs/{SHARED_FOLDER}/'
+    )
+    
+    parser.add_argument(
+        'files',
+        nargs='*',
+        metavar='MDX_FILE',
+        help='Only migrate the posts of these index.mdx files, e.g. the staged ones (default: all posts)'
+    )
+    
+    parser.add_argument(
+        '--stage',
+        action='store_true',
+        help='git add the MDX files this run rewrote'
+    )
+    
+    parser.add_argument(
+        '--shard',
+        type=Shard.parse,
+        metavar='I/N',
+        help='Only migrate shard I of N (0-based) and record the MDX rewrites in a manifest '
+             'for merge_shards.py instead of applying them'
+    )
+    
+    parser.add_argument(
+        '--shard-manifest',
+        metavar='PATH',
+        help=f'Where to write the shard manifest (default: {DEFAULT_MANIFEST_DIR}/<migrator>-<i>-of-<n>.json)'
+    )
+    
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='After migrating, keep running and migrate the new assets of every saved index.mdx'
+    )
+    
+    parser.add_argument(
+        '--trace',
+        metavar='PATH',
+        help='Record per-stage spans and write them to PATH as Chrome trace JSON, '
+             'plus a p50/p95/max summary (default: MIGRATION_TRACE)'
+    )
+    
+    args = parser.parse_args()
+    tracer.start(args.trace)
+    
     try:
-        migrator = GiphyToR2Migrator()
-        migrator.migrate_all_posts()
+        migrator = GiphyToR2Migrator(transcode_gifs=args.transcode_gifs, dedupe=args.dedupe,
+                                     shard=args.shard)
+        blog_posts = select_posts(migrator.blog_content_dir, args.files)
+        before = file_signatures(blog_posts)
+        migrator.migrate_all_posts(blog_posts)
+        if args.stage:
+            stage_rewritten(before)
+        if migrator.shard.active:
+            manifest = migrator.shard.write_manifest(migrator.STATE_NAME, args.shard_manifest)
+            print(f"Shard {migrator.shard} manifest: {manifest}")
+        if args.watch:
+            watch_posts([migrator])
+        migrator.fetcher.close()
+        migrator.uploader.close()
     except Exception as e:
         print(f"Error: {e}")
         return 1
+    finally:
+        trace_summary = tracer.finish()
+        if trace_summary:
+            print(trace_summary)
     
     return 0
 
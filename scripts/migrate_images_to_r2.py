@@ -19,7 +19,28 @@ Requirements:
 - Pillow (for image processing)
 
 Usage:
-    python migrate_images_to_r2.py
+    python migrate_images_to_r2.py [--jobs N] [--srcset [WIDTHS]] [--target-ssim SSIM]
+                                   [--transcode-gifs [webp|avif]] [--dedupe] [--watch] [--trace PATH]
+                                   [--stage] [--shard I/N] [MDX_FILE ...]
+
+With --srcset each image is decoded once and encoded at every width of the
+ladder (default 480,960,1440) plus its full size, and the reference is
+rewritten into an <img srcset sizes> element.
+
+With --target-ssim (or AVIF_TARGET_SSIM) the AVIF quality is searched per
+image for the smallest encoding that still meets the SSIM target.
+
+With --dedupe every image of the posts due for migration is fingerprinted
+first (see perceptual_hash.py); near-duplicates across posts, confirmed by a
+pixel check against the largest copy, are encoded once from that copy into
+blogs/shared/ and every reference points there.
+
+With --trace (or MIGRATION_TRACE) every stage is recorded as a span and
+written as Chrome trace JSON, followed by a p50/p95/max table per stage.
+
+With --transcode-gifs GIFs are also converted to an MP4 (or, without one, an
+animated WebP/AVIF) and embedded with a <video> (or <picture>) element that
+falls back to the GIF.
 
 Environment variables required:
 - R2_ACCESS_KEY_ID
@@ -29,36 +50,208 @@ Environment variables required:
 - R2_PUBLIC_URL (optional, for custom domain)
 """
 
+import io
 import os
 import re
-import hashlib
-import requests
+import argparse
 import tempfile
+from collections import deque
+from concurrent.futures import Executor, Future
 from pathlib import Path
 from urllib.parse import urlparse, urljoin
-from typing import List, Dict, Tuple, Optional
-import boto3
-from botocore.exceptions import ClientError
-from dotenv import load_dotenv
-from PIL import Image
+from typing import Iterator, List, Dict, Tuple, Optional, Union
+from image_quality import encode_avif, target_ssim_from_env
+from gif_transcode import (
+    ANIMATED_FORMATS, DEFAULT_ANIMATED_FORMAT, build_gif_embed, content_type_for, transcode_gif
+)
 import mimetypes
+from http_fetcher import HttpFetcher
+from mdx_scanner import is_giphy_link, scan_mdx
+from perceptual_hash import MIN_CONFIRM_SSIM, PerceptualIndex, fingerprint, pixel_similarity
+from r2_uploader import R2UploadScheduler, content_hash, r2_client_config
+from spooled_body import SpooledBody
+from migration_state import MigrationState, MIGRATED, FAILED
+from content_watcher import watch_posts
+from post_selection import file_signatures, select_posts, stage_rewritten
+from sharding import DEFAULT_MANIFEST_DIR, Shard
+from lazy_import import lazy_import, load_dotenv
+from tracing import tracer
+
+boto3 = lazy_import('boto3')
+requests = lazy_import('requests')
+Image = lazy_import('PIL.Image')
 
 # Load environment variables
 load_dotenv()
 
+# Default width ladder for --srcset; the full-size image is always added on top
+DEFAULT_SRCSET_WIDTHS = (480, 960, 1440)
+
+# Blog content is laid out in a 640px column (Container.astro, max-w breakpoint-sm)
+DEFAULT_SRCSET_SIZES = "(max-width: 640px) 100vw, 640px"
+
+# R2 folder (under blogs/) for canonical copies of images used by several posts
+SHARED_FOLDER = "shared"
+
+def _prepare_for_avif(img: 'Image.Image') -> 'Image.Image':
+    """Flatten an image into a mode AVIF can encode"""
+    # Handle different image modes
+    if img.mode in ('RGBA', 'LA'):
+        # Images with transparency - composite on white background
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'RGBA':
+            background.paste(img, mask=img.split()[-1])
+        else:  # LA mode
+            background.paste(img.convert('RGBA'), mask=img.split()[-1])
+        return background
+    if img.mode not in ('RGB', 'L'):
+        # Convert other modes to RGB
+        return img.convert('RGB')
+    return img
+
+def _decode_for_avif(img: 'Image.Image', encoded_size: int) -> 'Image.Image':
+    """Decode an opened image and flatten it for AVIF, as one traced stage"""
+    with tracer.span('decode', bytes_in=encoded_size) as span:
+        img.load()
+        img = _prepare_for_avif(img)
+        span.bytes_out = img.width * img.height * len(img.getbands())
+        return img
+
+def _avif_quality(original_source: str) -> int:
+    """Optimize quality based on image type"""
+    if original_source.lower().endswith('.png'):
+        return 90  # Higher quality for graphics/screenshots
+    return 85  # High quality for photos
+
+def encode_image(image_data: bytes, original_source: str,
+                 target_ssim: Optional[float] = None) -> Tuple[bytes, str, Optional[dict]]:
+    """Convert image bytes to AVIF, or keep GIFs as-is.
+
+    Returns (data, content_type, metrics); metrics holds the AVIF quality used
+    and, with a target_ssim, the SSIM it achieved. Lives at module level so it
+    can run in ProcessPoolExecutor workers.
+    """
+    # Check if it's a GIF - preserve GIFs as-is
+    if original_source.lower().endswith('.gif'):
+        return image_data, 'image/gif', None
+    
+    # Convert other formats to AVIF, entirely in memory
+    try:
+        with Image.open(io.BytesIO(image_data)) as img:
+            img = _decode_for_avif(img, len(image_data))
+            encoding = encode_avif(img, _avif_quality(original_source), target_ssim=target_ssim)
+            return encoding.data, 'image/avif', encoding.metrics()
+                
+    except Exception as e:
+        print(f"    ✗ Error converting image to AVIF: {e}")
+        raise
+
+def encode_image_variants(image_data: bytes, original_source: str, widths: Tuple[int, ...],
+                          target_ssim: Optional[float] = None
+                          ) -> Tuple[List[Tuple[int, bytes]], Tuple[int, int], dict]:
+    """Decode an image once and encode it to AVIF at every width of the ladder.
+
+    Widths at or above the source width are dropped; the full-size encode is
+    always included last. The quality picked for the full-size image (searched
+    when target_ssim is set) is reused for the smaller variants.
+    Returns ([(width, avif_bytes), ...], (width, height), metrics).
+    """
+    try:
+        with Image.open(io.BytesIO(image_data)) as img:
+            img = _decode_for_avif(img, len(image_data))
+            full_width, full_height = img.size
+            full = encode_avif(img, _avif_quality(original_source), target_ssim=target_ssim)
+            
+            variants = []
+            for width in sorted(set(widths)):
+                if width >= full_width:
+                    break
+                height = max(1, round(full_height * width / full_width))
+                with tracer.span('resize'):
+                    resized = img.resize((width, height), Image.Resampling.LANCZOS)
+                variants.append((width, encode_avif(resized, full.quality).data))
+            variants.append((full_width, full.data))
+            
+            return variants, (full_width, full_height), full.metrics()
+                
+    except Exception as e:
+        print(f"    ✗ Error converting image to AVIF: {e}")
+        raise
+
+def build_srcset_tag(alt_text: str, variants: List[Tuple[int, str]], size: Tuple[int, int],
+                     sizes: str = DEFAULT_SRCSET_SIZES) -> str:
+    """Build a responsive <img> element from (width, url) pairs sorted by width"""
+    srcset = ", ".join(f"{url} {width}w" for width, url in variants)
+    alt = alt_text.replace('"', '&quot;')
+    return (
+        f'<img src="{variants[-1][1]}" srcset="{srcset}" sizes="{sizes}" '
+        f'width="{size[0]}" height="{size[1]}" alt="{alt}" loading="lazy" decoding="async" />'
+    )
+
+def run_inline(fn, *args) -> Future:
+    """Run fn on the calling thread and wrap its outcome in a completed Future"""
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
 class ImageToR2Migrator:
-    def __init__(self):
+    # Key under which this migrator's progress is stored in the state database
+    STATE_NAME = 'images'
+    
+    def __init__(self, jobs: Optional[int] = None, srcset_widths: Optional[Tuple[int, ...]] = None,
+                 target_ssim: Optional[float] = None, transcode_gifs: Optional[str] = None,
+                 dedupe: bool = False, shard: Optional[Shard] = None):
         self.blog_content_dir = Path("src/content/blog")
         self.project_root = Path.cwd()
-        self.r2_client = self._setup_r2_client()
         self.bucket_name = os.getenv("R2_BUCKET_NAME")
         self.r2_public_url = os.getenv("R2_PUBLIC_URL", f"https://{self.bucket_name}.r2.dev")
         
+        # Per-file record of what has already been migrated
+        self.state = MigrationState()
+        
+        # A shard only migrates part of each file, which must not be remembered as done
+        self.shard = shard or Shard()
+        if self.shard.active:
+            self.state.enabled = False
+        
+        # Pooled HTTP client shared by every remote image download
+        self.fetcher = HttpFetcher(headers={
+            'User-Agent': 'Mozilla/5.0 (compatible image downloader)'
+        })
+        
         # Supported image extensions
         self.image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg', '.bmp', '.tiff', '.tif'}
         
         if not self.bucket_name:
             raise ValueError("R2_BUCKET_NAME environment variable is required")
+        
+        # Uploads run concurrently in the background
+        self.uploader = R2UploadScheduler(self._setup_r2_client, self.bucket_name, self.r2_public_url)
+        
+        # Number of encoder processes; the pool only exists during migrate_all_posts
+        self.jobs = jobs or os.cpu_count() or 1
+        self.executor: Optional[Executor] = None
+        
+        # Width ladder for responsive variants; None keeps a single full-size AVIF
+        self.srcset_widths = srcset_widths
+        
+        # SSIM target for the per-image quality search; None keeps the fixed quality
+        self.target_ssim = target_ssim if target_ssim is not None else target_ssim_from_env()
+        
+        # Animated image format GIFs are transcoded to when there is no MP4; None preserves GIFs as-is
+        self.transcode_gifs = transcode_gifs
+        
+        # Near-duplicate source -> canonical source, filled by index_near_duplicates
+        self.dedupe = dedupe
+        self.near_duplicates: Dict[str, str] = {}
+        # Canonical source -> its queued uploads, reused by every later reference
+        self.shared_uploads: Dict[str, tuple] = {}
+        # Remote source -> its body, spooled to disk by index_near_duplicates so it is fetched once
+        self.prefetched: Dict[str, Path] = {}
+        self._prefetch_dir: Optional[tempfile.TemporaryDirectory] = None
     
     def _setup_r2_client(self):
         """Setup Cloudflare R2 client using boto3"""
@@ -74,37 +267,19 @@ class ImageToR2Migrator:
             endpoint_url=endpoint_url,
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key,
-            region_name='auto'
+            region_name='auto',
+            config=r2_client_config()
         )
     
     def find_image_references(self, file_path: Path) -> List[Tuple[str, str, str]]:
-        """Find all image references in a markdown file"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        image_references = []
-        
-        # Pattern 1: Markdown image syntax ![alt](src)
-        markdown_pattern = r'!\[([^\]]*)\]\(([^)]+)\)'
-        for match in re.finditer(markdown_pattern, content):
-            alt_text = match.group(1)
-            src = match.group(2)
-            full_match = match.group(0)
-            
-            if self._is_image_url(src):
-                image_references.append((full_match, alt_text, src))
-        
-        # Pattern 2: HTML img tags <img src="..." alt="..." />
-        html_pattern = r'<img[^>]+src=["\']([^"\']+)["\'][^>]*(?:alt=["\']([^"\']*)["\'][^>]*)?/?>'
-        for match in re.finditer(html_pattern, content, re.IGNORECASE):
-            src = match.group(1)
-            alt_text = match.group(2) if match.group(2) else ""
-            full_match = match.group(0)
-            
-            if self._is_image_url(src):
-                image_references.append((full_match, alt_text, src))
-        
-        return image_references
+        """Find all image references in a markdown file (outside code blocks)"""
+        return [
+            (ref.full_match, ref.alt_text, ref.src)
+            for ref in scan_mdx(file_path).image_refs
+            # Markdown Giphy links belong to the Giphy migrator; migrating them here too would make
+            # both rewrite the same reference (and their shard manifests overlap)
+            if self._is_image_url(ref.src) and not is_giphy_link(ref)
+        ]
     
     def _is_image_url(self, url: str) -> bool:
         """Check if URL points to an image"""
@@ -172,69 +347,70 @@ class ImageToR2Migrator:
         if image_source.startswith(('http://', 'https://')):
             # Download from URL
             try:
-                response = requests.get(image_source, timeout=30, headers={
-                    'User-Agent': 'Mozilla/5.0 (compatible image downloader)'
-                })
-                response.raise_for_status()
-                return response.content
+                return self.fetcher.fetch(image_source)
             except requests.RequestException as e:
                 print(f"    ✗ Error downloading {image_source}: {e}")
                 raise
         else:
             # Read from local file
             try:
-                with open(image_source, 'rb') as f:
-                    return f.read()
+                with tracer.span('read', asset=image_source) as span, open(image_source, 'rb') as f:
+                    data = f.read()
+                    span.bytes_out = len(data)
+                    return data
             except IOError as e:
                 print(f"    ✗ Error reading {image_source}: {e}")
                 raise
     
-    def process_image(self, image_data: bytes, original_source: str) -> Tuple[bytes, str]:
+    def process_image(self, image_data: bytes, original_source: str) -> Tuple[bytes, str, Optional[dict]]:
         """Process image - convert to AVIF or keep as GIF"""
-        # Check if it's a GIF - preserve GIFs as-is
-        if original_source.lower().endswith('.gif'):
-            return image_data, 'image/gif'
-        
-        # Convert other formats to AVIF
-        with tempfile.NamedTemporaryFile() as temp_input:
-            temp_input.write(image_data)
-            temp_input.flush()
-            
-            try:
-                with Image.open(temp_input.name) as img:
-                    # Handle different image modes
-                    if img.mode in ('RGBA', 'LA'):
-                        # Images with transparency - composite on white background
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        if img.mode == 'RGBA':
-                            background.paste(img, mask=img.split()[-1])
-                        else:  # LA mode
-                            background.paste(img.convert('RGBA'), mask=img.split()[-1])
-                        img = background
-                    elif img.mode not in ('RGB', 'L'):
-                        # Convert other modes to RGB
-                        img = img.convert('RGB')
-                    
-                    # Save as AVIF
-                    with tempfile.NamedTemporaryFile(suffix='.avif') as temp_output:
-                        # Optimize quality based on image type
-                        quality = 85  # High quality for photos
-                        if original_source.lower().endswith('.png'):
-                            quality = 90  # Higher quality for graphics/screenshots
-                        
-                        img.save(temp_output.name, 'AVIF', quality=quality, speed=6)
-                        
-                        with open(temp_output.name, 'rb') as f:
-                            return f.read(), 'image/avif'
-                            
-            except Exception as e:
-                print(f"    ✗ Error converting image to AVIF: {e}")
-                raise
+        return encode_image(image_data, original_source, self.target_ssim)
+    
+    def submit_process_image(self, image_data: bytes, original_source: str) -> Future:
+        """Schedule process_image on the encoder pool (or run it inline without one)"""
+        if self.executor is not None and not original_source.lower().endswith('.gif'):
+            return tracer.submit(self.executor, encode_image, image_data, original_source, self.target_ssim)
+        
+        return run_inline(self.process_image, image_data, original_source)
     
-    def generate_filename(self, original_source: str, alt_text: str, is_gif: bool = False) -> str:
-        """Generate a unique filename for the image"""
-        # Create a hash of the original source for uniqueness
-        source_hash = hashlib.md5(original_source.encode()).hexdigest()[:8]
+    def submit_process_variants(self, image_data: bytes, original_source: str) -> Future:
+        """Schedule the srcset ladder encode of one image on the encoder pool"""
+        args = (encode_image_variants, image_data, original_source, self.srcset_widths, self.target_ssim)
+        if self.executor is not None:
+            return tracer.submit(self.executor, *args)
+        
+        return run_inline(*args)
+    
+    def submit_transcode_gif(self, gif_data: bytes) -> Future:
+        """Schedule the MP4 or animated WebP/AVIF transcode of a GIF on the encoder pool"""
+        if self.executor is not None:
+            return tracer.submit(self.executor, transcode_gif, gif_data, self.transcode_gifs)
+        
+        return run_inline(transcode_gif, gif_data, self.transcode_gifs)
+    
+    def submit_download_or_read_image(self, image_source: str) -> Future:
+        """Start downloading a remote image in the background; local files are read inline"""
+        # Bodies the --dedupe pass already downloaded are read back from disk
+        prefetched = self.prefetched.get(image_source)
+        if prefetched is not None:
+            return run_inline(self.download_or_read_image, str(prefetched))
+        
+        if image_source.startswith(('http://', 'https://')):
+            # Untouched GIFs are streamed straight through to R2
+            if image_source.lower().endswith('.gif') and not self.transcode_gifs:
+                return self.fetcher.submit_stream(image_source)
+            return self.fetcher.submit(image_source)
+        
+        return run_inline(self.download_or_read_image, image_source)
+    
+    def generate_filename(self, original_source: str, alt_text: str, content: Union[bytes, SpooledBody],
+                          extension: str = '.avif') -> str:
+        """Generate a content-addressed filename for the bytes that will be uploaded
+
+        `extension` is the tail after the hash, e.g. '.gif' or '.mp4'.
+        """
+        # Name the object after its bytes: edits get a new key, identical bytes share one
+        source_hash = content_hash(content)
         
         # Extract original filename
         if original_source.startswith(('http://', 'https://')):
@@ -250,9 +426,6 @@ class ImageToR2Migrator:
         clean_alt = re.sub(r'[^a-zA-Z0-9\s\-_]', '', alt_text)
         clean_alt = re.sub(r'\s+', '-', clean_alt.strip())[:30]
         
-        # Choose extension based on whether it's a GIF or not
-        extension = '.gif' if is_gif else '.avif'
-        
         # Construct filename
         if clean_alt and clean_alt != clean_name:
             filename = f"{clean_alt}-{clean_name}-{source_hash}{extension}"
@@ -267,36 +440,37 @@ class ImageToR2Migrator:
         
         return filename
     
+    def submit_upload_to_r2(self, image_data: Union[bytes, SpooledBody], blog_folder: str, filename: str,
+                            content_type: str) -> Future:
+        """Queue an image upload to R2; the Future resolves to the public URL"""
+        key = f"blogs/{blog_folder}/{filename}"
+        return self.uploader.submit(key, image_data, content_type)
+    
     def upload_to_r2(self, image_data: bytes, blog_folder: str, filename: str, content_type: str) -> str:
         """Upload image to R2 and return the public URL"""
-        key = f"blogs/{blog_folder}/{filename}"
-        
+        from botocore.exceptions import ClientError
         try:
-            self.r2_client.put_object(
-                Bucket=self.bucket_name,
-                Key=key,
-                Body=image_data,
-                ContentType=content_type,
-                CacheControl='public, max-age=31536000'  # Cache for 1 year
-            )
-            
-            # Return the public URL
-            return f"{self.r2_public_url}/{key}"
-            
+            return self.submit_upload_to_r2(image_data, blog_folder, filename, content_type).result()
         except ClientError as e:
             print(f"    ✗ Error uploading to R2: {e}")
             raise
     
-    def replace_image_references_in_file(self, file_path: Path, replacements: Dict[str, str]):
-        """Replace image references with R2 URLs in the markdown file"""
+    def replace_image_references_in_file(self, file_path: Path, replacements: Dict[str, str],
+                                         elements: Optional[Dict[str, str]] = None):
+        """Replace image references with R2 URLs in the markdown file
+
+        `elements` maps whole references to replacement markup (srcset <img> tags).
+        """
         with open(file_path, 'r', encoding='utf-8') as f:
             content = f.read()
         
-        # Replace each original reference with the corresponding R2 URL
+        # Replace the source of each original reference, ![alt](src) or <img src="...">, with its R2 URL
         for original_ref, r2_url in replacements.items():
-            content = content.replace(original_ref, original_ref.replace(
-                re.search(r'\(([^)]+)\)', original_ref).group(1), r2_url
-            ))
+            source = re.search(r'\(([^)]+)\)', original_ref) or re.search(r'src=["\']([^"\']+)["\']', original_ref)
+            content = content.replace(original_ref, original_ref.replace(source.group(1), r2_url))
+        
+        for original_ref, element in (elements or {}).items():
+            content = content.replace(original_ref, element)
         
         # Write back to file
         with open(file_path, 'w', encoding='utf-8') as f:
@@ -312,10 +486,16 @@ class ImageToR2Migrator:
             print(f"  No index.mdx found in {blog_path}")
             return 0
         
+        # Skip files that have not changed since they were fully migrated
+        if self.state.is_unchanged(self.STATE_NAME, mdx_file):
+            print(f"  Unchanged since last migration")
+            return 0
+        
         # Find image references
         image_refs = self.find_image_references(mdx_file)
         if not image_refs:
             print(f"  No images found")
+            self.state.record(self.STATE_NAME, mdx_file, [])
             return 0
         
         print(f"  Found {len(image_refs)} images")
@@ -323,80 +503,426 @@ class ImageToR2Migrator:
         # Use blog folder name for R2 organization
         blog_folder = blog_path.name
         replacements = {}
-        
+        elements = {}
+        outcomes = []
+        downloads = []
+        pending = []
+        reused = []
+        claimed = set()
+        
+        # Resolve every image and start all remote downloads at once
         for full_match, alt_text, image_src in image_refs:
-            try:
-                print(f"    Processing: {image_src}")
-                
+            # Assets of other shards are left for their runners
+            if not self.shard.owns(blog_folder, image_src):
+                continue
+            
+            print(f"    Processing: {image_src}")
+            
+            with tracer.context(asset=image_src):
                 # Resolve image path
-                resolved_source = self.resolve_image_path(image_src, blog_path)
+                with tracer.span('resolve'):
+                    resolved_source = self.resolve_image_path(image_src, blog_path)
                 if not resolved_source:
+                    outcomes.append((image_src, FAILED, 'unresolved'))
                     continue
                 
+                # Near-duplicates share the canonical copy's single encode and upload
+                canonical = self.near_duplicates.get(resolved_source)
+                if canonical is not None:
+                    if canonical in self.shared_uploads or canonical in claimed:
+                        print(f"    Near-duplicate of {canonical}, reusing its upload")
+                        reused.append((full_match, alt_text, image_src, canonical))
+                        continue
+                    claimed.add(canonical)
+                    resolved_source = canonical
+                
                 # Download or read image
-                image_data = self.download_or_read_image(resolved_source)
+                download = self.submit_download_or_read_image(resolved_source)
+            downloads.append((full_match, alt_text, image_src, resolved_source, download))
+        
+        # Fan the encoding out to the worker pool as downloads complete
+        for full_match, alt_text, image_src, resolved_source, download in downloads:
+            try:
+                image_data = download.result()
                 
-                # Process image (convert to AVIF or keep as GIF)
-                processed_data, content_type = self.process_image(image_data, resolved_source)
+                # Process image (convert to AVIF or keep as GIF); one decode per srcset ladder
+                is_gif = resolved_source.lower().endswith('.gif')
+                with tracer.context(asset=image_src):
+                    if is_gif and self.transcode_gifs:
+                        future = self.submit_transcode_gif(image_data)
+                    elif self.srcset_widths and not is_gif:
+                        future = self.submit_process_variants(image_data, resolved_source)
+                    else:
+                        future = self.submit_process_image(image_data, resolved_source)
+                pending.append((full_match, alt_text, image_src, resolved_source, image_data, future))
                 
+            except Exception as e:
+                print(f"    ✗ Failed to migrate {image_src}: {e}")
+                outcomes.append((image_src, FAILED, str(e)))
+                continue
+        
+        # Collect results in reference order so replacements stay deterministic
+        uploads = []
+        for full_match, alt_text, image_src, resolved_source, image_data, future in pending:
+            try:
                 # Check if it's a GIF
                 is_gif = resolved_source.lower().endswith('.gif')
+                # Shared copies are named after their source alone, not one post's alt text
+                shared = resolved_source in self.near_duplicates
+                folder, name_alt = (SHARED_FOLDER, '') if shared else (blog_folder, alt_text)
                 
-                # Generate filename
-                filename = self.generate_filename(resolved_source, alt_text, is_gif)
+                renditions = future.result() if is_gif and self.transcode_gifs else None
+                if renditions is not None and renditions.any:
+                    # The original GIF stays as fallback next to the lighter renditions
+                    files = [('gif', image_data, '.gif', 'image/gif')]
+                    if renditions.image is not None:
+                        files.append((renditions.image_ext, renditions.image, f".{renditions.image_ext}",
+                                      content_type_for(renditions.image_ext)))
+                    if renditions.mp4 is not None:
+                        files.append(('mp4', renditions.mp4, '.mp4', 'video/mp4'))
+                    
+                    rendition_uploads = []
+                    for label, data, extension, content_type in files:
+                        name = self.generate_filename(resolved_source, name_alt, data, extension)
+                        print(f"    Uploading as: {name} ({label.upper()}, {len(data)} bytes)")
+                        rendition_uploads.append(
+                            (label, self.submit_upload_to_r2(data, folder, name, content_type))
+                        )
+                    uploads.append((full_match, alt_text, image_src, rendition_uploads,
+                                    ('gif', renditions), renditions.metrics(len(image_data))))
+                    continue
+                
+                if self.srcset_widths and not is_gif:
+                    variants, size, metrics = future.result()
+                    
+                    # Full size is named after its own bytes; smaller widths reuse that name with a
+                    # -<width>w suffix, so every variant's key follows from the full-size key
+                    full_name = self.generate_filename(resolved_source, name_alt, variants[-1][1])
+                    variant_uploads = []
+                    for width, variant_data in variants:
+                        variant_name = full_name if width == size[0] else f"{Path(full_name).stem}-{width}w.avif"
+                        print(f"    Uploading as: {variant_name} (AVIF {width}w)")
+                        variant_uploads.append(
+                            (width, self.submit_upload_to_r2(variant_data, folder, variant_name, 'image/avif'))
+                        )
+                    uploads.append((full_match, alt_text, image_src, variant_uploads, ('srcset', size), metrics))
+                    continue
+                
+                if renditions is not None:
+                    # Nothing beat the GIF; keep it as the only file
+                    processed_data, content_type, metrics = image_data, 'image/gif', renditions.metrics(len(image_data))
+                else:
+                    processed_data, content_type, metrics = future.result()
                 format_info = "GIF (preserved)" if is_gif else "AVIF"
+                filename = self.generate_filename(resolved_source, name_alt, processed_data,
+                                                  '.gif' if is_gif else '.avif')
                 print(f"    Uploading as: {filename} ({format_info})")
                 
-                # Upload to R2
-                r2_url = self.upload_to_r2(processed_data, blog_folder, filename, content_type)
-                replacements[full_match] = r2_url
-                
-                print(f"    ✓ Migrated to: {r2_url}")
+                # Upload to R2 in the background
+                upload = self.submit_upload_to_r2(processed_data, folder, filename, content_type)
+                uploads.append((full_match, alt_text, image_src, [(None, upload)], ('single', None), metrics))
                 
             except Exception as e:
                 print(f"    ✗ Failed to migrate {image_src}: {e}")
+                outcomes.append((image_src, FAILED, str(e)))
                 continue
         
+        # Canonical copies encoded here serve every near-duplicate, in this post and later ones
+        sources = {full_match: resolved_source for full_match, _, _, resolved_source, _, _ in pending}
+        for entry in uploads:
+            if sources[entry[0]] in self.near_duplicates:
+                self.shared_uploads.setdefault(sources[entry[0]], entry[3:])
+        
+        for full_match, alt_text, image_src, canonical in reused:
+            if canonical in self.shared_uploads:
+                uploads.append((full_match, alt_text, image_src, *self.shared_uploads[canonical]))
+            else:
+                outcomes.append((image_src, FAILED, f'near-duplicate of failed {canonical}'))
+        
+        # Only rewrite the file once every upload of the post has been confirmed
+        for full_match, alt_text, image_src, variant_uploads, (embed, layout), metrics in uploads:
+            try:
+                urls = [(label, upload.result()) for label, upload in variant_uploads]
+                
+                if embed == 'gif':
+                    links = dict(urls)
+                    r2_url = links['gif']
+                    elements[full_match] = build_gif_embed(
+                        alt_text, r2_url, links.get(layout.image_ext), layout.image_ext, links.get('mp4'), layout.size
+                    )
+                    print(f"    ✓ Migrated to: {r2_url} (+{', '.join(label for label, _ in urls[1:])})")
+                elif len(urls) > 1:
+                    r2_url = urls[-1][1]
+                    elements[full_match] = build_srcset_tag(alt_text, urls, layout)
+                    print(f"    ✓ Migrated to: {r2_url} (+{len(urls) - 1} srcset variants)")
+                else:
+                    # Nothing to choose between (e.g. image narrower than the ladder)
+                    r2_url = urls[-1][1]
+                    replacements[full_match] = r2_url
+                    print(f"    ✓ Migrated to: {r2_url}")
+                
+                outcomes.append((image_src, MIGRATED, r2_url, metrics))
+            except Exception as e:
+                print(f"    ✗ Failed to migrate {image_src}: {e}")
+                outcomes.append((image_src, FAILED, str(e)))
+        
         # Replace image references in the file
-        if replacements:
-            self.replace_image_references_in_file(mdx_file, replacements)
-            print(f"  ✓ Updated {len(replacements)} images in {mdx_file}")
+        if replacements or elements:
+            with tracer.span('rewrite', asset=str(mdx_file)):
+                self.replace_image_references_in_file(mdx_file, replacements, elements)
+            print(f"  ✓ Updated {len(replacements) + len(elements)} images in {mdx_file}")
         
-        return len(replacements)
+        self.state.record(self.STATE_NAME, mdx_file, outcomes)
+        return len(replacements) + len(elements)
+    
+    def _bounded_downloads(self, sources: List[str]) -> Iterator[Tuple[str, Future]]:
+        """Download futures of every source in order, with at most one fetch window in flight"""
+        in_flight = deque()
+        for source in sources:
+            if source.startswith(('http://', 'https://')):
+                in_flight.append((source, self.fetcher.submit(source)))
+            else:
+                in_flight.append((source, run_inline(self.download_or_read_image, source)))
+            if len(in_flight) >= self.fetcher.max_connections:
+                yield in_flight.popleft()
+        while in_flight:
+            yield in_flight.popleft()
     
-    def migrate_all_posts(self):
+    @staticmethod
+    def _add_fingerprint(index: PerceptualIndex, source: str, future: Future):
+        try:
+            index.add(source, future.result())
+        except Exception:
+            pass  # Not decodable by Pillow (e.g. SVG); migrated on its own
+    
+    def _confirm_near_duplicate(self, source: str, canonical: str) -> bool:
+        """Pixel check of a hash match, on the spooled bodies (or local files) of both images"""
+        try:
+            similarity = pixel_similarity(
+                self.download_or_read_image(str(self.prefetched.get(source, source))),
+                self.download_or_read_image(str(self.prefetched.get(canonical, canonical)))
+            )
+        except Exception:
+            return False
+        if similarity < MIN_CONFIRM_SSIM:
+            print(f"  {source} only looks like {canonical} (SSIM {similarity:.3f}); migrating it on its own")
+            return False
+        return True
+    
+    def index_near_duplicates(self, blog_posts: List[Path]):
+        """Fingerprint the images of every post due for migration and map near-duplicates to a canonical source"""
+        sources = []
+        for blog_path in blog_posts:
+            mdx_file = blog_path / "index.mdx"
+            if not mdx_file.exists() or self.state.is_unchanged(self.STATE_NAME, mdx_file):
+                continue
+            for _, _, image_src in self.find_image_references(mdx_file):
+                resolved_source = self.resolve_image_path(image_src, blog_path)
+                if resolved_source and resolved_source not in sources:
+                    sources.append(resolved_source)
+        
+        # Only the hashes stay in memory: each remote body is spooled to disk for the upload and
+        # dropped once it is fingerprinted, and at most one fetch window of downloads and one
+        # fingerprint per encoder hold a body at any time
+        self._prefetch_dir = tempfile.TemporaryDirectory(prefix='image-dedupe-')
+        index = PerceptualIndex()
+        fingerprints = deque()
+        for source, download in self._bounded_downloads(sources):
+            try:
+                image_data = download.result()
+            except Exception:
+                continue  # Reported again when the post itself is migrated
+            if source.startswith(('http://', 'https://')):
+                body_path = Path(self._prefetch_dir.name) / str(len(self.prefetched))
+                body_path.write_bytes(image_data)
+                self.prefetched[source] = body_path
+            with tracer.context(asset=source):
+                if self.executor is not None:
+                    fingerprints.append((source, tracer.submit(self.executor, fingerprint, image_data)))
+                else:
+                    fingerprints.append((source, run_inline(fingerprint, image_data)))
+            
+            if len(fingerprints) > self.jobs:
+                self._add_fingerprint(index, *fingerprints.popleft())
+        while fingerprints:
+            self._add_fingerprint(index, *fingerprints.popleft())
+        
+        self.near_duplicates = index.duplicates(self._confirm_near_duplicate)
+        groups = len(set(self.near_duplicates.values()))
+        print(f"Fingerprinted {len(index)} images: {len(self.near_duplicates)} near-duplicates "
+              f"in {groups} group(s) will share one upload each in blogs/{SHARED_FOLDER}/")
+    
+    def migrate_all_posts(self, blog_posts: Optional[List[Path]] = None):
         """Migrate images in all blog posts"""
         if not self.blog_content_dir.exists():
             print(f"Blog content directory not found: {self.blog_content_dir}")
             return
         
         total_migrated = 0
-        blog_posts = [d for d in self.blog_content_dir.iterdir() if d.is_dir()]
+        if blog_posts is None:
+            blog_posts = [d for d in self.blog_content_dir.iterdir() if d.is_dir()]
         
         print(f"Found {len(blog_posts)} blog posts to process")
+        print(f"Encoding with {self.jobs} worker process(es)")
+        if self.target_ssim:
+            print(f"Searching AVIF quality per image for SSIM >= {self.target_ssim}")
+        if self.transcode_gifs:
+            print(f"Transcoding GIFs to MP4, or to animated {self.transcode_gifs.upper()} where there is no MP4")
+        if self.srcset_widths:
+            print(f"Generating srcset variants at widths: {', '.join(map(str, self.srcset_widths))} + full size")
         print("-" * 50)
         
-        for blog_path in blog_posts:
-            try:
-                migrated_count = self.process_blog_post(blog_path)
-                total_migrated += migrated_count
-            except Exception as e:
-                print(f"Error processing {blog_path}: {e}")
-                continue
+        if self.jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(max_workers=self.jobs)
+        
+        try:
+            if self.dedupe:
+                self.index_near_duplicates(blog_posts)
+                print()
             
-            print()
+            for blog_path in blog_posts:
+                try:
+                    with tracer.context(post=blog_path.name), self.shard.recording(blog_path / "index.mdx"):
+                        migrated_count = self.process_blog_post(blog_path)
+                    total_migrated += migrated_count
+                except Exception as e:
+                    print(f"Error processing {blog_path}: {e}")
+                    continue
+                
+                print()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            if self._prefetch_dir is not None:
+                self._prefetch_dir.cleanup()
+                self._prefetch_dir = None
+                self.prefetched.clear()
         
         print("-" * 50)
         print(f"Migration complete! Total images migrated: {total_migrated}")
+        print(self.uploader.summary())
+        print(self.fetcher.summary())
 
 def main():
     """Main function"""
+    parser = argparse.ArgumentParser(description="Migrate blog images to AVIF in R2")
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of parallel AVIF encoder processes (default: CPU count)'
+    )
+    
+    parser.add_argument(
+        '--srcset',
+        nargs='?',
+        const=','.join(str(w) for w in DEFAULT_SRCSET_WIDTHS),
+        metavar='WIDTHS',
+        help='Also upload resized variants and rewrite references to <img srcset> '
+             f'(comma-separated widths, default: {",".join(str(w) for w in DEFAULT_SRCSET_WIDTHS)})'
+    )
+    
+    parser.add_argument(
+        '--target-ssim',
+        type=float,
+        default=None,
+        help='Pick the lowest AVIF quality per image whose SSIM meets this target, e.g. 0.98 '
+             '(default: AVIF_TARGET_SSIM, or fixed quality 85/90)'
+    )
+    
+    parser.add_argument(
+        '--transcode-gifs',
+        nargs='?',
+        const=DEFAULT_ANIMATED_FORMAT,
+        choices=sorted(ANIMATED_FORMATS),
+        help='Also upload GIFs as an MP4 (or an animated image without one) and embed them with a '
+             f'<video>/<picture> element that falls back to the GIF (default format: {DEFAULT_ANIMATED_FORMAT})'
+    )
+    
+    parser.add_argument(
+        '--dedupe',
+        action='store_true',
+        help=f'Fingerprint all images first and upload near-duplicates across posts once, '
+             f'to blogs/{SHARED_FOLDER}/'
+    )
+    
+    parser.add_argument(
+        'files',
+        nargs='*',
+        metavar='MDX_FILE',
+        help='Only migrate the posts of these index.mdx files, e.g. the staged ones (default: all posts)'
+    )
+    
+    parser.add_argument(
+        '--stage',
+        action='store_true',
+        help='git add the MDX files this run rewrote'
+    )
+    
+    parser.add_argument(
+        '--shard',
+        type=Shard.parse,
+        metavar='I/N',
+        help='Only migrate shard I of N (0-based) and record the MDX rewrites in a manifest '
+             'for merge_shards.py instead of applying them'
+    )
+    
+    parser.add_argument(
+        '--shard-manifest',
+        metavar='PATH',
+        help=f'Where to write the shard manifest (default: {DEFAULT_MANIFEST_DIR}/<migrator>-<i>-of-<n>.json)'
+    )
+    
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='After migrating, keep running and migrate the new assets of every saved index.mdx'
+    )
+    
+    parser.add_argument(
+        '--trace',
+        metavar='PATH',
+        help='Record per-stage spans and write them to PATH as Chrome trace JSON, '
+             'plus a p50/p95/max summary (default: MIGRATION_TRACE)'
+    )
+    
+    args = parser.parse_args()
+    tracer.start(args.trace)
+    
+    srcset_widths = None
+    if args.srcset:
+        srcset_widths = tuple(int(w) for w in args.srcset.split(',') if w.strip())
+    
     try:
-        migrator = ImageToR2Migrator()
-        migrator.migrate_all_posts()
+        migrator = ImageToR2Migrator(
+            jobs=args.jobs,
+            srcset_widths=srcset_widths,
+            target_ssim=args.target_ssim,
+            transcode_gifs=args.transcode_gifs,
+            dedupe=args.dedupe,
+            shard=args.shard
+        )
+        blog_posts = select_posts(migrator.blog_content_dir, args.files)
+        before = file_signatures(blog_posts)
+        migrator.migrate_all_posts(blog_posts)
+        if args.stage:
+            stage_rewritten(before)
+        if migrator.shard.active:
+            manifest = migrator.shard.write_manifest(migrator.STATE_NAME, args.shard_manifest)
+            print(f"Shard {migrator.shard} manifest: {manifest}")
+        if args.watch:
+            watch_posts([migrator])
+        migrator.fetcher.close()
+        migrator.uploader.close()
     except Exception as e:
         print(f"Error: {e}")
         return 1
+    finally:
+        trace_summary = tracer.finish()
+        if trace_summary:
+            print(trace_summary)
     
     return 0
 
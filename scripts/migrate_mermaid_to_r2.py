@@ -5,6 +5,7 @@ Script to migrate Mermaid diagrams from blog posts to AVIF images in Cloudflare
 This script:
 1. Scans all blog posts for Mermaid code blocks
 2. Converts Mermaid diagrams to AVIF images using mermaid-cli
+   (all uncached diagrams of the corpus are rendered in a single mmdc session)
 3. Uploads them to Cloudflare R2 with organized folder structure
 4. Replaces the original Mermaid blocks with image links
 
@@ -15,7 +16,7 @@ Requirements:
 - mermaid-cli (npm package for rendering)
 
 Usage:
-    python migrate_mermaid_to_r2.py
+    python migrate_mermaid_to_r2.py [--watch] [--trace PATH] [--stage] [--shard I/N] [MDX_FILE ...]
 
 Environment variables required:
 - R2_ACCESS_KEY_ID
@@ -26,32 +27,70 @@ Environment variables required:
 """
 
 import os
+import argparse
 import re
-import hashlib
 import subprocess
 import tempfile
+from concurrent.futures import Future
+from functools import cached_property
 from pathlib import Path
-from typing import List, Dict, Tuple
-import boto3
-from botocore.exceptions import ClientError
-from dotenv import load_dotenv
-from PIL import Image
+from typing import List, Dict, Optional, Tuple
+from render_cache import RenderCache
+from image_quality import AvifEncoding, encode_avif, target_ssim_from_env
+from diagram_postprocess import POSTPROCESS_VERSION, round_and_flatten
+from mdx_scanner import scan_mdx
+from r2_uploader import R2UploadScheduler, content_hash, r2_client_config
+from migration_state import MigrationState, MIGRATED, FAILED
+from content_watcher import watch_posts
+from post_selection import file_signatures, select_posts, stage_rewritten
+from sharding import DEFAULT_MANIFEST_DIR, Shard
+from lazy_import import lazy_import, load_dotenv
+from tracing import tracer
+
+boto3 = lazy_import('boto3')
 
 # Load environment variables
 load_dotenv()
 
+# mermaid-cli flags and post-processing parameters; both are part of the render cache key
+MERMAID_RENDER_FLAGS = [
+    '-t', 'neutral',     # Neutral theme (works well with transparent background)
+    '-b', 'transparent', # Transparent background
+    '--scale', '2',      # Higher resolution
+]
+POSTPROCESS_PARAMS = {'padding': 10, 'radius': 8, 'quality': 85, 'speed': 6, 'version': POSTPROCESS_VERSION}
+
 class MermaidToR2Migrator:
-    def __init__(self):
+    # Key under which this migrator's progress is stored in the state database
+    STATE_NAME = 'mermaid'
+    
+    def __init__(self, shard: Optional[Shard] = None):
         self.blog_content_dir = Path("src/content/blog")
-        self.r2_client = self._setup_r2_client()
         self.bucket_name = os.getenv("R2_BUCKET_NAME")
         self.r2_public_url = os.getenv("R2_PUBLIC_URL", f"https://{self.bucket_name}.r2.dev")
         
         if not self.bucket_name:
             raise ValueError("R2_BUCKET_NAME environment variable is required")
         
-        # Check if mermaid-cli is available
-        self._check_mermaid_cli()
+        # Uploads run concurrently in the background
+        self.uploader = R2UploadScheduler(self._setup_r2_client, self.bucket_name, self.r2_public_url)
+        
+        # Per-file record of what has already been migrated
+        self.state = MigrationState()
+        
+        # A shard only migrates part of each file, which must not be remembered as done
+        self.shard = shard or Shard()
+        if self.shard.active:
+            self.state.enabled = False
+        
+        # Cache of final AVIF bytes keyed on diagram source and render settings
+        self.render_cache = RenderCache()
+        
+        # Optional SSIM target replacing the fixed AVIF quality
+        self.target_ssim = target_ssim_from_env()
+        self.postprocess_params = POSTPROCESS_PARAMS
+        if self.target_ssim:
+            self.postprocess_params = dict(POSTPROCESS_PARAMS, target_ssim=self.target_ssim)
     
     def _setup_r2_client(self):
         """Setup Cloudflare R2 client using boto3"""
@@ -67,13 +106,20 @@ class MermaidToR2Migrator:
             endpoint_url=endpoint_url,
             aws_access_key_id=access_key,
             aws_secret_access_key=secret_key,
-            region_name='auto'
+            region_name='auto',
+            config=r2_client_config()
         )
     
-    def _check_mermaid_cli(self):
-        """Check if mermaid-cli (mmdc) is available"""
+    @cached_property
+    def mmdc_version(self) -> str:
+        """mermaid-cli version, probed on the first diagram that needs a cache key"""
+        return self._check_mermaid_cli()
+    
+    def _check_mermaid_cli(self) -> str:
+        """Check if mermaid-cli (mmdc) is available and return its version"""
         try:
-            subprocess.run(['mmdc', '--version'], capture_output=True, check=True)
+            result = subprocess.run(['mmdc', '--version'], capture_output=True, check=True, text=True)
+            return result.stdout.strip()
         except (subprocess.CalledProcessError, FileNotFoundError):
             raise RuntimeError(
                 "mermaid-cli not found. Please install it with: npm install -g @mermaid-js/mermaid-cli"
@@ -81,121 +127,144 @@ class MermaidToR2Migrator:
     
     def find_mermaid_blocks(self, file_path: Path) -> List[Tuple[str, int, int]]:
         """Find all Mermaid code blocks in a markdown file"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Find all mermaid code blocks with their positions
-        mermaid_blocks = []
-        lines = content.split('\n')
-        
-        i = 0
-        while i < len(lines):
-            if lines[i].strip() == '```mermaid':
-                start_line = i
-                i += 1
-                mermaid_code = []
-                
-                # Find the end of the code block
-                while i < len(lines) and lines[i].strip() != '```':
-                    mermaid_code.append(lines[i])
-                    i += 1
-                
-                if i < len(lines):  # Found closing ```
-                    end_line = i
-                    mermaid_blocks.append(('\n'.join(mermaid_code), start_line, end_line))
-                
-            i += 1
-        
-        return mermaid_blocks
+        return [
+            (block.code, block.start_line, block.end_line)
+            for block in scan_mdx(file_path).mermaid_blocks
+        ]
     
-    def render_mermaid_to_png(self, mermaid_code: str) -> str:
-        """Render Mermaid code directly to PNG using mermaid-cli"""
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.mmd', delete=False) as mmd_file:
-            mmd_file.write(mermaid_code)
-            mmd_file_path = mmd_file.name
-        
-        png_file_path = mmd_file_path.replace('.mmd', '.png')
-        
-        try:
-            # Use mermaid-cli to render PNG with neutral theme and transparent background
-            subprocess.run([
-                'mmdc',
-                '-i', mmd_file_path,
-                '-o', png_file_path,
-                '-t', 'neutral',     # Neutral theme (works well with transparent background)
-                '-b', 'transparent', # Transparent background
-                '--scale', '2'       # Higher resolution
-            ], check=True, capture_output=True)
+    def render_mermaid_to_png(self, mermaid_code: str) -> bytes:
+        """Render Mermaid code directly to PNG bytes using mermaid-cli"""
+        with tempfile.TemporaryDirectory(prefix='mermaid-render-') as temp_dir:
+            mmd_file_path = os.path.join(temp_dir, 'diagram.mmd')
+            png_file_path = os.path.join(temp_dir, 'diagram.png')
             
-            return png_file_path
+            with open(mmd_file_path, 'w', encoding='utf-8') as mmd_file:
+                mmd_file.write(mermaid_code)
             
-        except subprocess.CalledProcessError as e:
-            print(f"Error rendering Mermaid diagram: {e}")
-            raise
-        finally:
-            # Clean up mermaid file
-            if os.path.exists(mmd_file_path):
-                os.unlink(mmd_file_path)
+            try:
+                # Use mermaid-cli to render PNG with neutral theme and transparent background
+                subprocess.run([
+                    'mmdc',
+                    '-i', mmd_file_path,
+                    '-o', png_file_path,
+                    *MERMAID_RENDER_FLAGS
+                ], check=True, capture_output=True)
+                
+            except subprocess.CalledProcessError as e:
+                print(f"Error rendering Mermaid diagram: {e}")
+                raise
+            
+            # Read the PNG straight from the renderer output; the directory is removed on exit
+            with open(png_file_path, 'rb') as f:
+                return f.read()
     
-    def add_rounded_corners_and_convert_to_avif(self, png_path: str) -> bytes:
-        """Add rounded corners to PNG and convert to AVIF format (no borders)"""
-        avif_path = png_path.replace('.png', '.avif')
+    def render_mermaid_batch_to_png(self, mermaid_codes: List[str]) -> Optional[List[bytes]]:
+        """Render several Mermaid diagrams in one mmdc session (one headless browser)
 
-        try:
-            with Image.open(png_path) as img:
-                # Ensure RGBA mode for transparency handling
-                if img.mode != 'RGBA':
-                    img = img.convert('RGBA')
-
-                # Add minimal padding
-                padding = 10
-                new_width = img.width + (padding * 2)
-                new_height = img.height + (padding * 2)
-
-                # Create new image with padding
-                padded_img = Image.new('RGBA', (new_width, new_height), (0, 0, 0, 0))
-                padded_img.paste(img, (padding, padding))
-
-                # Create rounded rectangle mask
-                mask = Image.new('L', (new_width, new_height), 0)
-                from PIL import ImageDraw
-                draw = ImageDraw.Draw(mask)
-
-                # Draw rounded rectangle (radius = 8px, smaller radius)
-                radius = 8
-                draw.rounded_rectangle(
-                    [(0, 0), (new_width, new_height)],
-                    radius=radius,
-                    fill=255
-                )
-
-                # Apply mask to create rounded corners
-                rounded_img = Image.new('RGBA', (new_width, new_height), (0, 0, 0, 0))
-                rounded_img.paste(padded_img, (0, 0))
-                rounded_img.putalpha(mask)
-
-                # Convert to RGB with white background for AVIF (no border)
-                background = Image.new('RGB', rounded_img.size, (255, 255, 255))
-                background.paste(rounded_img, mask=rounded_img.split()[-1])
-
-                background.save(avif_path, 'AVIF', quality=85, speed=6)
-
-            # Read AVIF data
-            with open(avif_path, 'rb') as f:
-                avif_data = f.read()
+        mmdc renders every mermaid fence of a markdown input to `<output>-<n>.png`,
+        so the diagrams are written into one markdown file and mapped back by position.
+        That naming is not documented, so the PNGs are only trusted if there is
+        exactly one per diagram; otherwise None is returned.
+        """
+        with tempfile.TemporaryDirectory(prefix='mermaid-batch-') as output_dir:
+            return self._render_mermaid_batch(mermaid_codes, output_dir)
+    
+    def _render_mermaid_batch(self, mermaid_codes: List[str], output_dir: str) -> Optional[List[bytes]]:
+        md_path = os.path.join(output_dir, 'batch.md')
+        with open(md_path, 'w', encoding='utf-8') as md_file:
+            for mermaid_code in mermaid_codes:
+                md_file.write(f"```mermaid\n{mermaid_code}\n```\n\n")
+        
+        output_path = os.path.join(output_dir, 'batch.png')
+        subprocess.run([
+            'mmdc',
+            '-i', md_path,
+            '-o', output_path,
+            *MERMAID_RENDER_FLAGS
+        ], check=True, capture_output=True)
+        
+        png_paths = [os.path.join(output_dir, f"batch-{n}.png") for n in range(1, len(mermaid_codes) + 1)]
+        outputs = [name for name in os.listdir(output_dir) if name.endswith('.png')]
+        if len(outputs) != len(mermaid_codes) or not all(os.path.exists(path) for path in png_paths):
+            return None
+        
+        png_images = []
+        for png_path in png_paths:
+            with open(png_path, 'rb') as f:
+                png_images.append(f.read())
+        return png_images
+    
+    def add_rounded_corners_and_convert_to_avif(self, png_data: bytes) -> AvifEncoding:
+        """Add padding and rounded corners on white to PNG bytes and convert to AVIF (no borders)"""
+        flattened = round_and_flatten(
+            png_data,
+            padding=POSTPROCESS_PARAMS['padding'],
+            radius=POSTPROCESS_PARAMS['radius']
+        )
+        return encode_avif(
+            flattened,
+            quality=POSTPROCESS_PARAMS['quality'],
+            speed=POSTPROCESS_PARAMS['speed'],
+            target_ssim=self.target_ssim
+        )
 
-            return avif_data
+    def _cache_key(self, mermaid_code: str) -> str:
+        return RenderCache.make_key(
+            mermaid_code, 'mmdc', self.mmdc_version, MERMAID_RENDER_FLAGS, self.postprocess_params
+        )
+    
+    def prerender_diagrams(self, blog_posts: List[Path]):
+        """Render every uncached Mermaid diagram of the corpus in a single mmdc session
 
-        finally:
-            # Clean up temporary files
-            for temp_path in [png_path, avif_path]:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
+        The renders go into the render cache, where process_blog_post finds them;
+        without the cache there is nowhere to keep them, so nothing is batched.
+        """
+        if not self.render_cache.enabled:
+            return
+        
+        missing = {}
+        for blog_path in blog_posts:
+            mdx_file = blog_path / "index.mdx"
+            if not mdx_file.exists() or self.state.is_unchanged(self.STATE_NAME, mdx_file):
+                continue
+            for mermaid_code, _, _ in self.find_mermaid_blocks(mdx_file):
+                if not self.shard.owns(blog_path.name, mermaid_code):
+                    continue
+                cache_key = self._cache_key(mermaid_code)
+                if cache_key not in missing and not self.render_cache.contains(cache_key):
+                    missing[cache_key] = mermaid_code
+        
+        # A single diagram gains nothing from batching
+        if len(missing) < 2:
+            return
+        
+        print(f"Rendering {len(missing)} Mermaid diagrams in one mmdc session")
+        cache_keys = list(missing)
+        
+        try:
+            with tracer.span('render', asset=f"batch of {len(cache_keys)}") as span:
+                png_images = self.render_mermaid_batch_to_png([missing[k] for k in cache_keys])
+                span.bytes_out = sum(len(png_data) for png_data in png_images or [])
+        except subprocess.CalledProcessError as e:
+            # One broken diagram fails the whole batch; render them one by one instead
+            print(f"  ⚠️  Batch render failed, falling back to one render per diagram: {e}")
+            return
+        
+        if png_images is None:
+            print("  ⚠️  Batch render did not produce one image per diagram, falling back to one render per diagram")
+            return
+        
+        for cache_key, png_data in zip(cache_keys, png_images):
+            with tracer.context(asset=f"render-{cache_key[:12]}"):
+                encoding = self.add_rounded_corners_and_convert_to_avif(png_data)
+            self.render_cache.put(cache_key, encoding.data, encoding.metrics())
+        
+        print("-" * 50)
     
-    def generate_filename(self, mermaid_code: str, index: int) -> str:
-        """Generate a unique filename for the diagram"""
-        # Create a hash of the mermaid code for uniqueness
-        code_hash = hashlib.md5(mermaid_code.encode()).hexdigest()[:8]
+    def generate_filename(self, mermaid_code: str, index: int, avif_data: bytes) -> str:
+        """Generate a content-addressed filename for the rendered diagram"""
+        # Hash the rendered bytes, not the source, so a re-render with new settings gets a new key
+        code_hash = content_hash(avif_data)
         
         # Extract diagram type from first line
         first_line = mermaid_code.strip().split('\n')[0]
@@ -214,22 +283,16 @@ class MermaidToR2Migrator:
         
         return f"{diagram_type}-{index + 1}-{code_hash}.avif"
     
+    def submit_upload_to_r2(self, avif_data: bytes, blog_folder: str, filename: str) -> Future:
+        """Queue an AVIF upload to R2; the Future resolves to the public URL"""
+        key = f"blogs/{blog_folder}/{filename}"
+        return self.uploader.submit(key, avif_data, 'image/avif')
+    
     def upload_to_r2(self, avif_data: bytes, blog_folder: str, filename: str) -> str:
         """Upload AVIF to R2 and return the public URL"""
-        key = f"blogs/{blog_folder}/{filename}"
-        
+        from botocore.exceptions import ClientError
         try:
-            self.r2_client.put_object(
-                Bucket=self.bucket_name,
-                Key=key,
-                Body=avif_data,
-                ContentType='image/avif',
-                CacheControl='public, max-age=31536000'  # Cache for 1 year
-            )
-            
-            # Return the public URL
-            return f"{self.r2_public_url}/{key}"
-            
+            return self.submit_upload_to_r2(avif_data, blog_folder, filename).result()
         except ClientError as e:
             print(f"Error uploading to R2: {e}")
             raise
@@ -261,10 +324,16 @@ class MermaidToR2Migrator:
             print(f"  No index.mdx found in {blog_path}")
             return 0
         
+        # Skip files that have not changed since they were fully migrated
+        if self.state.is_unchanged(self.STATE_NAME, mdx_file):
+            print(f"  Unchanged since last migration")
+            return 0
+        
         # Find Mermaid blocks
         mermaid_blocks = self.find_mermaid_blocks(mdx_file)
         if not mermaid_blocks:
             print(f"  No Mermaid diagrams found")
+            self.state.record(self.STATE_NAME, mdx_file, [])
             return 0
         
         print(f"  Found {len(mermaid_blocks)} Mermaid diagrams")
@@ -272,53 +341,87 @@ class MermaidToR2Migrator:
         # Use blog folder name for R2 organization
         blog_folder = blog_path.name
         replacements = []
+        outcomes = []
+        uploads = []
         
         for index, (mermaid_code, start_line, end_line) in enumerate(mermaid_blocks):
+            # Assets of other shards are left for their runners
+            if not self.shard.owns(blog_folder, mermaid_code):
+                continue
+            
             try:
                 print(f"    Processing diagram {index + 1}/{len(mermaid_blocks)}")
                 
-                # Render Mermaid directly to PNG with neutral theme and transparent background
-                png_path = self.render_mermaid_to_png(mermaid_code)
+                cache_key = self._cache_key(mermaid_code)
+                avif_data = self.render_cache.get(cache_key)
+                metrics = self.render_cache.get_meta(cache_key)
                 
-                # Add rounded corners and convert PNG to AVIF (no borders)
-                avif_data = self.add_rounded_corners_and_convert_to_avif(png_path)
+                if avif_data is None:
+                    with tracer.context(asset=f"diagram-{index + 1}"):
+                        # Render Mermaid directly to PNG with neutral theme and transparent background
+                        with tracer.span('render') as span:
+                            png_data = self.render_mermaid_to_png(mermaid_code)
+                            span.bytes_out = len(png_data)
+                    
+                        # Add rounded corners and convert PNG to AVIF (no borders)
+                        encoding = self.add_rounded_corners_and_convert_to_avif(png_data)
+                    avif_data, metrics = encoding.data, encoding.metrics()
+                    self.render_cache.put(cache_key, avif_data, metrics)
+                else:
+                    print(f"    Using cached render")
                 
                 # Generate filename
-                filename = self.generate_filename(mermaid_code, index)
+                filename = self.generate_filename(mermaid_code, index, avif_data)
                 print(f"    Uploading as: {filename}")
                 
-                # Upload to R2
-                r2_url = self.upload_to_r2(avif_data, blog_folder, filename)
-                replacements.append((start_line, end_line, r2_url))
-                
-                print(f"    ✓ Migrated to: {r2_url}")
+                # Upload to R2 in the background while the next diagram renders
+                upload = self.submit_upload_to_r2(avif_data, blog_folder, filename)
+                uploads.append((index, start_line, end_line, upload, metrics))
                 
             except Exception as e:
                 print(f"    ✗ Failed to migrate diagram {index + 1}: {e}")
+                outcomes.append((f"diagram-{index + 1}", FAILED, str(e)))
                 continue
         
+        # Only rewrite the file once every upload of the post has been confirmed
+        for index, start_line, end_line, upload, metrics in uploads:
+            try:
+                r2_url = upload.result()
+                replacements.append((start_line, end_line, r2_url))
+                outcomes.append((f"diagram-{index + 1}", MIGRATED, r2_url, metrics))
+                print(f"    ✓ Migrated to: {r2_url}")
+            except Exception as e:
+                print(f"    ✗ Failed to migrate diagram {index + 1}: {e}")
+                outcomes.append((f"diagram-{index + 1}", FAILED, str(e)))
+        
         # Replace Mermaid blocks in the file
         if replacements:
-            self.replace_mermaid_blocks_in_file(mdx_file, replacements)
+            with tracer.span('rewrite', asset=str(mdx_file)):
+                self.replace_mermaid_blocks_in_file(mdx_file, replacements)
             print(f"  ✓ Updated {len(replacements)} diagrams in {mdx_file}")
         
+        self.state.record(self.STATE_NAME, mdx_file, outcomes)
         return len(replacements)
     
-    def migrate_all_posts(self):
+    def migrate_all_posts(self, blog_posts: Optional[List[Path]] = None):
         """Migrate Mermaid diagrams in all blog posts"""
         if not self.blog_content_dir.exists():
             print(f"Blog content directory not found: {self.blog_content_dir}")
             return
         
         total_migrated = 0
-        blog_posts = [d for d in self.blog_content_dir.iterdir() if d.is_dir()]
+        if blog_posts is None:
+            blog_posts = [d for d in self.blog_content_dir.iterdir() if d.is_dir()]
         
         print(f"Found {len(blog_posts)} blog posts to process")
         print("-" * 50)
         
+        self.prerender_diagrams(blog_posts)
+        
         for blog_path in blog_posts:
             try:
-                migrated_count = self.process_blog_post(blog_path)
+                with tracer.context(post=blog_path.name), self.shard.recording(blog_path / "index.mdx"):
+                    migrated_count = self.process_blog_post(blog_path)
                 total_migrated += migrated_count
             except Exception as e:
                 print(f"Error processing {blog_path}: {e}")
@@ -328,15 +431,75 @@ class MermaidToR2Migrator:
         
         print("-" * 50)
         print(f"Migration complete! Total diagrams migrated: {total_migrated}")
+        print(self.uploader.summary())
+        print(self.render_cache.summary())
 
 def main():
     """Main function"""
+    parser = argparse.ArgumentParser(description="Migrate Mermaid diagrams to AVIF in R2")
+    parser.add_argument(
+        'files',
+        nargs='*',
+        metavar='MDX_FILE',
+        help='Only migrate the posts of these index.mdx files, e.g. the staged ones (default: all posts)'
+    )
+    
+    parser.add_argument(
+        '--stage',
+        action='store_true',
+        help='git add the MDX files this run rewrote'
+    )
+    
+    parser.add_argument(
+        '--shard',
+        type=Shard.parse,
+        metavar='I/N',
+        help='Only migrate shard I of N (0-based) and record the MDX rewrites in a manifest '
+             'for merge_shards.py instead of applying them'
+    )
+    
+    parser.add_argument(
+        '--shard-manifest',
+        metavar='PATH',
+        help=f'Where to write the shard manifest (default: {DEFAULT_MANIFEST_DIR}/<migrator>-<i>-of-<n>.json)'
+    )
+    
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='After migrating, keep running and migrate the new assets of every saved index.mdx'
+    )
+    
+    parser.add_argument(
+        '--trace',
+        metavar='PATH',
+        help='Record per-stage spans and write them to PATH as Chrome trace JSON, '
+             'plus a p50/p95/max summary (default: MIGRATION_TRACE)'
+    )
+    
+    args = parser.parse_args()
+    tracer.start(args.trace)
+    
     try:
-        migrator = MermaidToR2Migrator()
-        migrator.migrate_all_posts()
+        migrator = MermaidToR2Migrator(shard=args.shard)
+        blog_posts = select_posts(migrator.blog_content_dir, args.files)
+        before = file_signatures(blog_posts)
+        migrator.migrate_all_posts(blog_posts)
+        if args.stage:
+            stage_rewritten(before)
+        if migrator.shard.active:
+            manifest = migrator.shard.write_manifest(migrator.STATE_NAME, args.shard_manifest)
+            print(f"Shard {migrator.shard} manifest: {manifest}")
+        if args.watch:
+            watch_posts([migrator])
+        migrator.uploader.close()
     except Exception as e:
         print(f"Error: {e}")
         return 1
+    finally:
+        trace_summary = tracer.finish()
+        if trace_summary:
+            print(trace_summary)
     
     return 0
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Incremental migration state shared by the migration scripts.
+
+A small SQLite database records, per migrator, the content hash of every MDX
+file it has fully migrated together with the asset references found in it
+and the outcome for each one. On the next run an unchanged file is skipped
+after a single primary-key lookup and a `stat()`; the file is only read and
+hashed again when its mtime or size changed.
+
+A file is only remembered as done when every one of its assets migrated, so
+anything that failed is retried on the next run. Assets can carry a small
+metrics dict (e.g. the AVIF quality chosen and the SSIM it achieved), stored
+as JSON next to their outcome.
+
+Environment variables (optional):
+- MIGRATION_STATE_DB (default: .cache/migration-state.sqlite3)
+- MIGRATION_STATE_DISABLE (set to 1 to process every file)
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+DEFAULT_STATE_DB = ".cache/migration-state.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    migrator TEXT NOT NULL,
+    path TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (migrator, path)
+);
+CREATE TABLE IF NOT EXISTS assets (
+    migrator TEXT NOT NULL,
+    path TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    detail TEXT,
+    metrics TEXT,
+    PRIMARY KEY (migrator, path, ref)
+);
+"""
+
+# Outcome recorded for an asset that was uploaded and rewritten successfully
+MIGRATED = 'migrated'
+FAILED = 'failed'
+
+
+def hash_file(file_path: Path) -> str:
+    """SHA-256 of a file's bytes"""
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class MigrationState:
+    def __init__(self, db_path: Optional[str] = None):
+        self.enabled = os.getenv("MIGRATION_STATE_DISABLE", "0") != "1"
+        self.db_path = Path(db_path or os.getenv("MIGRATION_STATE_DB", DEFAULT_STATE_DB))
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_path))
+            self._conn.executescript(SCHEMA)
+
+            # Databases created before asset metrics were recorded
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(assets)")}
+            if 'metrics' not in columns:
+                self._conn.execute("ALTER TABLE assets ADD COLUMN metrics TEXT")
+        return self._conn
+
+    def is_unchanged(self, migrator: str, file_path: Path) -> bool:
+        """True if the file is identical to the last fully migrated version"""
+        if not self.enabled:
+            return False
+
+        row = self.conn.execute(
+            "SELECT mtime_ns, size, content_hash FROM files WHERE migrator = ? AND path = ?",
+            (migrator, str(file_path))
+        ).fetchone()
+        if row is None:
+            return False
+
+        stat = file_path.stat()
+        mtime_ns, size, content_hash = row
+        if stat.st_mtime_ns == mtime_ns and stat.st_size == size:
+            return True
+
+        # Touched but possibly identical (e.g. after a checkout); fall back to the hash
+        if stat.st_size != size or hash_file(file_path) != content_hash:
+            return False
+
+        with self.conn:
+            self.conn.execute(
+                "UPDATE files SET mtime_ns = ? WHERE migrator = ? AND path = ?",
+                (stat.st_mtime_ns, migrator, str(file_path))
+            )
+        return True
+
+    def record(self, migrator: str, file_path: Path, outcomes: List[Tuple]):
+        """Store the outcome of each asset reference and remember the file if all migrated.
+
+        `outcomes` holds (reference, outcome, detail) tuples, optionally followed
+        by a metrics dict; call this after the file has been rewritten so the
+        stored hash matches what is on disk.
+        """
+        if not self.enabled:
+            return
+
+        path = str(file_path)
+        rows = []
+        for ref, outcome, detail, *extra in outcomes:
+            metrics = extra[0] if extra else None
+            rows.append((migrator, path, ref, outcome, detail, json.dumps(metrics) if metrics else None))
+
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM assets WHERE migrator = ? AND path = ?", (migrator, path)
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO assets (migrator, path, ref, outcome, detail, metrics) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+            if all(outcome[1] == MIGRATED for outcome in outcomes):
+                stat = file_path.stat()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO files (migrator, path, mtime_ns, size, content_hash, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (migrator, path, stat.st_mtime_ns, stat.st_size, hash_file(file_path), time.time())
+                )
+            else:
+                self.conn.execute(
+                    "DELETE FROM files WHERE migrator = ? AND path = ?", (migrator, path)
+                )
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Perceptual fingerprints for finding near-duplicate images across posts.
+
+The same screenshot often appears in several posts as a re-exported PNG, a
+resized copy or a JPEG of the original. Their bytes differ, but their
+downscaled grayscale versions do not. Each image gets two 64-bit hashes,
+computed with NumPy on a small grayscale copy:
+
+- dHash: whether each pixel of a 9x8 thumbnail is brighter than its right neighbour
+- pHash: the signs of the 8x8 lowest DCT frequencies of a 32x32 thumbnail
+  relative to their median
+
+Two images are candidates when both hashes are within a few bits of each
+other (Hamming distance), their aspect ratios match and, for animations, their
+frame counts match. `PerceptualIndex` groups a corpus into such clusters and
+picks the largest member of each as the canonical source to encode once.
+
+Hashes this small cannot tell apart screenshots of different code on the same
+dark background, so every candidate is confirmed against its canonical source
+with a pixel check (`pixel_similarity`): SSIM of the two luma planes,
+compared at the smaller image's size, must reach MIN_CONFIRM_SSIM. Only confirmed members are mapped onto the canonical
+source; the rest are migrated on their own.
+"""
+
+import io
+from functools import lru_cache
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from image_quality import ssim
+from lazy_import import lazy_import
+from tracing import tracer
+
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+DHASH_SIZE = 8
+PHASH_SIZE = 8
+PHASH_SAMPLE = 32
+
+# Largest Hamming distances (out of 64 bits) at which two images are still candidates for the pixel check
+MAX_DHASH_DISTANCE = 4
+MAX_PHASH_DISTANCE = 4
+
+# Relative aspect ratio difference tolerated between a picture and its resized copy
+ASPECT_TOLERANCE = 0.02
+
+# Pixel check confirming a hash match: longest side the luma planes are compared at,
+# and the SSIM they must reach (resized and re-encoded copies score above 0.99,
+# different screenshots of the same layout below 0.95)
+CONFIRM_MAX_SIDE = 256
+MIN_CONFIRM_SSIM = 0.98
+
+
+class Fingerprint(NamedTuple):
+    dhash: int
+    phash: int
+    size: Tuple[int, int]
+    frames: int
+
+    @property
+    def area(self) -> int:
+        return self.size[0] * self.size[1]
+
+
+@lru_cache(maxsize=4)
+def _dct_matrix(n: int) -> 'np.ndarray':
+    """Orthonormal DCT-II basis, so dct(x) = D @ x @ D.T"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    basis = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    basis[0] /= np.sqrt(2)
+    return basis
+
+
+def _pack(bits: 'np.ndarray') -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def dhash(gray: 'Image.Image') -> int:
+    pixels = np.asarray(gray.resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.BOX), dtype=np.int16)
+    return _pack(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(gray: 'Image.Image') -> int:
+    pixels = np.asarray(gray.resize((PHASH_SAMPLE, PHASH_SAMPLE), Image.Resampling.BOX), dtype=np.float64)
+    basis = _dct_matrix(PHASH_SAMPLE)
+    low = (basis @ pixels @ basis.T)[:PHASH_SIZE, :PHASH_SIZE].ravel()
+    # The DC term only encodes overall brightness; keep it out of the threshold
+    return _pack(low > np.median(low[1:]))
+
+
+def fingerprint(data: bytes) -> Fingerprint:
+    """Fingerprint encoded image bytes; animations are hashed on their middle frame.
+
+    Lives at module level so it can run in ProcessPoolExecutor workers.
+    """
+    with tracer.span('fingerprint', bytes_in=len(data)):
+        return _fingerprint(data)
+
+
+def _grayscale(data: bytes, draft_side: Optional[int] = None) -> Tuple['Image.Image', Tuple[int, int], int]:
+    """Grayscale copy (the middle frame of animations), original size and frame count"""
+    with Image.open(io.BytesIO(data)) as img:
+        size = img.size
+        frames = getattr(img, 'n_frames', 1)
+        if frames > 1:
+            img.seek(frames // 2)
+        elif draft_side is not None:
+            # JPEGs can decode straight to a reduced grayscale image
+            img.draft('L', (draft_side, draft_side))
+        return img.convert('L'), size, frames
+
+
+def _fingerprint(data: bytes) -> Fingerprint:
+    gray, size, frames = _grayscale(data, PHASH_SAMPLE * 4)
+    return Fingerprint(dhash(gray), phash(gray), size, frames)
+
+
+def pixel_similarity(a: bytes, b: bytes) -> float:
+    """SSIM of two images' luma planes, both resized to the smaller image's size (capped at CONFIRM_MAX_SIDE)"""
+    with tracer.span('confirm', bytes_in=len(a) + len(b)):
+        gray_a, size_a, _ = _grayscale(a)
+        gray_b, size_b, _ = _grayscale(b)
+        width, height = min(size_a, size_b, key=lambda size: size[0] * size[1])
+        scale = min(1.0, CONFIRM_MAX_SIDE / max(width, height))
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        plane_a = np.asarray(gray_a.resize(size, Image.Resampling.BOX), dtype=np.float64)
+        plane_b = np.asarray(gray_b.resize(size, Image.Resampling.BOX), dtype=np.float64)
+        return ssim(plane_a, plane_b)
+
+
+def _popcount(values: 'np.ndarray') -> 'np.ndarray':
+    """Set bits per element of a uint64 array"""
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class PerceptualIndex:
+    def __init__(self, max_dhash_distance: int = MAX_DHASH_DISTANCE,
+                 max_phash_distance: int = MAX_PHASH_DISTANCE):
+        self.max_dhash_distance = max_dhash_distance
+        self.max_phash_distance = max_phash_distance
+
+        self.keys: List[str] = []
+        self.fingerprints: List[Fingerprint] = []
+        self._cluster_of: List[int] = []
+        self._dhashes = np.empty(0, dtype=np.uint64)
+        self._phashes = np.empty(0, dtype=np.uint64)
+        self._aspects = np.empty(0, dtype=np.float64)
+        self._frames = np.empty(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def find(self, fp: Fingerprint) -> Optional[int]:
+        """Position of the closest indexed near-duplicate of fp, if any"""
+        if not self.keys:
+            return None
+
+        d_distance = _popcount(self._dhashes ^ np.uint64(fp.dhash))
+        p_distance = _popcount(self._phashes ^ np.uint64(fp.phash))
+        aspect = fp.size[0] / fp.size[1]
+        match = (
+            (d_distance <= self.max_dhash_distance)
+            & (p_distance <= self.max_phash_distance)
+            & (np.abs(self._aspects - aspect) <= ASPECT_TOLERANCE * aspect)
+            & (self._frames == fp.frames)
+        )
+        if not match.any():
+            return None
+        candidates = np.flatnonzero(match)
+        return int(candidates[np.argmin((d_distance + p_distance)[candidates])])
+
+    def add(self, key: str, fp: Fingerprint):
+        """Index key, joining the cluster of its closest near-duplicate"""
+        if key in self.keys:
+            return
+        closest = self.find(fp)
+        self._cluster_of.append(self._cluster_of[closest] if closest is not None else len(self.keys))
+
+        self.keys.append(key)
+        self.fingerprints.append(fp)
+        self._dhashes = np.append(self._dhashes, np.uint64(fp.dhash))
+        self._phashes = np.append(self._phashes, np.uint64(fp.phash))
+        self._aspects = np.append(self._aspects, fp.size[0] / fp.size[1])
+        self._frames = np.append(self._frames, fp.frames)
+
+    def duplicates(self, confirm: Callable[[str, str], bool]) -> Dict[str, str]:
+        """Map every confirmed near-duplicate, and its cluster's canonical key (the largest image), to that key
+
+        `confirm(key, canonical_key)` is the pixel check every other member of a cluster must pass
+        against the canonical key; members that fail it are left out and migrated on their own.
+        """
+        clusters: Dict[int, List[int]] = {}
+        for position, cluster in enumerate(self._cluster_of):
+            clusters.setdefault(cluster, []).append(position)
+
+        canonical: Dict[str, str] = {}
+        for members in clusters.values():
+            if len(members) < 2:
+                continue
+            best = self.keys[max(members, key=lambda position: self.fingerprints[position].area)]
+            confirmed = [self.keys[position] for position in members
+                         if self.keys[position] != best and confirm(self.keys[position], best)]
+            if confirmed:
+                canonical[best] = best
+                canonical.update((key, best) for key in confirmed)
+        return canonical
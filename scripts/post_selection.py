@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Explicit MDX file lists for the migration scripts.
+
+By default every migrator walks all of src/content/blog/. The pre-commit hook
+instead passes the staged MDX files (`git diff --cached --name-only`), and
+only the posts they belong to are migrated, so commit latency follows the
+size of the change rather than the size of the corpus. With `--stage`, the
+MDX files a migrator rewrote are `git add`ed again so the rewrite lands in
+the same commit.
+"""
+
+import subprocess
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Each post is a directory under the blog content dir holding one index.mdx
+POST_FILE_NAME = "index.mdx"
+
+Signature = Optional[Tuple[int, int]]
+
+
+def all_posts(blog_content_dir: Path) -> List[Path]:
+    if not blog_content_dir.exists():
+        return []
+    return [d for d in blog_content_dir.iterdir() if d.is_dir()]
+
+
+def select_posts(blog_content_dir: Path, mdx_files: Optional[Iterable[str]] = None) -> List[Path]:
+    """Post directories to migrate: all of them, or only those of the given MDX files
+
+    Files outside the blog content dir, other than a post's index.mdx, or
+    deleted in the working tree are ignored.
+    """
+    mdx_files = list(mdx_files or [])
+    if not mdx_files:
+        return all_posts(blog_content_dir)
+
+    root = blog_content_dir.resolve()
+    posts: Dict[Path, None] = {}
+    for name in mdx_files:
+        path = Path(name)
+        if path.name != POST_FILE_NAME or not path.is_file():
+            continue
+        if path.resolve().parent.parent != root:
+            continue
+        posts[blog_content_dir / path.resolve().parent.name] = None
+    return list(posts)
+
+
+def _signature(path: Path) -> Signature:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def file_signatures(posts: Iterable[Path]) -> Dict[Path, Signature]:
+    """mtime/size of each post's index.mdx, taken before migrating"""
+    return {post / POST_FILE_NAME: _signature(post / POST_FILE_NAME) for post in posts}
+
+
+def stage_rewritten(before: Dict[Path, Signature]) -> List[Path]:
+    """`git add` every MDX file that changed since `before` was taken; returns them"""
+    rewritten = [path for path, signature in before.items() if _signature(path) != signature]
+    if rewritten:
+        subprocess.run(['git', 'add', '--', *map(str, rewritten)], check=True)
+        print(f"Staged {len(rewritten)} rewritten MDX file(s)")
+    return rewritten
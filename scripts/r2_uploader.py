@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Concurrent upload scheduler for Cloudflare R2.
+
+`put_object` calls are issued from a thread pool sized to match boto3's
+connection pool, so several uploads are on the wire at once. A hard cap on
+in-flight bytes keeps memory bounded: a submit blocks until enough earlier
+uploads have finished to make room for the new body.
+
+Callers get a Future per upload that resolves to the object's public URL,
+so a post's MDX file is only rewritten once every one of its uploads has
+been confirmed.
+
+Before the first upload into a `blogs/<folder>/` prefix, the whole prefix is
+listed with one paginated ListObjectsV2 sweep. Uploads whose key already
+exists with the same size and MD5 ETag are skipped, which saves a paid
+Class A operation and the transfer of the bytes.
+
+PUTs run under an `AdaptiveLimiter` (see adaptive_limit.py): when R2 answers
+with SlowDown/429/503 the number of concurrent uploads is halved and the
+upload retried after a jittered backoff, then ramps back up while R2 keeps
+up. boto3's own retries are limited to one so throttling reaches the limiter.
+
+Streamed bodies (`SpooledBody`) are sent with `upload_fileobj`, which switches
+to a multipart upload for large objects, so only a few parts are in memory.
+
+Migrators name objects after a hash of their bytes (`content_hash`), so a key
+always holds the same content and is served as `immutable`. Edited assets get
+a new key instead of leaving stale bytes cached at the edge, and submitting
+identical content to a key that is already uploaded or in flight is a no-op.
+"""
+
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, Set, Tuple, Union
+
+from adaptive_limit import AdaptiveLimiter
+from spooled_body import CONTENT_HASH_BYTES, MULTIPART_CHUNK_SIZE, SpooledBody
+from tracing import tracer
+
+DEFAULT_UPLOAD_WORKERS = 10
+DEFAULT_MAX_INFLIGHT_BYTES = 64 * 1024 * 1024
+# Keys are content-addressed, so an object never changes: cache for 1 year without revalidation
+DEFAULT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Parts uploaded in parallel per multipart transfer
+MULTIPART_CONCURRENCY = 4
+
+
+@lru_cache(maxsize=1)
+def transfer_config():
+    """Multipart settings for upload_fileobj; boto3 is only imported once a body is streamed"""
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=MULTIPART_CHUNK_SIZE,
+        multipart_chunksize=MULTIPART_CHUNK_SIZE,
+        max_concurrency=MULTIPART_CONCURRENCY,
+    )
+
+
+def content_hash(body: Union[bytes, SpooledBody]) -> str:
+    """Short hex BLAKE2b digest of an object's bytes, for content-addressed keys"""
+    if isinstance(body, SpooledBody):
+        return body.content_hash
+    return hashlib.blake2b(body, digest_size=CONTENT_HASH_BYTES).hexdigest()
+
+
+def r2_client_config(max_workers: int = DEFAULT_UPLOAD_WORKERS):
+    """boto3 client config with a connection pool large enough for the scheduler
+
+    boto3 retries once for transient errors; persistent throttling is left to
+    the scheduler's adaptive limiter, which also lowers the concurrency.
+    """
+    from botocore.config import Config
+    return Config(max_pool_connections=max_workers, retries={'mode': 'standard', 'max_attempts': 2})
+
+
+class R2UploadScheduler:
+    def __init__(self, client_factory: Callable[[], object], bucket_name: str, public_url: str,
+                 max_workers: int = DEFAULT_UPLOAD_WORKERS,
+                 max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES):
+        # The boto3 client is built on the first listing or upload, so a run with nothing to upload never pays for it
+        self._client_factory = client_factory
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.bucket_name = bucket_name
+        self.public_url = public_url
+        self.max_inflight_bytes = max_inflight_bytes
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload')
+        # Concurrent PUTs against R2, lowered while R2 throttles
+        self.limiter = AdaptiveLimiter('R2', max_workers, max_workers)
+        self._inflight_bytes = 0
+        self._inflight_changed = threading.Condition()
+
+        # key -> (etag, size) for every object seen in a listed prefix
+        self._index: Dict[str, Tuple[str, int]] = {}
+        self._indexed_prefixes: Set[str] = set()
+        self._index_lock = threading.Lock()
+
+        # key -> (etag, Future) for uploads that have been queued but not finished
+        self._pending: Dict[str, Tuple[str, Future]] = {}
+
+        self.stats = {
+            'list_requests': 0,
+            'uploaded': 0,
+            'uploaded_bytes': 0,
+            'skipped': 0,
+            'skipped_bytes': 0,
+        }
+
+    @property
+    def r2_client(self):
+        with self._client_lock:
+            if self._client is None:
+                self._client = self._client_factory()
+            return self._client
+
+    def prefetch_prefix(self, prefix: str):
+        """List every object under a prefix into the in-memory index"""
+        with self._index_lock:
+            if prefix in self._indexed_prefixes:
+                return
+            self._indexed_prefixes.add(prefix)
+
+        from botocore.exceptions import ClientError
+        try:
+            with tracer.span('list', asset=prefix):
+                paginator = self.r2_client.get_paginator('list_objects_v2')
+                for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+                    self.stats['list_requests'] += 1
+                    with self._index_lock:
+                        for obj in page.get('Contents', []):
+                            self._index[obj['Key']] = (obj['ETag'].strip('"'), obj['Size'])
+        except ClientError as e:
+            # Without a listing every object is simply uploaded
+            print(f"    ⚠️  Could not list {prefix} in R2: {e}")
+
+    @staticmethod
+    def _etag_and_size(body: Union[bytes, SpooledBody]) -> Tuple[str, int]:
+        """The ETag and size the stored object will have once body is uploaded"""
+        if isinstance(body, SpooledBody):
+            return body.etag, body.size
+        return hashlib.md5(body).hexdigest(), len(body)
+
+    @staticmethod
+    def _memory_cost(body: Union[bytes, SpooledBody]) -> int:
+        """Bytes an upload holds in memory while in flight"""
+        if isinstance(body, SpooledBody):
+            return min(body.size, MULTIPART_CHUNK_SIZE * MULTIPART_CONCURRENCY)
+        return len(body)
+
+    def is_unchanged(self, key: str, body: Union[bytes, SpooledBody]) -> bool:
+        """True if the bucket already holds exactly these bytes under key"""
+        return self._is_stored(key, *self._etag_and_size(body))
+
+    def _is_stored(self, key: str, etag: str, size: int) -> bool:
+        self.prefetch_prefix(key.rsplit('/', 1)[0] + '/')
+
+        with self._index_lock:
+            return self._index.get(key) == (etag, size)
+
+    def _reserve(self, size: int):
+        """Block until `size` bytes fit under the in-flight cap"""
+        with self._inflight_changed:
+            # A body larger than the cap is still allowed once nothing else is in flight
+            while self._inflight_bytes > 0 and self._inflight_bytes + size > self.max_inflight_bytes:
+                self._inflight_changed.wait()
+            self._inflight_bytes += size
+
+    def _release(self, size: int):
+        with self._inflight_changed:
+            self._inflight_bytes -= size
+            self._inflight_changed.notify_all()
+
+    def _put(self, key: str, body: Union[bytes, SpooledBody], content_type: str, cache_control: str) -> str:
+        try:
+            size = body.size if isinstance(body, SpooledBody) else len(body)
+            self.limiter.run(lambda: self._send(key, body, size, content_type, cache_control))
+
+            etag, size = self._etag_and_size(body)
+            with self._index_lock:
+                self._index[key] = (etag, size)
+                self.stats['uploaded'] += 1
+                self.stats['uploaded_bytes'] += size
+
+            return f"{self.public_url}/{key}"
+        finally:
+            self._release(self._memory_cost(body))
+            if isinstance(body, SpooledBody):
+                body.close()
+
+    def _send(self, key: str, body: Union[bytes, SpooledBody], size: int, content_type: str, cache_control: str):
+        """One upload attempt; a retry re-reads a SpooledBody from the start"""
+        with tracer.span('upload', asset=key, bytes_in=size):
+            if isinstance(body, SpooledBody):
+                # Streams from the spooled file; multipart above the threshold
+                self.r2_client.upload_fileobj(
+                    body.fileobj,
+                    self.bucket_name,
+                    key,
+                    ExtraArgs={'ContentType': content_type, 'CacheControl': cache_control},
+                    Config=transfer_config()
+                )
+            else:
+                self.r2_client.put_object(
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    Body=body,
+                    ContentType=content_type,
+                    CacheControl=cache_control
+                )
+
+    def submit(self, key: str, body: Union[bytes, SpooledBody], content_type: str,
+               cache_control: str = DEFAULT_CACHE_CONTROL) -> Future:
+        """Queue an upload; the returned Future resolves to the public URL
+
+        A SpooledBody is owned by the scheduler from here on and closed once sent.
+        """
+        etag, size = self._etag_and_size(body)
+        if self._is_stored(key, etag, size):
+            self._skip(body, size)
+            future = Future()
+            future.set_result(f"{self.public_url}/{key}")
+            return future
+
+        # The same bytes for the same key are already on their way
+        with self._index_lock:
+            pending = self._pending.get(key)
+        if pending is not None and pending[0] == etag:
+            self._skip(body, size)
+            return pending[1]
+
+        cost = self._memory_cost(body)
+        self._reserve(cost)
+        try:
+            future = self._executor.submit(tracer.bind(self._put), key, body, content_type, cache_control)
+        except BaseException:
+            self._release(cost)
+            raise
+
+        with self._index_lock:
+            self._pending[key] = (etag, future)
+        future.add_done_callback(lambda _: self._forget_pending(key, future))
+        return future
+
+    def _skip(self, body: Union[bytes, SpooledBody], size: int):
+        with self._index_lock:
+            self.stats['skipped'] += 1
+            self.stats['skipped_bytes'] += size
+        if isinstance(body, SpooledBody):
+            body.close()
+
+    def _forget_pending(self, key: str, future: Future):
+        # Finished uploads are in the index, which answers later submits instead
+        with self._index_lock:
+            if key in self._pending and self._pending[key][1] is future:
+                del self._pending[key]
+
+    def summary(self) -> str:
+        """Human readable upload statistics for end-of-run output"""
+        stats = self.stats
+        summary = (
+            f"R2 uploads: {stats['uploaded']} uploaded ({stats['uploaded_bytes']} bytes), "
+            f"{stats['skipped']} unchanged skipped (saved {stats['skipped']} PUTs, "
+            f"{stats['skipped_bytes']} bytes) using {stats['list_requests']} list requests"
+        )
+        throttling = self.limiter.summary()
+        return f"{summary}\n{throttling}" if throttling else summary
+
+    def close(self):
+        """Wait for queued uploads and stop the worker threads"""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Content-addressed on-disk cache for rendered diagram images.
+
+The D2 and Mermaid migrators render every diagram to PNG with an external CLI
+and then post-process it into AVIF. Both steps are pure functions of the
+diagram source, the renderer version, the render flags and the
+post-processing parameters, so the final AVIF bytes can be cached under a
+hash of all of those inputs.
+
+Entries are stored as `<cache-dir>/<key[:2]>/<key>.avif`, with optional
+metadata about the encode (chosen quality, SSIM) in a `<key>.json` sidecar.
+Every hit refreshes the entry's mtime, and when the cache grows past its size
+budget the least recently used entries are evicted first.
+
+Environment variables (optional):
+- DIAGRAM_CACHE_DIR (default: .cache/diagram-renders)
+- DIAGRAM_CACHE_MAX_MB (default: 512)
+- DIAGRAM_CACHE_DISABLE (set to 1 to bypass the cache)
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+DEFAULT_CACHE_DIR = ".cache/diagram-renders"
+DEFAULT_MAX_MB = 512
+
+
+class RenderCache:
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.cache_dir = Path(cache_dir or os.getenv("DIAGRAM_CACHE_DIR", DEFAULT_CACHE_DIR))
+        if max_bytes is None:
+            max_bytes = int(os.getenv("DIAGRAM_CACHE_MAX_MB", DEFAULT_MAX_MB)) * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.enabled = os.getenv("DIAGRAM_CACHE_DISABLE", "0") != "1"
+
+        # Total size of the cache, computed lazily on the first write
+        self._total_bytes: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(source: str, renderer: str, renderer_version: str,
+                 render_flags: List[str], postprocess: Dict[str, Any]) -> str:
+        """Build the cache key for a diagram from every input that affects its output"""
+        payload = json.dumps({
+            'source': source,
+            'renderer': renderer,
+            'renderer_version': renderer_version,
+            'render_flags': list(render_flags),
+            'postprocess': postprocess,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.avif"
+
+    def _meta_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def contains(self, key: str) -> bool:
+        """Check for an entry without reading it or counting a hit/miss"""
+        return self.enabled and self._entry_path(key).exists()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached AVIF bytes for a key, or None on a miss"""
+        if not self.enabled:
+            return None
+
+        entry = self._entry_path(key)
+        try:
+            with open(entry, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        # Refresh mtime so LRU eviction keeps recently used entries
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return data
+
+    def get_meta(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the metadata stored with an entry, if any"""
+        if not self.enabled:
+            return None
+        try:
+            with open(self._meta_path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, key: str, data: bytes, meta: Optional[Dict[str, Any]] = None):
+        """Store AVIF bytes (and optional metadata) under a key and evict old entries if over budget"""
+        if not self.enabled:
+            return
+
+        entry = self._entry_path(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+
+        if meta is not None:
+            with open(self._meta_path(key), 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+
+        previous_size = entry.stat().st_size if entry.exists() else 0
+
+        # Write atomically so a crashed run never leaves a truncated entry
+        fd, temp_path = tempfile.mkstemp(dir=entry.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, entry)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+        if self._total_bytes is None:
+            self._total_bytes = self._scan_total_bytes()
+        else:
+            self._total_bytes += len(data) - previous_size
+
+        if self._total_bytes > self.max_bytes:
+            self._evict()
+
+    def _iter_entries(self):
+        if not self.cache_dir.exists():
+            return
+        for shard in self.cache_dir.iterdir():
+            if shard.is_dir():
+                yield from shard.glob('*.avif')
+
+    def _scan_total_bytes(self) -> int:
+        return sum(entry.stat().st_size for entry in self._iter_entries())
+
+    def _evict(self):
+        """Delete least recently used entries until the cache fits its budget"""
+        entries = []
+        for entry in self._iter_entries():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+                total -= size
+            except FileNotFoundError:
+                pass
+            entry.with_suffix('.json').unlink(missing_ok=True)
+
+        self._total_bytes = total
+
+    def summary(self) -> str:
+        """Human readable hit/miss summary for end-of-run output"""
+        if not self.enabled:
+            return "Render cache disabled"
+        return f"Render cache: {self.hits} hits, {self.misses} misses ({self.cache_dir})"
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Deterministic sharding of a migration run across CI runners.
+
+With `--shard i/n` (0 <= i < n) every runner sees the whole corpus but only
+migrates its own slice of the assets: an asset belongs to shard
+`blake2b(post, asset) % n`, so every machine agrees on the split without
+coordinating.
+
+A sharded run uploads its assets as usual but does not leave its MDX rewrites
+in the working tree. It records them as character-range edits against the
+checked-out file, in a JSON manifest per migrator and shard
+(`.cache/shards/<migrator>-<i>-of-<n>.json`), and restores the file.
+`merge_shards.py` applies all the manifests to the original checkout in one
+step. That only works while no two edits overlap: every asset belongs to
+exactly one shard, and every kind of reference to exactly one migrator (the
+image migrator leaves markdown Giphy links to the Giphy migrator, but migrates
+`<img>` tags on Giphy hosts, which the Giphy migrator does not match). A file
+whose edits do overlap is reported and left untouched.
+
+Sharded runs ignore the incremental state: a shard only migrates part of a
+file, so the file must not be remembered as done.
+"""
+
+import os
+import json
+import hashlib
+import argparse
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from migration_state import hash_file
+
+MANIFEST_VERSION = 1
+DEFAULT_MANIFEST_DIR = ".cache/shards"
+
+
+class Edit(NamedTuple):
+    start: int
+    end: int
+    text: str
+
+
+def _line_offsets(lines: List[str]) -> List[int]:
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    return offsets
+
+
+def _trimmed_edit(start: int, old: str, new: str) -> Optional[Edit]:
+    # Drop what both sides share, so rewrites of different spans of one line stay disjoint
+    prefix = len(os.path.commonprefix([old, new]))
+    suffix = len(os.path.commonprefix([old[prefix:][::-1], new[prefix:][::-1]]))
+    if prefix == len(old) == len(new):
+        return None
+    return Edit(start + prefix, start + len(old) - suffix, new[prefix:len(new) - suffix])
+
+
+def text_edits(original: str, rewritten: str) -> List[Edit]:
+    """Character-range edits that turn original into rewritten, found line by line"""
+    a = original.splitlines(keepends=True)
+    b = rewritten.splitlines(keepends=True)
+    offsets = _line_offsets(a)
+
+    edits = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            continue
+        if i2 - i1 == j2 - j1:
+            # Lines rewritten in place (e.g. image links): one edit per line
+            pairs = [(offsets[i], a[i], b[j]) for i, j in zip(range(i1, i2), range(j1, j2))]
+        else:
+            pairs = [(offsets[i1], ''.join(a[i1:i2]), ''.join(b[j1:j2]))]
+        edits.extend(edit for edit in (_trimmed_edit(*pair) for pair in pairs) if edit is not None)
+    return edits
+
+
+def apply_edits(text: str, edits: List[Edit]) -> str:
+    """Apply non-overlapping edits made against the same text; raises ValueError on overlap"""
+    parts = []
+    position = 0
+    for edit in sorted(edits):
+        if edit.start < position:
+            raise ValueError(f"overlapping edits at character {edit.start}")
+        parts.append(text[position:edit.start])
+        parts.append(edit.text)
+        position = edit.end
+    parts.append(text[position:])
+    return ''.join(parts)
+
+
+class Shard:
+    def __init__(self, index: int = 0, count: int = 1):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"invalid shard {index}/{count}")
+        self.index = index
+        self.count = count
+        self.files: Dict[str, dict] = {}
+
+    @classmethod
+    def parse(cls, value: str) -> 'Shard':
+        """argparse type for `--shard i/n`"""
+        try:
+            index, count = (int(part) for part in value.split('/'))
+            return cls(index, count)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"expected i/n with 0 <= i < n, got {value!r}")
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    @property
+    def active(self) -> bool:
+        return self.count > 1
+
+    def owns(self, post: str, asset: str) -> bool:
+        """True if this shard migrates the given asset of the given post"""
+        if not self.active:
+            return True
+        digest = hashlib.blake2b(f"{post}\0{asset}".encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % self.count == self.index
+
+    @contextmanager
+    def recording(self, mdx_file: Path) -> Iterator[None]:
+        """Turn rewrites of mdx_file inside the block into manifest edits and restore the file"""
+        if not self.active or not mdx_file.exists():
+            yield
+            return
+
+        base = hash_file(mdx_file)
+        original_bytes = mdx_file.read_bytes()
+        original = mdx_file.read_text(encoding='utf-8')
+        try:
+            yield
+        finally:
+            rewritten = mdx_file.read_text(encoding='utf-8')
+            if rewritten != original:
+                edits = self.files.setdefault(str(mdx_file), {'base': base, 'edits': []})['edits']
+                edits.extend(list(edit) for edit in text_edits(original, rewritten))
+                mdx_file.write_bytes(original_bytes)
+
+    def write_manifest(self, migrator: str, path: Optional[str] = None) -> Path:
+        """Write this shard's edits; returns the manifest path"""
+        manifest_path = Path(path or Path(DEFAULT_MANIFEST_DIR) / f"{migrator}-{self.index}-of-{self.count}.json")
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': MANIFEST_VERSION,
+                'migrator': migrator,
+                'shard': [self.index, self.count],
+                'files': self.files,
+            }, f, indent=2)
+        return manifest_path
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Streamed object bodies for the download-to-upload path.
+
+A `SpooledBody` is filled chunk by chunk while a download streams in. It
+keeps at most one multipart part in memory (larger bodies roll over to a
+temporary file), enforces a maximum size, and hashes the bytes on the fly:
+the plain MD5 and the per-part MD5s are enough to predict the ETag R2 will
+report for the object, whether it is uploaded with a single PUT or as a
+multipart upload, and a BLAKE2b digest names the object by its content.
+"""
+
+import hashlib
+import tempfile
+from typing import Iterable, List, Optional
+
+# Bodies of at least this size are uploaded as multipart, in parts of this size
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Size of the chunks read from the network
+READ_CHUNK_SIZE = 256 * 1024
+
+# Digest size of the BLAKE2b content hash used in content-addressed object keys
+CONTENT_HASH_BYTES = 8
+
+
+class BodyTooLargeError(ValueError):
+    """Raised when a streamed body exceeds its maximum size"""
+
+
+class SpooledBody:
+    def __init__(self, max_bytes: Optional[int] = None, part_size: int = MULTIPART_CHUNK_SIZE):
+        self.max_bytes = max_bytes
+        self.part_size = part_size
+        self.size = 0
+
+        self._file = tempfile.SpooledTemporaryFile(max_size=part_size)
+        self._md5 = hashlib.md5()
+        self._content_hash = hashlib.blake2b(digest_size=CONTENT_HASH_BYTES)
+        self._part_digests: List[bytes] = []
+        self._part_md5 = hashlib.md5()
+        self._part_fill = 0
+
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[bytes], max_bytes: Optional[int] = None) -> 'SpooledBody':
+        """Spool an iterable of chunks, e.g. `response.iter_content()`"""
+        body = cls(max_bytes=max_bytes)
+        try:
+            for chunk in chunks:
+                body.write(chunk)
+        except BaseException:
+            body.close()
+            raise
+        body._file.seek(0)
+        return body
+
+    def write(self, chunk: bytes):
+        if self.max_bytes is not None and self.size + len(chunk) > self.max_bytes:
+            raise BodyTooLargeError(f"body exceeds the {self.max_bytes} byte limit")
+
+        self._file.write(chunk)
+        self._md5.update(chunk)
+        self._content_hash.update(chunk)
+        self.size += len(chunk)
+
+        # Track part boundaries so the multipart ETag can be derived locally
+        view = memoryview(chunk)
+        while view:
+            take = min(len(view), self.part_size - self._part_fill)
+            self._part_md5.update(view[:take])
+            self._part_fill += take
+            view = view[take:]
+            if self._part_fill == self.part_size:
+                self._part_digests.append(self._part_md5.digest())
+                self._part_md5 = hashlib.md5()
+                self._part_fill = 0
+
+    @property
+    def md5_hex(self) -> str:
+        return self._md5.hexdigest()
+
+    @property
+    def content_hash(self) -> str:
+        """Hex BLAKE2b digest of the body, as used in content-addressed keys"""
+        return self._content_hash.hexdigest()
+
+    @property
+    def etag(self) -> str:
+        """The ETag R2 reports once this body is uploaded with `upload_fileobj`"""
+        if self.size < self.part_size:
+            return self.md5_hex
+
+        digests = list(self._part_digests)
+        if self._part_fill:
+            digests.append(self._part_md5.digest())
+        return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+    @property
+    def fileobj(self):
+        """The spooled file, rewound to the start"""
+        self._file.seek(0)
+        return self._file
+
+    def read(self) -> bytes:
+        """Load the whole body into memory (only for bodies that must be decoded)"""
+        return self.fileobj.read()
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+AIMD concurrency limits (adaptive_limit.py): additive increase up to the
+ceiling, multiplicative decrease down to the floor.
+
+Usage:
+    python -m pytest scripts/tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from adaptive_limit import AdaptiveLimiter, is_throttled  # noqa: E402
+
+
+class Throttled(Exception):
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.response = {'ResponseMetadata': {'HTTPStatusCode': status}, 'Error': {}}
+
+
+def healthy(limiter: AdaptiveLimiter, requests: int):
+    for _ in range(requests):
+        limiter.release(limiter.acquire())
+
+
+def throttle(limiter: AdaptiveLimiter):
+    limiter.release(limiter.acquire(), throttled=True)
+
+
+def test_initial_limit_is_clamped_between_floor_and_ceiling():
+    assert AdaptiveLimiter('host', initial_limit=50, max_limit=8).limit == 8
+    assert AdaptiveLimiter('host', initial_limit=0, max_limit=8, min_limit=2).limit == 2
+
+
+def test_healthy_responses_grow_the_limit_by_about_one_per_window():
+    limiter = AdaptiveLimiter('host', initial_limit=4, max_limit=16)
+
+    healthy(limiter, 4)
+
+    assert 4.9 < limiter.limit < 5
+
+
+def test_limit_never_grows_past_the_ceiling():
+    limiter = AdaptiveLimiter('host', initial_limit=4, max_limit=6)
+
+    healthy(limiter, 200)
+
+    assert limiter.limit == 6
+
+
+def test_throttling_halves_the_limit():
+    limiter = AdaptiveLimiter('host', initial_limit=8, max_limit=16)
+
+    throttle(limiter)
+
+    assert limiter.limit == 4
+    assert limiter.stats['throttled'] == 1
+
+
+def test_limit_never_drops_below_the_floor():
+    limiter = AdaptiveLimiter('host', initial_limit=8, max_limit=16, min_limit=2)
+
+    for _ in range(10):
+        throttle(limiter)
+
+    assert limiter.limit == 2
+    assert limiter.stats['lowest_limit'] == 2
+
+
+def test_requests_in_flight_before_a_decrease_do_not_shrink_the_limit_again():
+    limiter = AdaptiveLimiter('host', initial_limit=8, max_limit=16)
+    first, second = limiter.acquire(), limiter.acquire()
+
+    limiter.release(first, throttled=True)
+    limiter.release(second, throttled=True)
+
+    assert limiter.limit == 4
+
+
+def test_other_failures_leave_the_limit_alone():
+    limiter = AdaptiveLimiter('host', initial_limit=8, max_limit=16)
+
+    limiter.release(limiter.acquire(), failed=True)
+
+    assert limiter.limit == 8
+
+
+def test_throttled_call_is_retried_until_it_succeeds(monkeypatch):
+    monkeypatch.setattr('adaptive_limit.time.sleep', lambda seconds: None)
+    limiter = AdaptiveLimiter('host', initial_limit=4, max_limit=8)
+    answers = iter([Throttled(503), Throttled(429), 'ok'])
+
+    def call():
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert limiter.run(call) == 'ok'
+    assert limiter.stats['retries'] == 2
+    assert limiter.limit < 4
+
+
+def test_s3_slowdown_error_code_counts_as_throttling():
+    error = Exception("An error occurred (SlowDown) when calling the PutObject operation")
+
+    assert is_throttled(error)
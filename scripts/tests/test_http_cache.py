@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+On-disk HTTP cache (http_cache.py) as the fetcher uses it: fresh entries are
+served offline, stale ones are revalidated, and the least recently used
+entries are evicted first.
+
+Usage:
+    python -m pytest scripts/tests
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from http_cache import HttpCache, freshness_lifetime  # noqa: E402
+from http_fetcher import HttpFetcher  # noqa: E402
+
+URL = 'https://cdn.example.com/a.png'
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, body: bytes = b'', headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        assert self.status_code == 200
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class FakeSession:
+    """Answers each GET with the next queued response and records the request headers"""
+
+    def __init__(self, *responses: FakeResponse):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, timeout=None, stream=False, headers=None):
+        self.requests.append(headers or {})
+        return self.responses.pop(0)
+
+
+@pytest.fixture(autouse=True)
+def cache_enabled(monkeypatch):
+    monkeypatch.delenv('HTTP_CACHE_DISABLE', raising=False)
+
+
+def fetcher(cache: HttpCache, *responses: FakeResponse) -> HttpFetcher:
+    fetcher = HttpFetcher(cache=cache)
+    fetcher._session = FakeSession(*responses)
+    return fetcher
+
+
+def expire(cache: HttpCache, url: str = URL):
+    entry = cache.lookup(url)
+    entry.meta['fresh_until'] = 0
+    cache._write_meta(entry.key, entry.meta)
+
+
+def test_fresh_entry_is_served_without_a_request(tmp_path):
+    cache = HttpCache(str(tmp_path))
+    fetcher(cache, FakeResponse(200, b'png', {'Cache-Control': 'max-age=3600'})).fetch(URL)
+
+    offline = fetcher(cache)
+
+    assert offline.fetch(URL) == b'png'
+    assert offline._session.requests == []
+    assert cache.hits == 1
+
+
+def test_stale_entry_is_revalidated_with_its_validators(tmp_path):
+    cache = HttpCache(str(tmp_path))
+    fetcher(cache, FakeResponse(200, b'png', {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})).fetch(URL)
+    expire(cache)
+
+    stale = fetcher(cache, FakeResponse(304))
+    stale.fetch(URL)
+
+    assert stale._session.requests == [{'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}]
+
+
+def test_304_serves_the_stored_body_and_refreshes_its_lifetime(tmp_path):
+    cache = HttpCache(str(tmp_path))
+    fetcher(cache, FakeResponse(200, b'png', {'ETag': '"v1"'})).fetch(URL)
+    expire(cache)
+
+    assert fetcher(cache, FakeResponse(304, headers={'Cache-Control': 'max-age=3600'})).fetch(URL) == b'png'
+    assert cache.revalidated == 1
+    assert cache.lookup(URL).is_fresh
+
+
+def test_stale_entry_changed_at_the_origin_is_replaced(tmp_path):
+    cache = HttpCache(str(tmp_path))
+    fetcher(cache, FakeResponse(200, b'old', {'ETag': '"v1"'})).fetch(URL)
+    expire(cache)
+
+    assert fetcher(cache, FakeResponse(200, b'new', {'ETag': '"v2"'})).fetch(URL) == b'new'
+    assert cache.lookup(URL).meta['etag'] == '"v2"'
+
+
+def test_no_store_response_is_not_cached(tmp_path):
+    cache = HttpCache(str(tmp_path))
+    fetcher(cache, FakeResponse(200, b'png', {'Cache-Control': 'no-store', 'ETag': '"v1"'})).fetch(URL)
+
+    assert cache.lookup(URL) is None
+
+
+def test_response_without_validators_or_lifetime_is_not_cached(tmp_path):
+    cache = HttpCache(str(tmp_path))
+    fetcher(cache, FakeResponse(200, b'png')).fetch(URL)
+
+    assert cache.lookup(URL) is None
+
+
+def test_least_recently_used_entry_is_evicted_first(tmp_path):
+    cache = HttpCache(str(tmp_path), max_bytes=10)
+    headers = {'ETag': '"v1"'}
+    fetcher(cache, FakeResponse(200, b'aaaa', headers)).fetch('https://cdn.example.com/a')
+    fetcher(cache, FakeResponse(200, b'bbbb', headers)).fetch('https://cdn.example.com/b')
+
+    # Use a again so b is now the least recently used entry
+    a = cache.lookup('https://cdn.example.com/a')
+    os.utime(a.body_path, (time.time() + 60, time.time() + 60))
+
+    fetcher(cache, FakeResponse(200, b'cccc', headers)).fetch('https://cdn.example.com/c')
+
+    assert cache.lookup('https://cdn.example.com/a') is not None
+    assert cache.lookup('https://cdn.example.com/b') is None
+    assert cache.lookup('https://cdn.example.com/c') is not None
+
+
+def test_max_age_counts_from_the_age_the_response_already_had():
+    assert freshness_lifetime({'Cache-Control': 'max-age=600', 'Age': '100'}, time.time()) == 500
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Code-block handling of the shared MDX scanner (mdx_scanner.py).
+
+MDX has no indented code blocks, so only fences (including fences indented
+under a list item) hide links from the migrators.
+
+Usage:
+    python -m pytest scripts/tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mdx_scanner import _fence_marker, scan_content  # noqa: E402
+
+
+def image_srcs(content: str):
+    return [ref.src for ref in scan_content(content).image_refs]
+
+
+def test_links_in_prose_are_found():
+    assert image_srcs("![a](a.png)\n<img src=\"b.png\" />\n") == ['a.png', 'b.png']
+
+
+def test_links_in_a_fenced_block_are_skipped():
+    assert image_srcs("```md\n![a](a.png)\n```\n![b](b.png)\n") == ['b.png']
+
+
+def test_links_in_a_tilde_fenced_block_are_skipped():
+    assert image_srcs("~~~\n![a](a.png)\n~~~\n![b](b.png)\n") == ['b.png']
+
+
+def test_links_in_a_fence_indented_under_a_list_item_are_skipped():
+    assert image_srcs("- step\n\n    ```md\n    ![a](a.png)\n    ```\n\n![b](b.png)\n") == ['b.png']
+
+
+def test_giphy_links_in_a_fenced_block_are_skipped():
+    content = "```\n![a](https://media.giphy.com/media/abc/giphy.gif)\n```\n"
+
+    assert scan_content(content).giphy_links == []
+
+
+def test_a_fence_with_an_info_string_does_not_close_a_block():
+    assert image_srcs("```\n![a](a.png)\n```python\n![c](c.png)\n```\n![b](b.png)\n") == ['b.png']
+
+
+def test_a_longer_fence_is_only_closed_by_a_fence_at_least_as_long():
+    content = "````md\n```\n![a](a.png)\n```\n````\n![b](b.png)\n"
+
+    assert image_srcs(content) == ['b.png']
+
+
+def test_an_unclosed_fence_hides_the_rest_of_the_file():
+    assert image_srcs("![a](a.png)\n```\n![b](b.png)\n") == ['a.png']
+
+
+def test_mermaid_fence_becomes_a_diagram_not_prose():
+    scan = scan_content("## Flow\n```mermaid\ngraph TD\n  A --> B\n```\n")
+
+    assert scan.image_refs == []
+    assert [(block.code, block.heading) for block in scan.mermaid_blocks] == [("graph TD\n  A --> B", "Flow")]
+
+
+def test_fence_marker_needs_three_fence_characters():
+    assert _fence_marker("``") == ''
+    assert _fence_marker("~~") == ''
+
+
+def test_fence_marker_keeps_the_full_fence_length():
+    assert _fence_marker("````js") == '````'
+    assert _fence_marker("~~~") == '~~~'
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Near-duplicate detection (perceptual_hash.py): hash candidates must pass the pixel check.
+
+Usage:
+    python -m pytest scripts/tests
+"""
+
+import io
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image, ImageDraw  # noqa: E402
+
+from perceptual_hash import MIN_CONFIRM_SSIM, PerceptualIndex, fingerprint, pixel_similarity  # noqa: E402
+
+WORDS = ['def', 'return', 'import', 'self', 'for', 'in', 'if', 'else', 'class', 'print', 'value', '=', ':']
+
+
+def code_screenshot(seed: int, size=(1200, 700)) -> Image.Image:
+    """A dark-theme editor screenshot with random lines of code"""
+    rnd = random.Random(seed)
+    img = Image.new('RGB', size, (30, 30, 36))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([0, 0, size[0], 28], fill=(50, 50, 60))
+    for y in range(40, size[1] - 20, 18):
+        line = ' ' * rnd.choice([0, 4, 8]) + ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 9)))
+        draw.text((20, y), line, fill=rnd.choice([(220, 220, 220), (150, 200, 255), (255, 180, 120)]))
+    return img
+
+
+def encode(img: Image.Image, image_format: str = 'PNG', **options) -> bytes:
+    output = io.BytesIO()
+    img.save(output, image_format, **options)
+    return output.getvalue()
+
+
+def loose_index(images: dict) -> PerceptualIndex:
+    """Index where every image is a hash candidate of every other, so only the pixel check decides"""
+    index = PerceptualIndex(max_dhash_distance=64, max_phash_distance=64)
+    for key, data in images.items():
+        index.add(key, fingerprint(data))
+    return index
+
+
+def pixel_check(images: dict):
+    return lambda key, canonical: pixel_similarity(images[key], images[canonical]) >= MIN_CONFIRM_SSIM
+
+
+def test_resized_copy_passes_the_pixel_check():
+    original = code_screenshot(1)
+    resized = original.resize((600, 350), Image.Resampling.LANCZOS)
+
+    assert pixel_similarity(encode(original), encode(resized)) >= MIN_CONFIRM_SSIM
+
+
+def test_jpeg_copy_passes_the_pixel_check():
+    original = code_screenshot(2)
+
+    assert pixel_similarity(encode(original), encode(original, 'JPEG', quality=75)) >= MIN_CONFIRM_SSIM
+
+
+def test_different_screenshots_of_the_same_size_fail_the_pixel_check():
+    assert pixel_similarity(encode(code_screenshot(3)), encode(code_screenshot(4))) < MIN_CONFIRM_SSIM
+
+
+def test_true_duplicates_map_to_the_largest_copy():
+    original = code_screenshot(5)
+    images = {
+        'small.png': encode(original.resize((400, 233), Image.Resampling.LANCZOS)),
+        'original.png': encode(original),
+        'copy.jpg': encode(original, 'JPEG', quality=80),
+    }
+
+    assert loose_index(images).duplicates(pixel_check(images)) == {
+        'small.png': 'original.png',
+        'original.png': 'original.png',
+        'copy.jpg': 'original.png',
+    }
+
+
+def test_hash_candidates_with_different_pixels_are_not_duplicates():
+    images = {f'shot-{seed}.png': encode(code_screenshot(seed)) for seed in range(6, 10)}
+
+    assert loose_index(images).duplicates(pixel_check(images)) == {}
+
+
+def test_only_members_confirmed_against_the_canonical_copy_join_it():
+    original = code_screenshot(10)
+    images = {
+        'original.png': encode(original),
+        'resized.png': encode(original.resize((900, 525), Image.Resampling.BICUBIC)),
+        'other.png': encode(code_screenshot(11, size=(900, 525))),
+    }
+
+    assert loose_index(images).duplicates(pixel_check(images)) == {
+        'original.png': 'original.png',
+        'resized.png': 'original.png',
+    }
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Merging the shard manifests of several migrators (sharding.py, merge_shards.py).
+
+Usage:
+    python -m pytest scripts/tests
+"""
+
+import os
+import sys
+from pathlib import Path
+from typing import Callable
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mdx_scanner import scan_mdx  # noqa: E402
+from merge_shards import load_manifests, merge  # noqa: E402
+from sharding import Shard  # noqa: E402
+
+POST = """# Post
+
+![Local](./diagram.png)
+
+![Dancing](https://media.giphy.com/media/abc123/giphy.gif)
+![Waving](https://i.giphy.com/media/def456/giphy.gif)
+<img src="https://media.giphy.com/media/ghi789/giphy.gif" alt="Jumping" />
+"""
+
+
+@pytest.fixture
+def post(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('R2_BUCKET_NAME', 'bucket')
+    monkeypatch.setenv('MIGRATION_STATE_DISABLE', '1')
+    mdx_file = tmp_path / "src/content/blog/post/index.mdx"
+    mdx_file.parent.mkdir(parents=True)
+    mdx_file.write_text(POST, encoding='utf-8')
+    return mdx_file
+
+
+def rewrite(mdx_file: Path, replacements):
+    content = mdx_file.read_text(encoding='utf-8')
+    for old, new in replacements.items():
+        content = content.replace(old, new)
+    mdx_file.write_text(content, encoding='utf-8')
+
+
+def record(migrator: str, mdx_file: Path, rewrite_file: Callable[[], None], manifest_dir: Path) -> Path:
+    """Record one migrator's rewrites as a 1/2 shard manifest"""
+    shard = Shard(0, 2)
+    with shard.recording(mdx_file):
+        rewrite_file()
+    return shard.write_manifest(migrator, str(manifest_dir / f"{migrator}.json"))
+
+
+def test_image_migrator_leaves_giphy_links_to_the_giphy_migrator(post):
+    from migrate_images_to_r2 import ImageToR2Migrator
+
+    image_srcs = [src for _, _, src in ImageToR2Migrator(jobs=1).find_image_references(post)]
+    giphy_urls = [link.url for link in scan_mdx(post).giphy_links]
+
+    assert image_srcs == ['./diagram.png', 'https://media.giphy.com/media/ghi789/giphy.gif']
+    assert giphy_urls == [
+        'https://media.giphy.com/media/abc123/giphy.gif',
+        'https://i.giphy.com/media/def456/giphy.gif',
+    ]
+
+
+def test_giphy_img_tags_are_migrated_by_the_image_migrator(post):
+    from migrate_images_to_r2 import ImageToR2Migrator
+
+    migrator = ImageToR2Migrator(jobs=1)
+    tag = '<img src="https://media.giphy.com/media/ghi789/giphy.gif" alt="Jumping" />'
+
+    assert tag in [full_match for full_match, _, _ in migrator.find_image_references(post)]
+    assert all(link.url != 'https://media.giphy.com/media/ghi789/giphy.gif' for link in scan_mdx(post).giphy_links)
+
+    migrator.replace_image_references_in_file(post, {tag: 'https://r2.example/jumping.gif'})
+    assert '<img src="https://r2.example/jumping.gif" alt="Jumping" />' in post.read_text(encoding='utf-8')
+
+
+def test_merge_manifests_from_two_migrators(post, tmp_path):
+    from migrate_images_to_r2 import ImageToR2Migrator
+
+    migrator = ImageToR2Migrator(jobs=1)
+    images = {
+        full_match: f"https://r2.example/{Path(src).stem}.avif"
+        for full_match, _, src in migrator.find_image_references(post)
+    }
+    giphy = {
+        link.url: f"https://r2.example/{link.alt_text}.gif"
+        for link in scan_mdx(post).giphy_links
+    }
+    manifests = [
+        record('images', post, lambda: migrator.replace_image_references_in_file(post, images), tmp_path),
+        record('giphy', post, lambda: rewrite(post, giphy), tmp_path),
+    ]
+    assert post.read_text(encoding='utf-8') == POST
+
+    files, _ = load_manifests(manifests)
+    rewritten, errors = merge(files)
+
+    assert errors == []
+    assert rewritten == 1
+    assert post.read_text(encoding='utf-8') == """# Post
+
+![Local](https://r2.example/diagram.avif)
+
+![Dancing](https://r2.example/Dancing.gif)
+![Waving](https://r2.example/Waving.gif)
+<img src="https://r2.example/giphy.avif" alt="Jumping" />
+"""
+
+
+def test_overlapping_manifests_leave_the_file_untouched(post, tmp_path):
+    link = '![Dancing](https://media.giphy.com/media/abc123/giphy.gif)'
+    manifests = [
+        record('images', post, lambda: rewrite(post, {link: '![Dancing](https://r2.example/a.avif)'}), tmp_path),
+        record('giphy', post, lambda: rewrite(post, {link: '![Dancing](https://r2.example/a.gif)'}), tmp_path),
+    ]
+
+    files, _ = load_manifests(manifests)
+    rewritten, errors = merge(files)
+
+    assert rewritten == 0
+    assert len(errors) == 1 and 'overlapping edits' in errors[0]
+    assert post.read_text(encoding='utf-8') == POST
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+ETag prediction of streamed bodies (spooled_body.py).
+
+R2 reports the plain MD5 for single-PUT objects and md5(part md5s)-N for
+multipart uploads; boto3 switches to multipart at exactly the part size.
+
+Usage:
+    python -m pytest scripts/tests
+"""
+
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from spooled_body import CONTENT_HASH_BYTES, MULTIPART_CHUNK_SIZE, BodyTooLargeError, SpooledBody  # noqa: E402
+
+PART = 4
+
+
+def spooled(data: bytes, chunk: int = 1024) -> SpooledBody:
+    """data written in chunks of `chunk` bytes to a body with PART-byte parts"""
+    body = SpooledBody(part_size=PART)
+    for i in range(0, len(data), chunk):
+        body.write(data[i:i + chunk])
+    return body
+
+
+def multipart_etag(data: bytes) -> str:
+    digests = [hashlib.md5(data[i:i + PART]).digest() for i in range(0, len(data), PART)]
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def test_body_below_the_part_size_has_the_plain_md5_etag():
+    assert spooled(b'abc').etag == hashlib.md5(b'abc').hexdigest()
+
+
+def test_body_of_exactly_the_part_size_has_a_one_part_multipart_etag():
+    assert spooled(b'abcd').etag == multipart_etag(b'abcd')
+    assert spooled(b'abcd').etag.endswith('-1')
+
+
+def test_body_one_byte_over_the_part_size_has_a_two_part_multipart_etag():
+    assert spooled(b'abcde').etag == multipart_etag(b'abcde')
+    assert spooled(b'abcde').etag.endswith('-2')
+
+
+def test_etag_does_not_depend_on_how_the_chunks_straddle_part_boundaries():
+    data = bytes(range(23))
+
+    assert spooled(data, chunk=3).etag == spooled(data, chunk=23).etag == multipart_etag(data)
+
+
+def test_content_hash_is_the_blake2b_of_the_body():
+    assert spooled(b'abcde').content_hash == hashlib.blake2b(b'abcde', digest_size=CONTENT_HASH_BYTES).hexdigest()
+
+
+def test_body_over_max_bytes_is_rejected():
+    body = SpooledBody(max_bytes=4)
+    body.write(b'abcd')
+
+    with pytest.raises(BodyTooLargeError):
+        body.write(b'e')
+
+
+def test_boto3_switches_to_multipart_at_the_part_size():
+    from r2_uploader import transfer_config
+
+    assert transfer_config().multipart_threshold == MULTIPART_CHUNK_SIZE
+    assert transfer_config().multipart_chunksize == MULTIPART_CHUNK_SIZE
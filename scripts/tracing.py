@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Lightweight span tracing for the migration scripts.
+
+Every stage of a migration (scan, resolve, download, decode, encode, render,
+upload, rewrite, ...) is wrapped in a span that records its post and asset,
+bytes in/out and the process and thread it ran on:
+
+    with tracer.span('encode', asset=src, bytes_in=len(data)) as span:
+        data = ...
+        span.bytes_out = len(data)
+
+Post and asset are inherited from `tracer.context(...)`, which migrators open
+per post and per asset. Work handed to thread pools keeps the submitting
+thread's context through `tracer.bind(fn)`; work handed to process pools goes
+through `tracer.submit(executor, fn, ...)`, which also brings the worker's
+spans back to the parent.
+
+Tracing is off unless a script is run with `--trace PATH` (or MIGRATION_TRACE
+is set), in which case spans cost a few microseconds each and otherwise
+nothing. At the end of the run `tracer.finish()` writes PATH as Chrome
+trace-event JSON (open it in chrome://tracing or https://ui.perfetto.dev),
+writes a per-stage summary next to it as `<PATH stem>.summary.json` and returns
+a p50/p95/max table for printing.
+"""
+
+import os
+import json
+import time
+import threading
+from concurrent.futures import Executor, Future
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+TRACE_ENV = "MIGRATION_TRACE"
+
+
+class Span:
+    __slots__ = ('stage', 'post', 'asset', 'bytes_in', 'bytes_out',
+                 'start_ns', 'end_ns', 'pid', 'thread', 'thread_id', '_tracer', '_context')
+
+    def __init__(self, tracer: Optional['Tracer'], stage: str, post: Optional[str], asset: Optional[str],
+                 bytes_in: Optional[int]):
+        self.stage = stage
+        self.post = post
+        self.asset = asset
+        self.bytes_in = bytes_in
+        self.bytes_out: Optional[int] = None
+        self.start_ns = 0
+        self.end_ns = 0
+        self.pid = os.getpid()
+        thread = threading.current_thread()
+        self.thread = thread.name
+        self.thread_id = thread.ident
+        self._tracer = tracer
+        self._context = None
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def __enter__(self) -> 'Span':
+        # Nested spans and contexts inside this span inherit its post and asset
+        self._context = self._tracer._push({'post': self.post, 'asset': self.asset})
+        self.start_ns = time.monotonic_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end_ns = time.monotonic_ns()
+        self._tracer._pop(self._context)
+        self._tracer._record(self)
+        self._tracer = self._context = None
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if not name.startswith('_')}
+
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+
+
+class _NullSpan:
+    """Stand-in returned while tracing is off; attribute writes are discarded"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Context:
+    def __init__(self, tracer: 'Tracer', fields: Dict[str, Optional[str]]):
+        self.tracer = tracer
+        self.fields = fields
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = self.tracer._push(self.fields)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer._pop(self.previous)
+
+
+def _run_traced(fn: Callable, args: tuple, context: Dict[str, Optional[str]]):
+    """Process pool entry point: run fn with tracing on and return its spans with the result"""
+    tracer.enabled = True
+    tracer.spans = []
+    with tracer.context(**context):
+        result = fn(*args)
+    spans, tracer.spans = tracer.spans, []
+    return result, spans
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.path: Optional[Path] = None
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_ns = 0
+
+    # Context
+
+    def _current(self) -> Dict[str, Optional[str]]:
+        return getattr(self._local, 'context', None) or {}
+
+    def _push(self, fields: Dict[str, Optional[str]]) -> Dict[str, Optional[str]]:
+        previous = self._current()
+        merged = dict(previous)
+        merged.update({key: value for key, value in fields.items() if value is not None})
+        self._local.context = merged
+        return previous
+
+    def _pop(self, previous: Dict[str, Optional[str]]):
+        self._local.context = previous
+
+    def context(self, post: Optional[str] = None, asset: Optional[str] = None):
+        """Set the post and/or asset that spans opened inside this block are attributed to"""
+        if not self.enabled:
+            return NULL_SPAN
+        return _Context(self, {'post': post, 'asset': asset})
+
+    def bind(self, fn: Callable) -> Callable:
+        """Wrap fn so it runs under the calling thread's context (for thread pools)"""
+        if not self.enabled:
+            return fn
+        context = self._current()
+
+        def bound(*args, **kwargs):
+            previous = self._push(context)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._pop(previous)
+        return bound
+
+    def submit(self, executor: Executor, fn: Callable, *args) -> Future:
+        """executor.submit for process pools that keeps the spans recorded in the worker"""
+        if not self.enabled:
+            return executor.submit(fn, *args)
+
+        outer = Future()
+
+        def done(inner: Future):
+            try:
+                result, spans = inner.result()
+            except BaseException as e:
+                outer.set_exception(e)
+                return
+            with self._lock:
+                self.spans.extend(spans)
+            outer.set_result(result)
+
+        executor.submit(_run_traced, fn, args, self._current()).add_done_callback(done)
+        return outer
+
+    # Spans
+
+    def span(self, stage: str, post: Optional[str] = None, asset: Optional[str] = None,
+             bytes_in: Optional[int] = None):
+        """A span for one stage; use as a context manager and set .bytes_out before it closes"""
+        if not self.enabled:
+            return NULL_SPAN
+        context = self._current()
+        return Span(self, stage, post or context.get('post'), asset or context.get('asset'), bytes_in)
+
+    def _record(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    # Run lifecycle
+
+    def start(self, path: Optional[str] = None) -> bool:
+        """Turn tracing on if a trace path is given (or set in MIGRATION_TRACE)"""
+        path = path or os.getenv(TRACE_ENV)
+        if not path:
+            return False
+        self.enabled = True
+        self.path = Path(path)
+        self.spans = []
+        self._started_ns = time.monotonic_ns()
+        return True
+
+    def summary(self) -> Dict[str, dict]:
+        """Per-stage count, total, p50/p95/max duration in ms and bytes in/out"""
+        by_stage: Dict[str, List[Span]] = {}
+        for span in self.spans:
+            by_stage.setdefault(span.stage, []).append(span)
+
+        stages = {}
+        for stage, spans in by_stage.items():
+            durations = sorted(span.duration_ms for span in spans)
+            stages[stage] = {
+                'count': len(durations),
+                'total_ms': round(sum(durations), 3),
+                'p50_ms': round(_percentile(durations, 50), 3),
+                'p95_ms': round(_percentile(durations, 95), 3),
+                'max_ms': round(durations[-1], 3),
+                'bytes_in': sum(span.bytes_in or 0 for span in spans),
+                'bytes_out': sum(span.bytes_out or 0 for span in spans),
+            }
+        return dict(sorted(stages.items(), key=lambda item: -item[1]['total_ms']))
+
+    def summary_table(self) -> str:
+        stages = self.summary()
+        lines = [f"{'stage':<12}{'count':>7}{'total ms':>12}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"
+                 f"{'MB in':>9}{'MB out':>9}"]
+        for stage, s in stages.items():
+            lines.append(
+                f"{stage:<12}{s['count']:>7}{s['total_ms']:>12.1f}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}"
+                f"{s['max_ms']:>10.1f}{s['bytes_in'] / 1e6:>9.2f}{s['bytes_out'] / 1e6:>9.2f}"
+            )
+        return "\n".join(lines)
+
+    def chrome_trace(self) -> dict:
+        """The recorded spans as Chrome trace-event JSON (complete 'X' events)"""
+        events = []
+        threads = {}
+        for span in self.spans:
+            threads[(span.pid, span.thread_id)] = span.thread
+            args = {'post': span.post, 'asset': span.asset, 'bytes_in': span.bytes_in,
+                    'bytes_out': span.bytes_out, 'worker': f"{span.pid}/{span.thread}"}
+            events.append({
+                'name': span.stage,
+                'cat': 'migration',
+                'ph': 'X',
+                'ts': (span.start_ns - self._started_ns) / 1000,
+                'dur': (span.end_ns - span.start_ns) / 1000,
+                'pid': span.pid,
+                'tid': span.thread_id,
+                'args': {key: value for key, value in args.items() if value is not None},
+            })
+
+        main_pid = os.getpid()
+        for pid in {pid for pid, _ in threads}:
+            name = 'migration' if pid == main_pid else f'encoder worker {pid}'
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}})
+        for (pid, tid), name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def finish(self) -> str:
+        """Write the Chrome trace and summary JSON; returns the summary table ('' when off)"""
+        if not self.enabled:
+            return ""
+        self.enabled = False
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f)
+
+        summary_path = self.path.with_name(f"{self.path.stem}.summary.json")
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'wall_ms': round((time.monotonic_ns() - self._started_ns) / 1e6, 3),
+                'stages': self.summary(),
+            }, f, indent=2)
+
+        return f"Trace written to {self.path} (summary: {summary_path})\n{self.summary_table()}"
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+# Process-wide tracer shared by every module of a migration run
+tracer = Tracer()